@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# преобразование аудио через ffmpeg без временных файлов
+# данные подаются в ffmpeg через stdin и забираются из stdout, длительность
+# берется из статистики которую ffmpeg пишет в stderr в том же запуске,
+# так что для конвертации с определением длины нужен один процесс а не два (ffprobe + ffmpeg)
+
+
+import re
+import subprocess
+import threading
+
+import my_log
+import utils
+
+
+FFMPEG = 'ffmpeg'
+
+# по умолчанию для распознавания речи
+OGG_ARGS = ['-map', '0:a', '-c:a', 'libvorbis', '-f', 'ogg']
+# сырой звук для speech_recognition, моно 16кгц 16бит
+PCM_RATE = 16000
+PCM_ARGS = ['-map', '0:a', '-ac', '1', '-ar', str(PCM_RATE), '-f', 's16le']
+
+# time=00:01:02.50 в строке статистики, последняя - длина того что записано
+TIME_RE = re.compile(r'time=\s*(\d+):(\d+):(\d+(?:\.\d+)?)')
+# Duration: 00:01:02.50 в заголовке входного файла, у потока из stdin бывает N/A
+DURATION_RE = re.compile(r'Duration:\s*(\d+):(\d+):(\d+(?:\.\d+)?)')
+
+
+def parse_duration(log: str) -> float:
+    '''Duration in seconds from ffmpeg stderr, 0 if not found'''
+    found = TIME_RE.findall(log) or DURATION_RE.findall(log)
+    if not found:
+        return 0
+    hours, minutes, seconds = found[-1]
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+def run(data, output_args: list, start: float = 0, length: float = 0) -> tuple:
+    '''Run ffmpeg on data (bytes or path to file), returns (stdout bytes, stderr text).
+
+    start, length - cut fragment, seconds
+    '''
+    cut = []
+    if start:
+        cut += ['-ss', str(start)]
+    input_ = data if isinstance(data, str) else 'pipe:0'
+    args = [FFMPEG, '-hide_banner', '-nostdin', *cut, '-i', input_]
+    if length:
+        args += ['-t', str(length)]
+    args += [*output_args, 'pipe:1']
+    proc = subprocess.run(args,
+                          input=None if isinstance(data, str) else data,
+                          stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE)
+    return proc.stdout, proc.stderr.decode('utf-8', errors='replace')
+
+
+def convert(data, output_args: list = OGG_ARGS, start: float = 0, length: float = 0) -> tuple:
+    '''Convert audio (bytes or path to file) to ogg or other format from output_args.
+
+    Returns (converted bytes, duration of converted audio in seconds)
+    '''
+    try:
+        out, log = run(data, output_args, start, length)
+        if not out and not isinstance(data, str):
+            # mp4/mov у которых индекс в конце файла нельзя читать из трубы,
+            # ffmpeg нужен файл с произвольным доступом
+            tmp_fname = utils.get_tmp_fname()
+            try:
+                with open(tmp_fname, 'wb') as f:
+                    f.write(data)
+                out, log = run(tmp_fname, output_args, start, length)
+            finally:
+                utils.remove_file(tmp_fname)
+        if not out:
+            my_log.log2(f'my_audio:convert: ffmpeg failed\n\n{log[-2000:]}')
+        return out, parse_duration(log)
+    except Exception as error:
+        my_log.log2(f'my_audio:convert: {error}')
+        return b'', 0
+
+
+def duration(data) -> float:
+    '''Duration of audio (bytes or path to file) in seconds.
+    The stream is copied, not decoded, so it is fast'''
+    _, log = run(data, ['-map', '0:a', '-c', 'copy', '-f', 'null'])
+    return parse_duration(log)
+
+
+def to_pcm(data) -> bytes:
+    '''Raw mono 16 bit PCM with PCM_RATE sample rate,
+    for speech_recognition.AudioData and pydub.AudioSegment'''
+    out, _ = convert(data, PCM_ARGS)
+    return out
+
+
+def stream_pcm(data, block: float = 1.0):
+    '''Decode audio (bytes, path or url) to raw PCM like to_pcm and yield it
+    by blocks of `block` seconds while ffmpeg is still decoding the rest'''
+    tmp_fname = ''
+    if not isinstance(data, str) and data[4:8] in (b'ftyp', b'moov'):
+        # mp4/mov читается из трубы только если индекс в начале, проще сразу дать файл
+        tmp_fname = utils.get_tmp_fname()
+        with open(tmp_fname, 'wb') as f:
+            f.write(data)
+        data = tmp_fname
+    pipe = not isinstance(data, str)
+    proc = subprocess.Popen([FFMPEG, '-hide_banner', '-nostdin', '-i', 'pipe:0' if pipe else data, *PCM_ARGS, 'pipe:1'],
+                            stdin=subprocess.PIPE if pipe else subprocess.DEVNULL,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL)
+
+    def feed():
+        try:
+            proc.stdin.write(data)
+        except Exception:
+            # ffmpeg закончил раньше (ошибка или прервали чтение)
+            pass
+        finally:
+            try:
+                proc.stdin.close()
+            except Exception:
+                pass
+
+    if pipe:
+        # пишем в отдельном потоке, иначе ffmpeg и мы будем ждать друг друга
+        threading.Thread(target=feed, daemon=True).start()
+
+    try:
+        size = int(PCM_RATE * 2 * block)
+        while True:
+            chunk = proc.stdout.read(size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        proc.stdout.close()
+        if proc.poll() is None:
+            proc.kill()
+        proc.wait()
+        if tmp_fname:
+            utils.remove_file(tmp_fname)
+
+
+if __name__ == '__main__':
+    pass
+
+    # with open('1.ogg', 'rb') as f:
+    #     data = f.read()
+    # ogg, dur = convert(data)
+    # print(len(ogg), dur, duration(data))
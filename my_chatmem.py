@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+# общая память диалогов для всех модулей с ИИ (my_gemini, my_groq, my_openrouter и т.д.)
+# каждый модуль создает свой ChatMemory и его функции update_mem, undo, reset,
+# get_mem_as_string просто вызывают методы этого объекта
+
+
+import collections
+import threading
+import traceback
+
+import my_db
+import my_log
+
+
+# сколько историй держать в памяти, остальные читаются из базы при обращении
+CACHE_SIZE = 1000
+
+
+def message_tokens(message) -> int:
+    '''Token estimate for message in openai {'content'} or gemini {'parts'} format'''
+    if isinstance(message, dict):
+        if 'content' in message:
+            text = message['content']
+        else:
+            text = ' '.join(x.get('text', '') for x in message.get('parts', []) if isinstance(x, dict))
+    else:
+        text = message
+    if not isinstance(text, str):
+        text = str(text)
+    return my_db.estimate_tokens(text)
+
+
+def trim_tokens(mem: list, max_tokens: int) -> list:
+    '''Drop oldest messages so the rest fit into max_tokens.
+    System message at the start is kept, the last message (query) is always kept,
+    history starts with a user message.
+    Each message is measured once, O(n).
+    '''
+    if not mem or not max_tokens:
+        return mem
+    head = mem[:1] if isinstance(mem[0], dict) and mem[0].get('role') == 'system' else []
+    body = mem[len(head):]
+    if not body:
+        return mem
+    total = sum(message_tokens(x) for x in head)
+    start = len(body) - 1
+    for i in range(len(body) - 1, -1, -1):
+        total += message_tokens(body[i])
+        if total > max_tokens and i < len(body) - 1:
+            break
+        start = i
+    while start < len(body) - 1 and body[start].get('role') != 'user':
+        start += 1
+    return head + body[start:]
+
+
+class History:
+    '''Chat history with running totals of chars and tokens.
+
+    Messages are appended to the end and dropped from the start, so keeping
+    history under the limits costs O(1) amortized per message.
+    '''
+    def __init__(self, messages = ()):
+        # (role, text, tokens)
+        self.messages = collections.deque()
+        self.chars = 0
+        self.tokens = 0
+        # (max_lines, max_chars, max_tokens) с которыми история была загружена
+        self.limits = (0, 0, 0)
+        for role, text, tokens in messages:
+            self.append(role, text, tokens)
+
+    def append(self, role: str, text: str, tokens: int = None):
+        if tokens is None:
+            tokens = my_db.estimate_tokens(text)
+        self.messages.append((role, text, tokens))
+        self.chars += len(text)
+        self.tokens += tokens
+
+    def popleft(self):
+        _, text, tokens = self.messages.popleft()
+        self.chars -= len(text)
+        self.tokens -= tokens
+
+    def pop(self):
+        _, text, tokens = self.messages.pop()
+        self.chars -= len(text)
+        self.tokens -= tokens
+
+    def trim(self, max_lines: int, max_chars: int, max_tokens: int):
+        '''Drop oldest messages until history fits into limits (0 - no limit),
+        history always starts with a user message'''
+        while self.messages and ((max_lines and len(self.messages) > max_lines) or
+                                 (max_chars and self.chars > max_chars) or
+                                 (max_tokens and self.tokens > max_tokens)):
+            self.popleft()
+        while self.messages and self.messages[0][0] != 'user':
+            self.popleft()
+
+
+def limits_grown(old: tuple, new: tuple) -> bool:
+    '''True if any of new limits is bigger than old one, 0 - no limit'''
+    return any((n or float('inf')) > (o or float('inf')) for o, n in zip(old, new))
+
+
+class ChatMemory:
+    '''Chat history engine shared by LLM backends.
+
+    Keeps per-chat locks, stores history in my_db dialogs table (or in memory
+    if persistent=False) and trims it to the configured limits.
+    Recent histories are cached in memory with running totals, db is read only
+    for chats that are not in the cache.
+
+    backend - name of the backend in dialogs table ('groq', 'openrouter' etc)
+    max_lines - how many messages to keep (user and bot message are 2 lines)
+    max_chars - how many chars of text to keep, 0 - no limit
+    max_tokens - how many tokens to keep (see my_db.estimate_tokens), 0 - no limit
+    limits - function(chat_id) -> (max_lines, max_chars), for per user limits
+    assistant_role - role of bot messages, 'assistant' or 'model' for gemini
+    persistent - store history in db or only in memory
+    log - logging function of the backend
+    '''
+    def __init__(self,
+                 backend: str,
+                 max_lines: int = 40,
+                 max_chars: int = 0,
+                 max_tokens: int = 0,
+                 limits = None,
+                 assistant_role: str = 'assistant',
+                 persistent: bool = True,
+                 log = my_log.log2):
+        self.backend = backend
+        self.max_lines = max_lines
+        self.max_chars = max_chars
+        self.max_tokens = max_tokens
+        self.limits = limits
+        self.assistant_role = assistant_role
+        self.persistent = persistent
+        self.log = log
+
+        # {chat_id: threading.RLock()}
+        self.locks = {}
+        self.locks_lock = threading.Lock()
+
+        # {chat_id: History}, LRU если persistent=True, иначе это и есть хранилище.
+        # cache_lock общий для всех чатов и держится только на время операций
+        # со словарем и историей в памяти, чтение из базы идет под блокировкой чата
+        self.cache = collections.OrderedDict()
+        self.cache_lock = threading.Lock()
+
+    def lock(self, chat_id: str) -> threading.RLock:
+        '''Get lock for chat, hold it while reading history, asking the model and saving the answer.
+        Methods of ChatMemory take it too, so it is reentrant'''
+        with self.locks_lock:
+            if chat_id not in self.locks:
+                self.locks[chat_id] = threading.RLock()
+            return self.locks[chat_id]
+
+    def get_limits(self, chat_id: str) -> tuple:
+        '''(max_lines, max_chars, max_tokens) for chat'''
+        if self.limits:
+            max_lines, max_chars = self.limits(chat_id)
+            return max_lines, max_chars, self.max_tokens
+        return self.max_lines, self.max_chars, self.max_tokens
+
+    def cached(self, chat_id: str, limits: tuple) -> History:
+        '''History from memory cache or None if it has to be (re)loaded, must be called with cache_lock'''
+        history = self.cache.get(chat_id)
+        if history is None or (self.persistent and limits_grown(history.limits, limits)):
+            return None
+        self.cache.move_to_end(chat_id)
+        history.limits = limits
+        history.trim(*limits)
+        return history
+
+    def history(self, chat_id: str, limits: tuple) -> History:
+        '''Get History object for chat, read it from db if it is not in memory.
+        Must be called without cache_lock, read its messages with cache_lock'''
+        with self.cache_lock:
+            history = self.cached(chat_id, limits)
+        if history is not None:
+            return history
+
+        # чтение (и миграция старого формата) из базы может быть долгим,
+        # другие чаты в это время работают, этот ждет на своей блокировке
+        with self.lock(chat_id):
+            with self.cache_lock:
+                history = self.cached(chat_id, limits)
+            if history is not None:
+                return history
+            messages = []
+            if self.persistent:
+                max_lines, _, max_tokens = limits
+                messages = my_db.get_dialog(chat_id, self.backend, max_lines=max_lines,
+                                            max_tokens=max_tokens, with_tokens=True)
+            history = History(messages)
+            with self.cache_lock:
+                self.cache[chat_id] = history
+                if self.persistent:
+                    while len(self.cache) > CACHE_SIZE:
+                        self.cache.popitem(last=False)
+                history.limits = limits
+                history.trim(*limits)
+            return history
+
+    def get_messages(self, chat_id: str) -> list:
+        '''Get chat history as list of (role, text)'''
+        try:
+            history = self.history(chat_id, self.get_limits(chat_id))
+            with self.cache_lock:
+                return [(role, text) for role, text, _ in history.messages]
+        except Exception as error:
+            error_traceback = traceback.format_exc()
+            self.log(f'my_chatmem:get_messages: {self.backend} {error}\n\n{error_traceback}')
+            return []
+
+    def get(self, chat_id: str) -> list:
+        '''Get chat history in openai format [{'role': 'user', 'content': '...'}, ...]'''
+        return [{'role': role, 'content': text} for role, text in self.get_messages(chat_id)]
+
+    def update(self, chat_id: str, query: str, resp: str):
+        '''Add user query and bot response to chat history'''
+        messages = [('user', query), (self.assistant_role, resp)]
+        try:
+            # под блокировкой чата, чтобы история не читалась из базы одновременно с записью
+            with self.lock(chat_id):
+                if self.persistent:
+                    my_db.add_dialog(chat_id, self.backend, messages)
+                else:
+                    # в памяти история создается при первом обращении
+                    self.history(chat_id, self.get_limits(chat_id))
+                with self.cache_lock:
+                    history = self.cache.get(chat_id)
+                    if history is not None:
+                        for role, text in messages:
+                            history.append(role, text)
+                        history.trim(*history.limits)
+        except Exception as error:
+            error_traceback = traceback.format_exc()
+            self.log(f'my_chatmem:update: {self.backend} {error}\n\n{error_traceback}')
+
+    def undo(self, chat_id: str, n: int = 2):
+        '''Remove last n messages (last query and response) from chat history'''
+        try:
+            with self.lock(chat_id):
+                if self.persistent:
+                    my_db.undo_dialog(chat_id, self.backend, n)
+                with self.cache_lock:
+                    if self.persistent:
+                        # в базе могут быть более старые сообщения которые теперь влезут, перечитать
+                        self.cache.pop(chat_id, None)
+                    elif chat_id in self.cache:
+                        history = self.cache[chat_id]
+                        for _ in range(min(n, len(history.messages))):
+                            history.pop()
+        except Exception as error:
+            error_traceback = traceback.format_exc()
+            self.log(f'Failed to undo chat {chat_id}: {error}\n\n{error_traceback}')
+
+    def reset(self, chat_id: str):
+        '''Remove chat history'''
+        with self.lock(chat_id):
+            if self.persistent:
+                my_db.reset_dialog(chat_id, self.backend)
+            with self.cache_lock:
+                self.cache.pop(chat_id, None)
+
+    def as_string(self, chat_id: str) -> str:
+        '''Chat history as text for showing to user'''
+        try:
+            result = ''
+            for role, text in self.get_messages(chat_id):
+                if role == 'user': role = '𝐔𝐒𝐄𝐑'
+                if role == self.assistant_role: role = '𝐁𝐎𝐓'
+                if role == 'system': role = '𝐒𝐘𝐒𝐓𝐄𝐌'
+                if text.startswith('[Info to help you answer'):
+                    end = text.find(']') + 1
+                    text = text[end:].strip()
+                result += f'{role}: {text}\n'
+                if role == '𝐁𝐎𝐓':
+                    result += '\n'
+            return result
+        except Exception as error:
+            error_traceback = traceback.format_exc()
+            self.log(f'my_chatmem:as_string: {self.backend} {error}\n\n{error_traceback}')
+            return ''
+
+
+if __name__ == '__main__':
+    pass
+    my_db.init(backup=False)
+
+    # mem = ChatMemory('test', max_lines=4, max_chars=100, max_tokens=50)
+    # mem.update('test', 'hi', 'hello')
+    # mem.update('test', '1+1', '2')
+    # mem.update('test', '2+2', '4')
+    # print(mem.get('test'))
+    # print(mem.as_string('test'))
+    # mem.undo('test')
+    # print(mem.get('test'))
+    # mem.reset('test')
+
+    my_db.close()
@@ -1,13 +1,16 @@
 #!/usr/bin/env python3
 
 
+import contextlib
 import gzip
 import hashlib
 import lzma
 import pickle
+import queue
 import time
 import threading
 import traceback
+import zlib
 import shutil
 import sqlite3
 import sys
@@ -18,32 +21,121 @@ import my_log
 from utils import async_run
 
 
+DB_FILE = 'db/main.db'
+
+# LOCK, CON и CUR только для записи, читают через READ_POOL
 LOCK = threading.Lock()
 
 CON = None
 CUR = None
+READ_POOL = None
 COM_COUNTER = 0
 DAEMON_RUN = True
-DAEMON_TIME = 120
-
-
-# Serialize and compress an object
-def obj_to_blob(obj):
-    if obj is None:
-        return None
-    else:
-        try:
-            return lzma.compress(pickle.dumps(obj))
-        except Exception as error:
-            my_log.log2(f'my_db:obj_to_blob {error}')
-            return None
+# база в режиме WAL, коммит дешевый, поэтому коммитим часто что бы
+# читатели из READ_POOL видели свежие данные
+DAEMON_TIME = 2
+
+# отложенная запись свойств юзеров, {user_id: {property: value}}
+# set_user_property только складывает сюда значения, а sync_daemon
+# раз в DAEMON_TIME секунд пишет их в базу пачками. Значения удаляются
+# отсюда только после коммита
+USERS_PENDING = {}
+USERS_PENDING_LOCK = threading.Lock()
+# увеличивается после каждой выгрузки USERS_PENDING в базу
+USERS_FLUSH_GEN = 0
+
+# счетчики сообщений по дням, номер дня = int(access_time // DAY_SECONDS)
+DAY_SECONDS = 60 * 60 * 24
+# счетчики хранятся год, раз в MSG_EXPIRE_TIME секунд старые дни вычитаются из итогов
+MSG_KEEP_DAYS = 365
+MSG_EXPIRE_TIME = 60 * 60
+
+# старые колонки users в которых диалоги хранились целиком, {backend: column}
+# при первом чтении диалога они переносятся в таблицу dialogs
+DIALOG_COLUMNS = {
+    'gemini': 'dialog_gemini',
+    'groq': 'dialog_groq',
+    'openrouter': 'dialog_openrouter',
+    'shadow': 'dialog_shadow',
+    'gpt4omini': 'dialog_gpt4omini',
+}
+# сколько последних сообщений хранить в dialogs для одного чата
+DIALOG_MAX_ROWS = 200
+
+# очередь для add_msg, один поток msg_counter_daemon забирает из нее записи
+# и пишет их пачками по MSG_BATCH_SIZE штук или раз в MSG_BATCH_TIME секунд
+MSG_QUEUE_SIZE = 10000
+MSG_BATCH_SIZE = 500
+MSG_BATCH_TIME = 0.5
+MSG_QUEUE = queue.Queue(maxsize=MSG_QUEUE_SIZE)
+MSG_QUEUE_DONE = threading.Event()
+MSG_QUEUE_STATS_LOCK = threading.Lock()
+MSG_QUEUE_STATS = {
+    'queued': 0,
+    'written': 0,
+    'batches': 0,
+    'max_batch': 0,
+    'max_depth': 0,
+    'full': 0, # сколько раз очередь была полной и add_msg ждал
+    'dropped': 0,
+}
+
+# кеш распознанных аудио, ключ - хеш содержимого + язык + движок
+STT_CACHE_TTL = DAY_SECONDS * 30
+STT_CACHE_MAX_ROWS = 100000
+# чистка старых записей раз в столько записей
+STT_CACHE_CLEAN_EVERY = 100
+STT_CACHE_STATS_LOCK = threading.Lock()
+STT_CACHE_STATS = {
+    'hits': 0,
+    'misses': 0,
+    'written': 0,
+    'evicted': 0,
+}
+
+
+# Старые диалоги в таблице users хранились блобами, теперь они только читаются
+# при переносе в таблицу dialogs, см. migrate_dialog. Первый байт блоба - номер
+# кодека, самые старые блобы это просто lzma поток, он начинается с байта 0xFD.
+# Кодеки и словарь менять нельзя, иначе не прочитаются еще не перенесенные блобы.
+PICKLE_PROTOCOL = 4
+BLOB_CODEC_LZMA = 0xFD
+BLOB_CODEC_ZLIB = 0x01
+BLOB_CODEC_ZLIB_DICT = 0x02
+
+# словарь для zlib, куски которые есть почти в каждом сохраненном диалоге
+BLOB_ZDICT = pickle.dumps([
+    {'role': 'system', 'content': ''},
+    {'role': 'user', 'content': ''},
+    {'role': 'assistant', 'content': ''},
+    {'role': 'user', 'parts': [{'text': ''}]},
+    {'role': 'model', 'parts': [{'text': ''}]},
+], protocol=PICKLE_PROTOCOL)
+
+
+def zlib_dict_decompress(data: bytes) -> bytes:
+    decompressor = zlib.decompressobj(zdict=BLOB_ZDICT)
+    return decompressor.decompress(data) + decompressor.flush()
+
+
+# {codec id: decompress}
+BLOB_CODECS = {
+    BLOB_CODEC_LZMA: lzma.decompress,
+    BLOB_CODEC_ZLIB: zlib.decompress,
+    BLOB_CODEC_ZLIB_DICT: zlib_dict_decompress,
+}
 
 
 # De-serialize and decompress an object
 def blob_to_obj(blob):
+    '''Decode old dialog blob written with any of BLOB_CODECS'''
     if blob:
         try:
-            return pickle.loads(lzma.decompress(blob))
+            codec = blob[0]
+            # у lzma свой заголовок, номер кодека отдельно не писался
+            if codec == BLOB_CODEC_LZMA:
+                return pickle.loads(lzma.decompress(blob))
+            return pickle.loads(BLOB_CODECS[codec](blob[1:]))
         except Exception as error:
             my_log.log2(f'my_db:blob_to_obj {error}')
             return None
@@ -76,24 +168,184 @@ class SmartCache:
                 del self.cache[key]
 
 
+class UsersCache:
+    '''LRU cache of whole rows from users table, {user_id: [column values]}
+    Row values are stored in the order of USERS_COLUMNS.
+    '''
+    def __init__(self, max_size = 1000):
+        self.cache = LRUCache(maxsize=max_size)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, user_id):
+        with self.lock:
+            row = self.cache.get(user_id)
+            if row is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return row
+
+    def set(self, user_id, row: list):
+        with self.lock:
+            if user_id not in self.cache and len(self.cache) >= self.cache.maxsize:
+                self.evictions += 1
+            self.cache[user_id] = row
+
+    def update(self, user_id, index: int, value):
+        '''change one value in cached row, do nothing if row is not cached'''
+        with self.lock:
+            row = self.cache.get(user_id)
+            if row is not None:
+                row[index] = value
+
+    def delete(self, user_id):
+        with self.lock:
+            if user_id in self.cache:
+                del self.cache[user_id]
+
+    def stats(self) -> dict:
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self.cache),
+                'max_size': self.cache.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / total if total else 0.0,
+            }
+
+
+class ReadPool:
+    '''Pool of read only connections to db.
+    In WAL mode readers do not wait for the writer and for each other.
+    Connections are shared between threads because handlers run in short
+    lived threads and a connection per thread would be reopened every time.
+    '''
+    def __init__(self, db_file: str, max_size: int = 16):
+        self.db_file = db_file
+        self.pool = queue.LifoQueue()
+        self.semaphore = threading.BoundedSemaphore(max_size)
+
+    def connect(self):
+        con = sqlite3.connect(f'file:{self.db_file}?mode=ro', uri=True, check_same_thread=False)
+        con.execute('PRAGMA query_only = ON')
+        return con
+
+    @contextlib.contextmanager
+    def cursor(self):
+        with self.semaphore:
+            try:
+                con = self.pool.get_nowait()
+            except queue.Empty:
+                con = self.connect()
+            try:
+                yield con.cursor()
+            finally:
+                self.pool.put(con)
+
+    def close(self):
+        while True:
+            try:
+                self.pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+
 # cache for users table
-USERS_CACHE = SmartCache()
+USERS_CACHE = UsersCache()
+# колонки users которые кешируются целой строкой (все кроме BLOB с диалогами),
+# заполняется в init, {name: index}
+USERS_COLUMNS = []
+USERS_COLUMNS_INDEX = {}
 
 
 def backup_db():
     try:
-        with open('db/main.db', 'rb') as f_in, gzip.open('db/main.db.gz', 'wb', compresslevel=1) as f_out:
+        with open(DB_FILE, 'rb') as f_in, gzip.open(f'{DB_FILE}.gz', 'wb', compresslevel=1) as f_out:
             shutil.copyfileobj(f_in, f_out)
     except Exception as error:
         my_log.log2(f'my_db:compress_backup_db {error}')
 
 
+def flush_users():
+    '''Write pending user properties to db in batches'''
+    global COM_COUNTER, USERS_FLUSH_GEN
+    with LOCK:
+        with USERS_PENDING_LOCK:
+            if not USERS_PENDING:
+                return
+            pending = {user_id: properties.copy() for user_id, properties in USERS_PENDING.items()}
+
+        try:
+            # добавляем новых юзеров которых еще нет в базе
+            ids = list(pending.keys())
+            existing = set()
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i+500]
+                CUR.execute(f'''
+                    SELECT id FROM users
+                    WHERE id IN ({','.join('?' * len(chunk))})
+                ''', chunk)
+                existing.update(x[0] for x in CUR.fetchall())
+            # delete_user_property для несуществующего юзера не должен его создавать
+            new_users = [(user_id, get_first_meet(user_id) or time.time()) for user_id in ids
+                         if user_id not in existing and any(v is not None for v in pending[user_id].values())]
+            if new_users:
+                CUR.executemany('''
+                    INSERT INTO users (id, first_meet)
+                    VALUES (?, ?)
+                ''', new_users)
+        except Exception as error:
+            my_log.log2(f'my_db:flush_users {error}')
+            return
+
+        # один UPDATE на каждую колонку со всеми юзерами сразу
+        by_property = {}
+        for user_id, properties in pending.items():
+            for property, value in properties.items():
+                by_property.setdefault(property, []).append((value, user_id))
+        for property, values in by_property.items():
+            try:
+                CUR.executemany(f'''
+                    UPDATE users
+                    SET {property} = ?
+                    WHERE id = ?
+                ''', values)
+            except Exception as error:
+                my_log.log2(f'my_db:flush_users {property} {error}')
+
+        try:
+            CON.commit()
+            COM_COUNTER = 0
+        except Exception as error:
+            my_log.log2(f'my_db:flush_users:commit {error}')
+            return
+
+        # убираем записанное, кроме того что успели поменять пока шла запись
+        with USERS_PENDING_LOCK:
+            for user_id, properties in pending.items():
+                current = USERS_PENDING.get(user_id)
+                if current is None:
+                    continue
+                for property, value in properties.items():
+                    if property in current and current[property] is value:
+                        del current[property]
+                if not current:
+                    del USERS_PENDING[user_id]
+            USERS_FLUSH_GEN += 1
+
+
 @async_run
 def sync_daemon():
     global COM_COUNTER
     while DAEMON_RUN:
         time.sleep(DAEMON_TIME)
         try:
+            flush_users()
             with LOCK:
                 if COM_COUNTER > 0:
                     CON.commit()
@@ -102,18 +354,32 @@ def sync_daemon():
             my_log.log2(f'my_db:sync_daemon {error}')
 
 
+def load_users_columns():
+    '''Read list of users table columns that go to USERS_CACHE'''
+    global USERS_COLUMNS, USERS_COLUMNS_INDEX
+    CUR.execute('PRAGMA table_info(users)')
+    columns = [x[1] for x in CUR.fetchall() if x[2].upper() != 'BLOB']
+    USERS_COLUMNS_INDEX = {name: i for i, name in enumerate(columns)}
+    USERS_COLUMNS = columns
+    USERS_CACHE.cache.clear()
+
+
 def init(backup: bool = True):
     '''init db'''
-    global CON, CUR
-    day_seconds = 60 * 60 * 24
+    global CON, CUR, READ_POOL
+    day_seconds = DAY_SECONDS
     week_seconds = day_seconds * 7
     month_seconds = day_seconds * 30
     year_seconds = day_seconds * 365
     try:
+        CON = sqlite3.connect(DB_FILE, check_same_thread=False)
+        CUR = CON.cursor()
+        CUR.execute('PRAGMA journal_mode = WAL')
+        CUR.execute('PRAGMA synchronous = NORMAL')
+        # все что осталось в WAL файле переносим в основной файл перед бекапом
+        CUR.execute('PRAGMA wal_checkpoint(TRUNCATE)')
         if backup:
             backup_db()
-        CON = sqlite3.connect('db/main.db', check_same_thread=False)
-        CUR = CON.cursor()
 
         CUR.execute('''
             CREATE TABLE IF NOT EXISTS msg_counter (
@@ -127,6 +393,48 @@ def init(backup: bool = True):
         CUR.execute('CREATE INDEX IF NOT EXISTS idx_access_time ON msg_counter (access_time)')
         CUR.execute('CREATE INDEX IF NOT EXISTS idx_user_id ON msg_counter (user_id)')
         CUR.execute('CREATE INDEX IF NOT EXISTS idx_model_used ON msg_counter (model_used)')
+        CUR.execute('CREATE INDEX IF NOT EXISTS idx_user_id_access_time ON msg_counter (user_id, access_time)')
+
+        # свернутые счетчики msg_counter, обновляются в add_msg
+        # msg_counter_daily - число сообщений юзера по модели за день
+        # msg_counter_users - всего сообщений юзера и время последнего
+        CUR.execute('''SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'msg_counter_daily' ''')
+        daily_exists = CUR.fetchone() is not None
+        CUR.execute('''
+            CREATE TABLE IF NOT EXISTS msg_counter_daily (
+                user_id TEXT,
+                model_used TEXT,
+                day INTEGER,
+                count INTEGER,
+                PRIMARY KEY (user_id, model_used, day)
+            ) WITHOUT ROWID
+        ''')
+        CUR.execute('CREATE INDEX IF NOT EXISTS idx_daily_day ON msg_counter_daily (day)')
+        if daily_exists:
+            CUR.execute('''DELETE FROM msg_counter_daily WHERE day < ?''', (int((time.time() - year_seconds) // DAY_SECONDS),))
+        else:
+            CUR.execute(f'''
+                INSERT INTO msg_counter_daily (user_id, model_used, day, count)
+                SELECT user_id, model_used, CAST(access_time / {DAY_SECONDS} AS INTEGER), COUNT(*)
+                FROM msg_counter
+                GROUP BY user_id, model_used, CAST(access_time / {DAY_SECONDS} AS INTEGER)
+            ''')
+        CUR.execute('''
+            CREATE TABLE IF NOT EXISTS msg_counter_users (
+                user_id TEXT PRIMARY KEY,
+                total INTEGER,
+                last_time REAL
+            ) WITHOUT ROWID
+        ''')
+        CUR.execute('CREATE INDEX IF NOT EXISTS idx_users_last_time ON msg_counter_users (last_time)')
+        # старые сообщения только что удалены, пересчитываем итоги
+        CUR.execute('DELETE FROM msg_counter_users')
+        CUR.execute('''
+            INSERT INTO msg_counter_users (user_id, total, last_time)
+            SELECT user_id, COUNT(*), MAX(access_time)
+            FROM msg_counter
+            GROUP BY user_id
+        ''')
 
         CUR.execute('''
             CREATE TABLE IF NOT EXISTS translations (
@@ -138,9 +446,19 @@ def init(backup: bool = True):
                 timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
             )
         ''')
-        CUR.execute('CREATE INDEX IF NOT EXISTS idx_original ON translations (original)')
+        # перевод ищется по хешу (original, lang, help) в одном коротком уникальном индексе,
+        # раньше было 3 индекса по отдельным длинным текстовым колонкам
+        CUR.execute('PRAGMA table_info(translations)')
+        if 'key' not in [x[1] for x in CUR.fetchall()]:
+            CUR.execute('ALTER TABLE translations ADD COLUMN key TEXT')
+        CON.create_function('translation_key', 3, translation_key, deterministic=True)
+        CUR.execute('UPDATE translations SET key = translation_key(original, lang, help) WHERE key IS NULL')
+        # дубли от старых версий, оставляем последний перевод
+        CUR.execute('DELETE FROM translations WHERE id NOT IN (SELECT MAX(id) FROM translations GROUP BY key)')
+        CUR.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_translations_key ON translations (key)')
+        CUR.execute('DROP INDEX IF EXISTS idx_original')
+        CUR.execute('DROP INDEX IF EXISTS idx_help')
         CUR.execute('CREATE INDEX IF NOT EXISTS idx_lang ON translations (lang)')
-        CUR.execute('CREATE INDEX IF NOT EXISTS idx_help ON translations (help)')
         CUR.execute('CREATE INDEX IF NOT EXISTS idx_translation ON translations (translation)')
         # CUR.execute('CREATE INDEX IF NOT EXISTS idx_timestamp ON translations (timestamp)')
 
@@ -193,6 +511,7 @@ def init(backup: bool = True):
             )
         ''')
         CUR.execute('CREATE INDEX IF NOT EXISTS idx_id ON users (id)')
+        load_users_columns()
         CUR.execute('CREATE INDEX IF NOT EXISTS idx_first_meet ON users (first_meet)')
         # удалить файлы старше 1 дня и диалоги старше 1 недели
         CUR.execute("""UPDATE users SET saved_file = NULL,
@@ -202,6 +521,7 @@ def init(backup: bool = True):
                     dialog_groq = NULL,
                     dialog_openrouter = NULL,
                     dialog_shadow = NULL,
+                    dialog_gpt4omini = NULL,
                     persistant_memory = NULL
                     WHERE last_time_access < ?
                     """, (time.time() - week_seconds,))
@@ -215,6 +535,32 @@ def init(backup: bool = True):
             )
         ''')
 
+        CUR.execute('''
+            CREATE TABLE IF NOT EXISTS stt_cache (
+                key TEXT PRIMARY KEY,
+                date REAL,
+                lang TEXT,
+                engine TEXT,
+                text TEXT
+            )
+        ''')
+        CUR.execute('CREATE INDEX IF NOT EXISTS idx_stt_cache_date ON stt_cache (date)')
+        CUR.execute('DELETE FROM stt_cache WHERE date < ?', (time.time() - STT_CACHE_TTL,))
+
+        # длинные расшифровки (видео по ссылкам), незаконченные продолжаются после перезапуска,
+        # готовые куски лежат в stt_cache
+        CUR.execute('''
+            CREATE TABLE IF NOT EXISTS transcribe_jobs (
+                id TEXT PRIMARY KEY,
+                date REAL,
+                url TEXT,
+                lang TEXT,
+                engines TEXT,
+                done INTEGER
+            )
+        ''')
+        CUR.execute('DELETE FROM transcribe_jobs WHERE date < ?', (time.time() - week_seconds,))
+
         CUR.execute('''
             CREATE TABLE IF NOT EXISTS im_suggests (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -224,11 +570,32 @@ def init(backup: bool = True):
             )
         ''')
 
+        # история диалогов с ботами, одна строка на сообщение,
+        # новый ход это INSERT 2 строк вместо перезаписи всего блоба
+        CUR.execute('''
+            CREATE TABLE IF NOT EXISTS dialogs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id TEXT,
+                backend TEXT,
+                role TEXT,
+                text TEXT,
+                tokens INTEGER,
+                date REAL
+            )
+        ''')
+        CUR.execute('CREATE INDEX IF NOT EXISTS idx_dialogs_chat ON dialogs (chat_id, backend, id)')
+        CUR.execute('''DELETE FROM dialogs WHERE chat_id IN (
+                    SELECT id FROM users WHERE last_time_access < ?)
+                    ''', (time.time() - week_seconds,))
+
         if backup:
             CON.commit()
             CUR.execute("VACUUM")
         CON.commit()
+        READ_POOL = ReadPool(DB_FILE)
         sync_daemon()
+        MSG_QUEUE_DONE.clear()
+        msg_counter_daemon()
     except Exception as error:
         traceback_error = traceback.format_exc()
         my_log.log2(f'my_db:init {error}\n\n{traceback_error}')
@@ -237,39 +604,177 @@ def init(backup: bool = True):
 def close():
     global DAEMON_RUN
     DAEMON_RUN = False
+    MSG_QUEUE.put(None)
+    MSG_QUEUE_DONE.wait(timeout=30)
     time.sleep(DAEMON_TIME + 2)
+    flush_users()
     with LOCK:
         try:
             CON.commit()
+            CUR.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            READ_POOL.close()
             # CON.close()
         except Exception as error:
             my_log.log2(f'my_db:close {error}')
 
 
-@async_run
 def add_msg(user_id: str, model_used: str, timestamp: float = None):
-    '''add msg counter record to db'''
+    '''add msg counter record to db (queued, written by msg_counter_daemon)'''
+    item = (user_id, timestamp if timestamp else time.time(), model_used)
+    try:
+        MSG_QUEUE.put_nowait(item)
+    except queue.Full:
+        with MSG_QUEUE_STATS_LOCK:
+            MSG_QUEUE_STATS['full'] += 1
+        try:
+            MSG_QUEUE.put(item, timeout=5)
+        except queue.Full:
+            with MSG_QUEUE_STATS_LOCK:
+                MSG_QUEUE_STATS['dropped'] += 1
+            my_log.log2(f'my_db:add_msg queue is full, dropped {item}')
+            return
+    depth = MSG_QUEUE.qsize()
+    with MSG_QUEUE_STATS_LOCK:
+        MSG_QUEUE_STATS['queued'] += 1
+        if depth > MSG_QUEUE_STATS['max_depth']:
+            MSG_QUEUE_STATS['max_depth'] = depth
+
+
+def write_msgs(batch: list):
+    '''Write msg counter records and their rollups to db in one transaction,
+    if any write fails nothing is written
+    batch - list of tuples (user_id, access_time, model_used)
+    '''
     global COM_COUNTER
     with LOCK:
         try:
-            access_time = timestamp if timestamp else time.time()
-            
-            # Проверка наличия записи
+            rows = list(dict.fromkeys(batch))
+            # записи которые уже есть в базе, один запрос на всю пачку
             CUR.execute('''
-                SELECT COUNT(*) FROM msg_counter
-                WHERE user_id = ? AND access_time = ? AND model_used = ?
-            ''', (user_id, access_time, model_used))
-            
-            if CUR.fetchone()[0] == 0:
-                # Если записи нет, добавляем новую
-                CUR.execute('''
+                SELECT user_id, access_time, model_used FROM msg_counter
+                WHERE access_time BETWEEN ? AND ?
+            ''', (min(row[1] for row in rows), max(row[1] for row in rows)))
+            stored = set(CUR.fetchall())
+            new_rows = [row for row in rows if row not in stored]
+            if not new_rows:
+                return
+
+            daily = {}
+            users = {}
+            for user_id, access_time, model_used in new_rows:
+                key = (user_id, model_used, int(access_time // DAY_SECONDS))
+                daily[key] = daily.get(key, 0) + 1
+                total, last_time = users.get(user_id, (0, access_time))
+                users[user_id] = (total + 1, max(last_time, access_time))
+
+            # соединение общее и коммитится пачками в sync_daemon, поэтому откатываем
+            # только свои записи, до точки сохранения
+            CUR.execute('SAVEPOINT write_msgs')
+            try:
+                CUR.executemany('''
                     INSERT INTO msg_counter (user_id, access_time, model_used)
                     VALUES (?, ?, ?)
-                ''', (user_id, access_time, model_used))
-                COM_COUNTER += 1
+                ''', new_rows)
+                CUR.executemany('''
+                    INSERT INTO msg_counter_daily (user_id, model_used, day, count)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT (user_id, model_used, day) DO UPDATE SET count = count + excluded.count
+                ''', [key + (count,) for key, count in daily.items()])
+                CUR.executemany('''
+                    INSERT INTO msg_counter_users (user_id, total, last_time)
+                    VALUES (?, ?, ?)
+                    ON CONFLICT (user_id) DO UPDATE SET total = total + excluded.total,
+                    last_time = MAX(last_time, excluded.last_time)
+                ''', [(user_id, total, last_time) for user_id, (total, last_time) in users.items()])
+            except Exception:
+                CUR.execute('ROLLBACK TO write_msgs')
+                raise
+            finally:
+                CUR.execute('RELEASE write_msgs')
+            COM_COUNTER += len(new_rows)
+        except Exception as error:
+            my_log.log2(f'my_db:write_msgs {error}')
+
 
+def expire_msgs():
+    '''Remove msg counter records older than MSG_KEEP_DAYS days and subtract
+    them from users totals, in one transaction so that msg_counter_users
+    always matches msg_counter_daily'''
+    global COM_COUNTER
+    day = int(time.time() // DAY_SECONDS) - MSG_KEEP_DAYS
+    with LOCK:
+        try:
+            CUR.execute('SAVEPOINT expire_msgs')
+            try:
+                CUR.execute('''
+                    SELECT user_id, SUM(count) FROM msg_counter_daily
+                    WHERE day < ?
+                    GROUP BY user_id
+                ''', (day,))
+                expired = CUR.fetchall()
+                if expired:
+                    CUR.executemany('''
+                        UPDATE msg_counter_users SET total = total - ?
+                        WHERE user_id = ?
+                    ''', [(count, user_id) for user_id, count in expired])
+                    CUR.execute('DELETE FROM msg_counter_users WHERE total <= 0')
+                    CUR.execute('DELETE FROM msg_counter_daily WHERE day < ?', (day,))
+                    CUR.execute('DELETE FROM msg_counter WHERE access_time < ?', (day * DAY_SECONDS,))
+                    COM_COUNTER += len(expired)
+            except Exception:
+                CUR.execute('ROLLBACK TO expire_msgs')
+                raise
+            finally:
+                CUR.execute('RELEASE expire_msgs')
         except Exception as error:
-            my_log.log2(f'my_db:add {error}')
+            my_log.log2(f'my_db:expire_msgs {error}')
+
+
+@async_run
+def msg_counter_daemon():
+    '''Write records from MSG_QUEUE to db in batches and expire old ones,
+    stops on None in queue'''
+    running = True
+    expire_time = time.time() + MSG_EXPIRE_TIME
+    while running:
+        if time.time() >= expire_time:
+            expire_msgs()
+            expire_time = time.time() + MSG_EXPIRE_TIME
+        try:
+            item = MSG_QUEUE.get(timeout=max(expire_time - time.time(), 0))
+        except queue.Empty:
+            continue
+        if item is None:
+            break
+        batch = [item]
+        deadline = time.time() + MSG_BATCH_TIME
+        while len(batch) < MSG_BATCH_SIZE:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                item = MSG_QUEUE.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                running = False
+                break
+            batch.append(item)
+        write_msgs(batch)
+        with MSG_QUEUE_STATS_LOCK:
+            MSG_QUEUE_STATS['written'] += len(batch)
+            MSG_QUEUE_STATS['batches'] += 1
+            if len(batch) > MSG_QUEUE_STATS['max_batch']:
+                MSG_QUEUE_STATS['max_batch'] = len(batch)
+    MSG_QUEUE_DONE.set()
+
+
+def get_msg_queue_stats() -> dict:
+    '''Get counters of add_msg queue'''
+    with MSG_QUEUE_STATS_LOCK:
+        stats = MSG_QUEUE_STATS.copy()
+    stats['depth'] = MSG_QUEUE.qsize()
+    return stats
 
 
 def count_msgs(user_id: str, model: str, access_time: float):
@@ -278,21 +783,45 @@ def count_msgs(user_id: str, model: str, access_time: float):
     access_time - seconds before now (60*60*24*30 - 30 days)
 
     print(count_msgs('user1', 'all', 60*60*24*30)) - print all messages sent by user1 in the last 30 days
+
+    Whole days are taken from msg_counter_daily, only the first (partial)
+    day of the period is counted in msg_counter.
     '''
-    access_time = time.time() - access_time
-    with LOCK:
+    with READ_POOL.cursor() as cur:
         try:
+            # в базе хранится только последний год, весь год это просто итог по юзеру
+            if model == 'all' and access_time >= MSG_KEEP_DAYS * DAY_SECONDS:
+                cur.execute('''
+                    SELECT total FROM msg_counter_users
+                    WHERE user_id = ?
+                ''', (user_id,))
+                result = cur.fetchone()
+                return result[0] if result else 0
+
+            access_time = time.time() - access_time
+            day = int(access_time // DAY_SECONDS)
+            next_day_time = (day + 1) * DAY_SECONDS
             if model == 'all':
-                CUR.execute('''
+                cur.execute('''
                     SELECT COUNT(*) FROM msg_counter
-                    WHERE user_id = ? AND access_time > ?
-                ''', (user_id, access_time))
+                    WHERE user_id = ? AND access_time > ? AND access_time < ?
+                ''', (user_id, access_time, next_day_time))
+                partial = cur.fetchone()[0]
+                cur.execute('''
+                    SELECT SUM(count) FROM msg_counter_daily
+                    WHERE user_id = ? AND day > ?
+                ''', (user_id, day))
             else:
-                CUR.execute('''
+                cur.execute('''
                     SELECT COUNT(*) FROM msg_counter
-                    WHERE user_id = ? AND model_used = ? AND access_time > ?
-                ''', (user_id, model, access_time))
-            return CUR.fetchone()[0]
+                    WHERE user_id = ? AND access_time > ? AND access_time < ? AND model_used = ?
+                ''', (user_id, access_time, next_day_time, model))
+                partial = cur.fetchone()[0]
+                cur.execute('''
+                    SELECT SUM(count) FROM msg_counter_daily
+                    WHERE user_id = ? AND model_used = ? AND day > ?
+                ''', (user_id, model, day))
+            return partial + (cur.fetchone()[0] or 0)
         except Exception as error:
             my_log.log2(f'my_db:count {error}')
             return 0
@@ -300,12 +829,12 @@ def count_msgs(user_id: str, model: str, access_time: float):
 
 def count_msgs_all():
     '''count all messages'''
-    with LOCK:
+    with READ_POOL.cursor() as cur:
         try:
-            CUR.execute('''
-                SELECT COUNT(*) FROM msg_counter
+            cur.execute('''
+                SELECT SUM(total) FROM msg_counter_users
             ''')
-            return CUR.fetchone()[0]
+            return cur.fetchone()[0] or 0
         except Exception as error:
             my_log.log2(f'my_db:count_all {error}')
             return 0
@@ -313,19 +842,27 @@ def count_msgs_all():
 
 def get_model_usage(days: int):
     access_time = time.time() - days * 24 * 60 * 60
-    with LOCK:
+    day = int(access_time // DAY_SECONDS)
+    with READ_POOL.cursor() as cur:
         try:
-            CUR.execute('''
+            model_usage = {}
+            # неполный первый день из msg_counter, остальные дни из msg_counter_daily
+            cur.execute('''
                 SELECT model_used, COUNT(*) FROM msg_counter
-                WHERE access_time > ?
+                WHERE access_time > ? AND access_time < ?
                 GROUP BY model_used
-            ''', (access_time,))
-            results = CUR.fetchall()
-            model_usage = {}
+            ''', (access_time, (day + 1) * DAY_SECONDS))
+            results = cur.fetchall()
+            cur.execute('''
+                SELECT model_used, SUM(count) FROM msg_counter_daily
+                WHERE day > ?
+                GROUP BY model_used
+            ''', (day,))
+            results += cur.fetchall()
             for row in results:
                 model = row[0]
                 usage_count = row[1]
-                model_usage[model] = usage_count
+                model_usage[model] = model_usage.get(model, 0) + usage_count
             return model_usage
         except Exception as error:
             my_log.log2(f'my_db:get_model_usage {error}')
@@ -333,12 +870,12 @@ def get_model_usage(days: int):
 
 
 def get_total_msg_users() -> int:
-    with LOCK:
+    with READ_POOL.cursor() as cur:
         try:
-            CUR.execute('''
-                SELECT COUNT(DISTINCT user_id) FROM msg_counter
+            cur.execute('''
+                SELECT COUNT(*) FROM msg_counter_users
             ''')
-            return CUR.fetchone()[0]
+            return cur.fetchone()[0]
         except Exception as error:
             my_log.log2(f'my_db:get_total_msg_users {error}')
             return 0
@@ -346,13 +883,13 @@ def get_total_msg_users() -> int:
 
 def get_total_msg_users_in_days(days: int) -> int:
     access_time = time.time() - days * 24 * 60 * 60
-    with LOCK:
+    with READ_POOL.cursor() as cur:
         try:
-            CUR.execute('''
-                SELECT COUNT(DISTINCT user_id) FROM msg_counter
-                WHERE access_time > ?
+            cur.execute('''
+                SELECT COUNT(*) FROM msg_counter_users
+                WHERE last_time > ?
             ''', (access_time,))
-            return CUR.fetchone()[0]
+            return cur.fetchone()[0]
         except Exception as error:
             my_log.log2(f'my_db:get_total_msg_users_in_days {error}')
             return 0
@@ -361,101 +898,151 @@ def get_total_msg_users_in_days(days: int) -> int:
 def count_new_user_in_days(days: int) -> int:
     '''Посчитать сколько юзеров впервые написали боту раньше чем за days дней'''
     access_time = time.time() - days * 24 * 60 * 60
-    with LOCK:
+    flush_users()
+    with READ_POOL.cursor() as cur:
         try:
-            CUR.execute('''
+            cur.execute('''
                 SELECT COUNT(DISTINCT T1.user_id)
-                FROM msg_counter AS T1
+                FROM msg_counter_users AS T1
                 INNER JOIN users AS T2 ON T1.user_id = T2.id
                 WHERE T2.first_meet > ?
             ''', (access_time,))
-            return CUR.fetchone()[0]
+            return cur.fetchone()[0]
         except Exception as error:
             my_log.log2(f'my_db:count_new_user_in_days {error}')
             return 0
 
 
+def get_top_langs(limit: int = 10) -> list:
+    '''Most popular languages of users, most used first'''
+    with READ_POOL.cursor() as cur:
+        try:
+            cur.execute('''
+                SELECT lang FROM users
+                WHERE lang IS NOT NULL AND lang != ''
+                GROUP BY lang
+                ORDER BY COUNT(*) DESC
+                LIMIT ?
+            ''', (limit,))
+            return [x[0] for x in cur.fetchall()]
+        except Exception as error:
+            my_log.log2(f'my_db:get_top_langs {error}')
+            return []
+
+
+def translation_key(text: str, lang: str, help: str) -> str:
+    '''Hash of (text, lang, help), key of translations table and of memory caches'''
+    return hashlib.md5(f'{lang}\0{help or ""}\0{text}'.encode('utf-8', errors='ignore')).hexdigest()
+
+
 def get_translation(text: str, lang: str, help: str) -> str:
     '''Get translation from cache if any'''
-    with LOCK:
+    with READ_POOL.cursor() as cur:
         try:
-            CUR.execute('''
+            cur.execute('''
                 SELECT translation FROM translations
-                WHERE original = ? AND lang = ? AND help = ?
-            ''', (text, lang, help))
-            result = CUR.fetchone()
+                WHERE key = ?
+            ''', (translation_key(text, lang, help),))
+            result = cur.fetchone()
             return result[0] if result else ''
         except Exception as error:
             my_log.log2(f'my_db:get_translation {error}')
             return ''
 
 
+def get_translations(langs: list) -> list:
+    '''All translations to the languages, list of (original, lang, help, translation)'''
+    if not langs:
+        return []
+    with READ_POOL.cursor() as cur:
+        try:
+            cur.execute(f'''
+                SELECT original, lang, help, translation FROM translations
+                WHERE lang IN ({','.join('?' * len(langs))})
+            ''', list(langs))
+            return cur.fetchall()
+        except Exception as error:
+            my_log.log2(f'my_db:get_translations {error}')
+            return []
+
+
 def update_translation(text: str, lang: str, help: str, translation: str):
     '''Update or insert translation in cache'''
     global COM_COUNTER
     with LOCK:
         try:
             CUR.execute('''
-                SELECT 1 FROM translations
-                WHERE original = ? AND lang = ? AND help = ?
-            ''', (text, lang, help))
-            if CUR.fetchone():
-                CUR.execute('''
-                    UPDATE translations
-                    SET translation = ?
-                    WHERE original = ? AND lang = ? AND help = ?
-                ''', (translation, text, lang, help))
-            else:
-                CUR.execute('''
-                    INSERT INTO translations (original, lang, help, translation)
-                    VALUES (?, ?, ?, ?)
-                ''', (text, lang, help, translation))
+                INSERT INTO translations (key, original, lang, help, translation)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET translation = excluded.translation
+            ''', (translation_key(text, lang, help), text, lang, help, translation))
             COM_COUNTER += 1
         except Exception as error:
             my_log.log2(f'my_db:update_translation {error}')
 
 
 def update_translations(values: list):
-    '''Update many translations in cache
+    '''Update or insert many translations in cache
     values - list of tuples (text, lang, help, translation)
     '''
     global COM_COUNTER
-    drop_all_translations()
     with LOCK:
         try:
             # Выполняем один запрос для вставки данных
             CUR.executemany('''
-                INSERT INTO translations (original, lang, help, translation)
-                VALUES (?, ?, ?, ?)
-            ''', values)
+                INSERT OR REPLACE INTO translations (key, original, lang, help, translation)
+                VALUES (?, ?, ?, ?, ?)
+            ''', [(translation_key(text, lang, help), text, lang, help, translation)
+                  for text, lang, help, translation in values])
             COM_COUNTER += len(values)
         except Exception as error:
             my_log.log2(f'my_db:update_translations {error}')
 
 
+def get_ui_strings(lang: str, min_langs: int = 3) -> list:
+    '''Texts that are translated to at least min_langs languages but not to lang,
+    list of (original, help)'''
+    with READ_POOL.cursor() as cur:
+        try:
+            cur.execute('''
+                SELECT original, help FROM translations
+                GROUP BY original, help
+                HAVING COUNT(DISTINCT lang) >= ? AND SUM(lang = ?) = 0
+            ''', (min_langs, lang))
+            return cur.fetchall()
+        except Exception as error:
+            my_log.log2(f'my_db:get_ui_strings {error}')
+            return []
+
+
 def get_translations_like(text: str) -> list:
     '''Get translations from cache that are similar to the given text'''
-    with LOCK:
+    with READ_POOL.cursor() as cur:
         try:
-            CUR.execute('''
+            cur.execute('''
                 SELECT original, lang, help, translation FROM translations
                 WHERE translation LIKE ?
             ''', (f'%{text}%',))
-            results = CUR.fetchall()
+            results = cur.fetchall()
             return results or []
         except Exception as error:
             my_log.log2(f'my_db:get_translations_like {error}')
             return []
 
 
-def get_translations_count() -> int:
-    '''Get count of translations'''
-    with LOCK:
+def get_translations_count(lang: str = '') -> int:
+    '''Get count of translations, all or to the language'''
+    with READ_POOL.cursor() as cur:
         try:
-            CUR.execute('''
-                SELECT COUNT(*) FROM translations
-            ''')
-            result = CUR.fetchone()
+            if lang:
+                cur.execute('''
+                    SELECT COUNT(*) FROM translations WHERE lang = ?
+                ''', (lang,))
+            else:
+                cur.execute('''
+                    SELECT COUNT(*) FROM translations
+                ''')
+            result = cur.fetchone()
             return result[0] if result else 0
         except Exception as error:
             my_log.log2(f'my_db:get_translations_count {error}')
@@ -520,36 +1107,67 @@ def get_user_property(user_id: str, property: str):
     '''Get a value of property in user table
     Return None if user not found
     '''
-    cache_key = hashlib.md5(f"{user_id}_{property}".encode()).hexdigest()
-    if cache_key in USERS_CACHE.cache:
-        return USERS_CACHE.get(cache_key)
-    else:
-        with LOCK:
-            try:
-                CUR.execute(f'''
+    # значение которое еще не записано в базу самое свежее
+    with USERS_PENDING_LOCK:
+        if user_id in USERS_PENDING and property in USERS_PENDING[user_id]:
+            return USERS_PENDING[user_id][property]
+        flush_gen = USERS_FLUSH_GEN
+
+    index = USERS_COLUMNS_INDEX.get(property)
+    if index is not None:
+        row = USERS_CACHE.get(user_id)
+        if row is not None:
+            return row[index]
+
+    with READ_POOL.cursor() as cur:
+        try:
+            if index is None:
+                # диалоги и колонки которых нет в USERS_COLUMNS читаются по одной без кеша
+                cur.execute(f'''
                     SELECT {property} FROM users
                     WHERE id = ?
                 ''', (user_id,))
-                result = CUR.fetchone()
-                if result:
-                    USERS_CACHE.set(cache_key, result[0])
-                    return result[0]
-                else:
-                    return None
-            except Exception as error:
-                my_log.log2(f'my_db:get_user_property {error}')
+                result = cur.fetchone()
+                return result[0] if result else None
+
+            cur.execute(f'''
+                SELECT {', '.join(USERS_COLUMNS)} FROM users
+                WHERE id = ?
+            ''', (user_id,))
+            result = cur.fetchone()
+            if not result:
                 return None
+            row = list(result)
+            # то что записали пока шел запрос
+            with USERS_PENDING_LOCK:
+                for name, value in USERS_PENDING.get(user_id, {}).items():
+                    if name in USERS_COLUMNS_INDEX:
+                        row[USERS_COLUMNS_INDEX[name]] = value
+                # если во время запроса прошла выгрузка USERS_PENDING то строка
+                # могла быть прочитана без нее, такую не кешируем
+                if flush_gen == USERS_FLUSH_GEN:
+                    USERS_CACHE.set(user_id, row)
+            return row[index]
+        except Exception as error:
+            my_log.log2(f'my_db:get_user_property {error}')
+            return None
+
+
+def get_users_cache_stats() -> dict:
+    '''Get hit/miss/eviction counters of users cache'''
+    return USERS_CACHE.stats()
 
 
 def get_user_all_bad_ids():
     '''get users ids if blocked = True'''
-    with LOCK:
+    flush_users()
+    with READ_POOL.cursor() as cur:
         try:
-            CUR.execute('''
+            cur.execute('''
                 SELECT id FROM users
                 WHERE blocked = 1
             ''')
-            result = CUR.fetchall()
+            result = cur.fetchall()
             return [x[0] for x in result]
         except Exception as error:
             my_log.log2(f'my_db:get_user_all_bad_ids {error}')
@@ -558,13 +1176,14 @@ def get_user_all_bad_ids():
 
 def get_user_all_bad_bing_ids():
     '''get users ids if blocked_bing = True'''
-    with LOCK:
+    flush_users()
+    with READ_POOL.cursor() as cur:
         try:
-            CUR.execute('''
+            cur.execute('''
                 SELECT id FROM users
                 WHERE blocked_bing = 1
             ''')
-            result = CUR.fetchall()
+            result = cur.fetchall()
             return [x[0] for x in result]
         except Exception as error:
             my_log.log2(f'my_db:get_user_all_bad_bing_ids {error}')
@@ -573,13 +1192,14 @@ def get_user_all_bad_bing_ids():
 
 def get_user_all_bad_totally_ids():
     '''get users ids if blocked_totally = True'''
-    with LOCK:
+    flush_users()
+    with READ_POOL.cursor() as cur:
         try:
-            CUR.execute('''
+            cur.execute('''
                 SELECT id FROM users
                 WHERE blocked_totally = 1
             ''')
-            result = CUR.fetchall()
+            result = cur.fetchall()
             return [x[0] for x in result]
         except Exception as error:
             my_log.log2(f'my_db:get_user_all_bad_totally_ids {error}')
@@ -588,76 +1208,174 @@ def get_user_all_bad_totally_ids():
 
 def delete_user_property(user_id: str, property: str):
     '''Delete user`s property value'''
-    global COM_COUNTER
-    cache_key = hashlib.md5(f"{user_id}_{property}".encode()).hexdigest()
-    if cache_key in USERS_CACHE.cache:
-        USERS_CACHE.delete(cache_key)
+    set_user_property(user_id, property, None)
+
+
+def set_user_property(user_id: str, property: str, value):
+    '''Set user`s property
+    Value is written to db later by sync_daemon (see flush_users)
+    '''
+    with USERS_PENDING_LOCK:
+        if user_id not in USERS_PENDING:
+            USERS_PENDING[user_id] = {}
+        USERS_PENDING[user_id][property] = value
+        if property in USERS_COLUMNS_INDEX:
+            USERS_CACHE.update(user_id, USERS_COLUMNS_INDEX[property], value)
+
+
+def estimate_tokens(text: str) -> int:
+    '''Rough token count for dialog message.
+    Считаем по байтам utf-8 а не по символам, английский текст это ~4 символа на токен,
+    а кириллица и прочее занимают 2-3 байта на символ и токенов в них больше.
+    '''
+    return len(text.encode('utf-8', errors='ignore')) // 4 + 1
+
+
+def mem_to_messages(mem) -> list:
+    '''Convert old dialog object (list of dicts or gemini Content) to list of (role, text)'''
+    messages = []
+    for x in mem or []:
+        try:
+            if isinstance(x, dict):
+                role = x['role']
+                text = x['content'] if 'content' in x else x['parts'][0]['text']
+            else:
+                role = x.role
+                text = x.parts[0].text
+        except Exception as error:
+            my_log.log2(f'my_db:mem_to_messages {error}')
+            continue
+        if text:
+            messages.append((role, text))
+    return messages
+
+
+def migrate_dialog(chat_id: str, backend: str) -> bool:
+    '''Move dialog from old users.dialog_* blob to dialogs table'''
+    column = DIALOG_COLUMNS.get(backend)
+    if not column:
+        return False
+    blob = get_user_property(chat_id, column)
+    if not blob:
+        return False
+    messages = mem_to_messages(blob_to_obj(blob))
+    set_user_property(chat_id, column, None)
+    if messages:
+        add_dialog(chat_id, backend, messages)
+        return True
+    return False
+
+
+def add_dialog(chat_id: str, backend: str, messages: list):
+    '''Append messages to chat history
+    messages - list of tuples (role, text)
+    '''
+    now = time.time()
+    rows = [(chat_id, backend, role, text, estimate_tokens(text), now) for role, text in messages]
     with LOCK:
         try:
-            # Проверяем, существует ли пользователь
+            CUR.executemany('''
+                INSERT INTO dialogs (chat_id, backend, role, text, tokens, date)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', rows)
+            # старое удаляем, в памяти бота столько все равно не бывает
             CUR.execute('''
-                SELECT 1 FROM users
-                WHERE id = ?
-            ''', (user_id,))
-            if CUR.fetchone():
-                # Проверяем, есть ли у property
-                CUR.execute(f'''
-                    SELECT 1 FROM users
-                    WHERE id = ? AND {property} IS NOT NULL
-                ''', (user_id,))
-                if CUR.fetchone():
-                    # Удаляем
-                    CUR.execute(f'''
-                        UPDATE users
-                        SET {property} = NULL
-                        WHERE id = ?
-                    ''', (user_id,))
-                    COM_COUNTER += 1
-            else:
-                my_log.log2(f'my_db:delete_property - User {user_id} not found')
+                DELETE FROM dialogs
+                WHERE chat_id = ? AND backend = ? AND id < (
+                    SELECT id FROM dialogs
+                    WHERE chat_id = ? AND backend = ?
+                    ORDER BY id DESC
+                    LIMIT 1 OFFSET ?)
+            ''', (chat_id, backend, chat_id, backend, DIALOG_MAX_ROWS - 1))
+            # читают через READ_POOL, следующий ход должен увидеть эти строки
+            CON.commit()
         except Exception as error:
-            my_log.log2(f'my_db:delete_property {error}')
+            my_log.log2(f'my_db:add_dialog {error}')
 
 
-def set_user_property(user_id: str, property: str, value):
-    '''Set user`s property'''
-    global COM_COUNTER
-    cache_key = hashlib.md5(f"{user_id}_{property}".encode()).hexdigest()
-    USERS_CACHE.set(cache_key, value)
+def get_dialog(chat_id: str, backend: str, max_lines: int = 0, max_bytes: int = 0,
+               max_tokens: int = 0, with_tokens: bool = False) -> list:
+    '''Get last messages of chat history as list of (role, text)
+    max_lines - not more than max_lines messages
+    max_bytes - not more than max_bytes of text
+    max_tokens - not more than max_tokens (see estimate_tokens)
+    with_tokens - return (role, text, tokens)
+    History always starts with a user message.
+    '''
+    with READ_POOL.cursor() as cur:
+        try:
+            cur.execute('''
+                SELECT role, text, tokens FROM (
+                    SELECT id, role, text, tokens,
+                    SUM(LENGTH(CAST(text AS BLOB))) OVER (ORDER BY id DESC) AS total_bytes,
+                    SUM(tokens) OVER (ORDER BY id DESC) AS total_tokens
+                    FROM dialogs
+                    WHERE chat_id = ? AND backend = ?
+                    ORDER BY id DESC
+                    LIMIT ?
+                )
+                WHERE (? = 0 OR total_bytes <= ?) AND (? = 0 OR total_tokens <= ?)
+                ORDER BY id
+            ''', (chat_id, backend, max_lines or DIALOG_MAX_ROWS,
+                  max_bytes, max_bytes, max_tokens, max_tokens))
+            messages = cur.fetchall()
+        except Exception as error:
+            my_log.log2(f'my_db:get_dialog {error}')
+            return []
+
+    if not messages and migrate_dialog(chat_id, backend):
+        return get_dialog(chat_id, backend, max_lines, max_bytes, max_tokens, with_tokens)
+
+    if not with_tokens:
+        messages = [(role, text) for role, text, _ in messages]
+
+    while messages and messages[0][0] != 'user':
+        messages = messages[1:]
+    return messages
+
+
+def undo_dialog(chat_id: str, backend: str, n: int = 2):
+    '''Remove last n messages from chat history'''
     with LOCK:
         try:
-            # Проверяем, есть ли пользователь в базе
             CUR.execute('''
-                SELECT 1 FROM users
-                WHERE id = ?
-            ''', (user_id,))
-            if CUR.fetchone():
-                # Обновляем если пользователь уже существует
-                CUR.execute(f'''
-                    UPDATE users
-                    SET {property} = ?
-                    WHERE id = ?
-                ''', (value, user_id))
-            else:
-                # Добавляем нового пользователя, если его нет
-                first_meet = get_first_meet(user_id) or time.time()
-                CUR.execute(f'''
-                    INSERT INTO users (id, {property}, first_meet)
-                    VALUES (?, ?, ?)
-                ''', (user_id, value, first_meet))
-            COM_COUNTER += 1
+                DELETE FROM dialogs
+                WHERE id IN (
+                    SELECT id FROM dialogs
+                    WHERE chat_id = ? AND backend = ?
+                    ORDER BY id DESC
+                    LIMIT ?)
+            ''', (chat_id, backend, n))
+            CON.commit()
         except Exception as error:
-            my_log.log2(f'my_db:set_user_property {error}')
+            my_log.log2(f'my_db:undo_dialog {error}')
 
 
-def get_all_users_ids():
-    '''Get all users ids'''
+def reset_dialog(chat_id: str, backend: str):
+    '''Remove chat history'''
+    column = DIALOG_COLUMNS.get(backend)
+    if column:
+        set_user_property(chat_id, column, None)
     with LOCK:
         try:
             CUR.execute('''
+                DELETE FROM dialogs
+                WHERE chat_id = ? AND backend = ?
+            ''', (chat_id, backend))
+            CON.commit()
+        except Exception as error:
+            my_log.log2(f'my_db:reset_dialog {error}')
+
+
+def get_all_users_ids():
+    '''Get all users ids'''
+    flush_users()
+    with READ_POOL.cursor() as cur:
+        try:
+            cur.execute('''
                 SELECT id FROM users
             ''')
-            results = CUR.fetchall()
+            results = cur.fetchall()
             return [result[0] for result in results]
         except Exception as error:
             my_log.log2(f'my_db:get_all_users_ids {error}')
@@ -700,13 +1418,13 @@ def set_sum_cache(url, text):
 
 def get_from_sum(url: str) -> str:
     '''Get from sum'''
-    with LOCK:
+    with READ_POOL.cursor() as cur:
         try:
-            CUR.execute('''
+            cur.execute('''
                 SELECT text FROM sum
                 WHERE url = ?
             ''', (url,))
-            result = CUR.fetchone()
+            result = cur.fetchone()
             if result is None:
                 return ''
             return result[0]
@@ -727,6 +1445,104 @@ def delete_from_sum(url_id: str):
             my_log.log2(f'my_db:remove_from_sum {error}')
 
 
+def stt_cache_key(data: bytes, lang: str, engine: str) -> str:
+    '''Key of stt_cache table, hash of audio data + language + engine'''
+    return f'{hashlib.sha256(data).hexdigest()}:{lang}:{engine}'
+
+
+def get_stt_cache(key: str) -> str:
+    '''Get recognized text of audio from cache, '' if not found or expired'''
+    text = ''
+    with READ_POOL.cursor() as cur:
+        try:
+            cur.execute('''
+                SELECT text FROM stt_cache
+                WHERE key = ? AND date > ?
+            ''', (key, time.time() - STT_CACHE_TTL))
+            result = cur.fetchone()
+            text = result[0] if result else ''
+        except Exception as error:
+            my_log.log2(f'my_db:get_stt_cache {error}')
+    with STT_CACHE_STATS_LOCK:
+        STT_CACHE_STATS['hits' if text else 'misses'] += 1
+    return text
+
+
+def set_stt_cache(key: str, lang: str, engine: str, text: str):
+    '''Save recognized text of audio, old and extra records are removed from time to time'''
+    global COM_COUNTER
+    with LOCK:
+        try:
+            CUR.execute('''
+                INSERT OR REPLACE INTO stt_cache (key, date, lang, engine, text)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (key, time.time(), lang, engine, text))
+            with STT_CACHE_STATS_LOCK:
+                STT_CACHE_STATS['written'] += 1
+                clean = STT_CACHE_STATS['written'] % STT_CACHE_CLEAN_EVERY == 0
+            if clean:
+                CUR.execute('DELETE FROM stt_cache WHERE date < ?', (time.time() - STT_CACHE_TTL,))
+                evicted = CUR.rowcount
+                CUR.execute('''
+                    DELETE FROM stt_cache WHERE date <= (
+                        SELECT date FROM stt_cache ORDER BY date DESC LIMIT 1 OFFSET ?)
+                ''', (STT_CACHE_MAX_ROWS,))
+                evicted += CUR.rowcount
+                with STT_CACHE_STATS_LOCK:
+                    STT_CACHE_STATS['evicted'] += evicted
+            COM_COUNTER += 1
+        except Exception as error:
+            my_log.log2(f'my_db:set_stt_cache {error}')
+
+
+def get_stt_cache_stats() -> dict:
+    '''Get counters of stt cache'''
+    with STT_CACHE_STATS_LOCK:
+        stats = STT_CACHE_STATS.copy()
+    total = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / total if total else 0.0
+    return stats
+
+
+def add_transcribe_job(job_id: str, url: str, lang: str, engines: str):
+    '''Remember started transcription job, it is resumed after restart if not done'''
+    global COM_COUNTER
+    with LOCK:
+        try:
+            CUR.execute('''
+                INSERT OR REPLACE INTO transcribe_jobs (id, date, url, lang, engines, done)
+                VALUES (?, ?, ?, ?, ?, 0)
+            ''', (job_id, time.time(), url, lang, engines))
+            COM_COUNTER += 1
+        except Exception as error:
+            my_log.log2(f'my_db:add_transcribe_job {error}')
+
+
+def finish_transcribe_job(job_id: str):
+    global COM_COUNTER
+    with LOCK:
+        try:
+            CUR.execute('UPDATE transcribe_jobs SET done = 1 WHERE id = ?', (job_id,))
+            COM_COUNTER += 1
+        except Exception as error:
+            my_log.log2(f'my_db:finish_transcribe_job {error}')
+
+
+def get_unfinished_transcribe_jobs(max_age: float) -> list:
+    '''Not done transcription jobs not older than max_age seconds, list of (id, url, lang, engines)'''
+    with READ_POOL.cursor() as cur:
+        try:
+            cur.execute('''
+                SELECT id, url, lang, engines FROM transcribe_jobs
+                WHERE done = 0 AND date > ?
+                ORDER BY date
+            ''', (time.time() - max_age,))
+            return cur.fetchall()
+        except Exception as error:
+            my_log.log2(f'my_db:get_unfinished_transcribe_jobs {error}')
+            return []
+
+
 def set_im_suggests(hash, prompt):
     '''Set im_suggests'''
     global COM_COUNTER
@@ -763,13 +1579,13 @@ def set_im_suggests(hash, prompt):
 
 def get_from_im_suggests(hash: str) -> str:
     '''Get from im_suggests'''
-    with LOCK:
+    with READ_POOL.cursor() as cur:
         try:
-            CUR.execute('''
+            cur.execute('''
                 SELECT prompt FROM im_suggests
                 WHERE hash = ?
             ''', (hash,))
-            result = CUR.fetchone()
+            result = cur.fetchone()
             if result is None:
                 return ''
             return result[0]
@@ -794,12 +1610,6 @@ if __name__ == '__main__':
     pass
     init(backup=False)
 
-    # a='xg'*100000
-    # b = obj_to_blob(a)
-    # print(len(b))
-    # print(blob_to_obj(b))
-    
-
     # set_sum_cache('test', 'test123')
     # print(get_from_sum('test'))
     # delete_from_sum('test')
@@ -5,7 +5,6 @@
 import io
 import random
 import time
-import threading
 import traceback
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from PIL import Image
@@ -14,6 +13,7 @@ import langcodes
 from duckduckgo_search import DDGS
 
 import cfg
+import my_chatmem
 import my_db
 import my_gemini
 import my_log
@@ -28,14 +28,9 @@ MAX_LINES = 20
 # Объекты для доступа к чату {id:DDG object}
 CHATS_OBJ = {}
 
-# хранилище диалогов {id:list(mem)}
+# хранилище диалогов и блокировки чатов что бы не испортить историю
 # Эти диалоги на самом деле не работают, просто что бы были, нет смысла сохранять их на диск
-CHATS = {}
-
-# блокировка чатов что бы не испортить историю 
-# {id:lock}
-LOCKS = {}
-
+MEM = my_chatmem.ChatMemory('ddg', max_lines=MAX_LINES*2, persistent=False, log=my_log.log_ddg)
 
 
 def undo(chat_id: str):
@@ -51,14 +46,7 @@ def undo(chat_id: str):
     Returns:
         None
     """
-    try:
-        if chat_id in CHATS:
-            mem = CHATS[chat_id]
-            # remove 2 last lines from mem
-            mem = mem[:-2]
-            CHATS[chat_id] = mem
-    except Exception as error:
-        my_log.log_ddg(f'Failed to undo chat {chat_id}: {error}')
+    MEM.undo(chat_id)
 
 
 def get_mem_as_string(chat_id: str) -> str:
@@ -71,45 +59,17 @@ def get_mem_as_string(chat_id: str) -> str:
     Returns:
         str: The chat history as a string.
     """
-    if chat_id not in CHATS:
-        CHATS[chat_id] = []
-    mem = CHATS[chat_id]
-    result = ''
-    for x in mem:
-        role = x['role']
-        if role == 'user': role = '𝐔𝐒𝐄𝐑'
-        if role == 'assistant': role = '𝐁𝐎𝐓'
-
-        text = x['content']
-
-        if text.startswith('[Info to help you answer'):
-            end = text.find(']') + 1
-            text = text[end:].strip()
-        result += f'{role}: {text}\n'
-        if role == '𝐁𝐎𝐓':
-            result += '\n'
-    return result
+    return MEM.as_string(chat_id)
 
 
 def update_mem(query: str, resp: str, chat_id: str):
-    if chat_id not in CHATS:
-        CHATS[chat_id] = []
-
-    mem = CHATS[chat_id]
-
-    mem += [{'role': 'user', 'content': query}]
-    mem += [{'role': 'assistant', 'content': resp}]
-
-    mem = mem[-MAX_LINES*2:]
-
-    CHATS[chat_id] = mem
+    MEM.update(chat_id, query, resp)
 
 
 def reset(chat_id: str):
     if chat_id in CHATS_OBJ:
         del CHATS_OBJ[chat_id]
-    if chat_id in CHATS:
-        del CHATS[chat_id]
+    MEM.reset(chat_id)
 
 
 def chat_new_connection():
@@ -133,10 +93,7 @@ def chat(query: str,
     if not model:
         model='claude-3-haiku'
 
-    if chat_id not in LOCKS:
-        LOCKS[chat_id] = threading.Lock()
-
-    with LOCKS[chat_id]:
+    with MEM.lock(chat_id):
         try:
             resp = CHATS_OBJ[chat_id].chat(query, model)
             my_db.add_msg(chat_id, model)
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# склейка сообщений которые приходят пачкой (длинный текст порезанный клиентом
+# телеграма на куски, альбомы картинок), части копятся в буфере по ключу и
+# когда новые части перестали приходить вызывается одна функция со всеми частями.
+# Все буферы обслуживает один поток, он спит до ближайшего срока
+
+
+import threading
+import time
+import traceback
+
+import my_log
+
+
+class Debouncer:
+    '''Collects items by key and calls callback(key, items) once
+    when no new item for the key arrived for its delay.
+
+    callback is called in the debouncer thread, it should be fast
+    (for example submit the real work to a worker pool).
+    '''
+    def __init__(self, callback, name: str = ''):
+        self.callback = callback
+        self.name = name
+        # {key: [deadline, items]}
+        self.buffers = {}
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def add(self, key, item, delay: float) -> bool:
+        '''Add item to the buffer of key, callback fires after delay seconds
+        of silence (each new item moves the deadline).
+        Returns True if this item started a new buffer.'''
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name=f'debounce {self.name}', daemon=True)
+                self.thread.start()
+            first = key not in self.buffers
+            if first:
+                self.buffers[key] = [0, []]
+            self.buffers[key][0] = time.time() + delay
+            self.buffers[key][1].append(item)
+            self.condition.notify()
+            return first
+
+    def run(self):
+        while True:
+            with self.condition:
+                now = time.time()
+                ready = [key for key, (deadline, _) in self.buffers.items() if deadline <= now]
+                ready = [(key, self.buffers.pop(key)[1]) for key in ready]
+                if not ready:
+                    deadlines = [deadline for deadline, _ in self.buffers.values()]
+                    self.condition.wait(min(deadlines) - now if deadlines else None)
+                    continue
+            for key, items in ready:
+                try:
+                    self.callback(key, items)
+                except Exception as error:
+                    error_traceback = traceback.format_exc()
+                    my_log.log2(f'my_debounce:{self.name}: {error}\n\n{error_traceback}')
+
+
+if __name__ == '__main__':
+    pass
+
+    # d = Debouncer(lambda key, items: print(key, items), 'test')
+    # d.add('chat', 'part 1', 1)
+    # time.sleep(0.5)
+    # d.add('chat', 'part 2', 1)
+    # time.sleep(2)
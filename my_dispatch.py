@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# диспетчер обработчиков телеграм бота
+# раньше каждый апдейт запускался в своем потоке (utils.async_run), при наплыве
+# это тысячи потоков. Теперь апдейты ставятся в очередь общего цикла asyncio
+# и выполняются ограниченным пулом потоков, ждущие своей очереди апдейты
+# это просто корутины а не потоки. В этом же цикле можно выполнять асинхронный
+# код других модулей (run_coroutine)
+
+
+import asyncio
+import concurrent.futures
+import functools
+import threading
+import time
+import traceback
+
+import cfg
+import my_log
+
+
+# сколько обработчиков может работать одновременно, остальные ждут в очереди
+WORKERS = cfg.DISPATCH_WORKERS if hasattr(cfg, 'DISPATCH_WORKERS') else 100
+
+LOOP = None
+LOOP_LOCK = threading.Lock()
+EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix='dispatch')
+# пул по умолчанию для run_in_executor(None, ...) и to_thread из корутин цикла,
+# отдельный и маленький, чтобы такие вызовы не занимали воркеры обработчиков
+# и не ждали за ними в очереди
+LOOP_WORKERS = 4
+
+STATS = {'submitted': 0, 'queued': 0, 'running': 0, 'done': 0, 'errors': 0,
+         'max_queued': 0, 'wait_time': 0.0, 'max_wait_time': 0.0}
+STATS_LOCK = threading.Lock()
+
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    '''Event loop of the dispatcher, it runs forever in its own daemon thread'''
+    global LOOP
+    with LOOP_LOCK:
+        if LOOP is None:
+            LOOP = asyncio.new_event_loop()
+            LOOP.set_default_executor(concurrent.futures.ThreadPoolExecutor(max_workers=LOOP_WORKERS,
+                                                                            thread_name_prefix='dispatch-loop'))
+            threading.Thread(target=LOOP.run_forever, name='dispatch-loop', daemon=True).start()
+        return LOOP
+
+
+async def run(func, args: tuple, kwargs: dict, submit_time: float):
+    with STATS_LOCK:
+        STATS['queued'] += 1
+        STATS['max_queued'] = max(STATS['max_queued'], STATS['queued'])
+
+    def worker():
+        wait_time = time.time() - submit_time
+        with STATS_LOCK:
+            STATS['queued'] -= 1
+            STATS['running'] += 1
+            STATS['wait_time'] += wait_time
+            STATS['max_wait_time'] = max(STATS['max_wait_time'], wait_time)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            with STATS_LOCK:
+                STATS['running'] -= 1
+                STATS['done'] += 1
+
+    try:
+        return await get_loop().run_in_executor(EXECUTOR, worker)
+    except Exception as error:
+        with STATS_LOCK:
+            STATS['errors'] += 1
+        error_traceback = traceback.format_exc()
+        my_log.log2(f'my_dispatch:run: {getattr(func, "__name__", func)} {error}\n\n{error_traceback}')
+
+
+def submit(func, *args, **kwargs) -> concurrent.futures.Future:
+    '''Run func(*args, **kwargs) in the worker pool, returns future with its result
+    (None if func raised an exception, it is logged)'''
+    with STATS_LOCK:
+        STATS['submitted'] += 1
+    return asyncio.run_coroutine_threadsafe(run(func, args, kwargs, time.time()), get_loop())
+
+
+def async_run(func):
+    '''Декоратор для запуска функции в пуле обработчиков, асинхронно.
+    Для бесконечных циклов (демонов) надо использовать utils.async_run,
+    иначе они навсегда займут воркер пула'''
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        submit(func, *args, **kwargs)
+    return wrapper
+
+
+def run_coroutine(coro, timeout: float = None):
+    '''Run coroutine in the dispatcher loop and wait for the result,
+    must not be called from the loop thread itself'''
+    return asyncio.run_coroutine_threadsafe(coro, get_loop()).result(timeout)
+
+
+def get_stats_text() -> str:
+    '''Short text report for /stats'''
+    with STATS_LOCK:
+        started = STATS['done'] + STATS['running']
+        avg_wait = STATS['wait_time'] / started if started else 0
+        return (f"Dispatcher: {STATS['running']}/{WORKERS} running, {STATS['queued']} queued "
+                f"(max {STATS['max_queued']}), done {STATS['done']}, errors {STATS['errors']}, "
+                f"wait avg {avg_wait:.2f}s max {STATS['max_wait_time']:.1f}s")
+
+
+if __name__ == '__main__':
+    pass
+
+    # for i in range(10):
+    #     submit(time.sleep, 1)
+    # time.sleep(0.1)
+    # print(get_stats_text())
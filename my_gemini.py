@@ -1,10 +1,10 @@
 #!/usr/bin/env python3
 
 import cachetools.func
+import functools
 import io
 import PIL
 import pprint
-import random
 import re
 import sys
 import time
@@ -19,7 +19,9 @@ from google.api_core import retry
 from sqlitedict import SqliteDict
 
 import cfg
+import my_chatmem
 import my_db
+import my_keys
 import my_log
 import my_sum
 from my_skills import get_weather, get_currency_rates, search_google, download_text_from_url, update_user_profile, calc, get_cryptocurrency_rates, run_script, query_wikipedia
@@ -34,6 +36,8 @@ USER_KEYS = SqliteDict('db/gemini_user_keys.db', autocommit=True)
 # list of all users keys
 
 ALL_KEYS = []
+# порядок в котором пробовать ключи, с учетом их ошибок и лимитов
+KEYS = my_keys.KeyPool('Gemini', rpm=15)
 USER_KEYS_LOCK = threading.Lock()
 
 SAFETY_SETTINGS = {
@@ -47,12 +51,14 @@ SAFETY_SETTINGS = {
 # таймаут в запросе к джемини
 TIMEOUT = 180
 
-LOCKS = {}
 CHATS = {}
 MAX_CHAT_LINES = 20
 if hasattr(cfg, 'GEMINI_MAX_CHAT_LINES'):
     MAX_CHAT_LINES = cfg.GEMINI_MAX_CHAT_LINES
-MAX_CHAT_MEM_BYTES = 40000
+# сколько токенов истории отправлять в запросе (оценка, см. my_db.estimate_tokens)
+MAX_CHAT_MEM_TOKENS = 10000
+# память диалогов и блокировки чатов что бы не испортить историю
+MEM = my_chatmem.ChatMemory('gemini', max_lines=MAX_CHAT_LINES*2, max_tokens=MAX_CHAT_MEM_TOKENS, assistant_role='model', log=my_log.log_gemini)
 # не принимать запросы больше чем, это ограничение для телеграм бота, в этом модуле оно не используется
 MAX_REQUEST = 20000
 MAX_SUM_REQUEST = 300000
@@ -68,6 +74,16 @@ MEM_UNCENSORED = [
 ]
 
 
+def unless_cancelled(skill, cancelled: threading.Event):
+    '''Skill that does nothing if the answer is not needed any more, see chat(cancelled)'''
+    @functools.wraps(skill)
+    def wrapper(*args, **kwargs):
+        if cancelled.is_set():
+            return 'Cancelled.'
+        return skill(*args, **kwargs)
+    return wrapper
+
+
 def chat(query: str,
          chat_id: str = '',
          temperature: float = 1,
@@ -76,7 +92,9 @@ def chat(query: str,
          max_tokens: int = 8000,
          insert_mem = None,
          key__: str = '',
-         use_skills: bool = False) -> str:
+         use_skills: bool = False,
+         update_memory: bool = True,
+         cancelled: threading.Event = None) -> str:
     '''Chat with AI model.
     Args:
         query (str): The query to be used for generating the response.
@@ -100,6 +118,10 @@ def chat(query: str,
         system (str, optional): The system instruction to use for generating the response. Defaults to ''.
         max_tokens (int, optional): The maximum number of tokens to generate. Defaults to 8000. Range: [10,8000]
         insert_mem: (list, optional): The history of the chat. Defaults to None.
+        update_memory (bool, optional): Save query and answer to the chat history. Defaults to True.
+        cancelled (threading.Event, optional): Set when the answer is not needed any more
+                                               (lost the race in my_hedge), then skills with
+                                               side effects are not run and the answer is not counted.
 
     Returns:
         str: The generated response from the AI model.
@@ -117,7 +139,7 @@ def chat(query: str,
             max_tokens = 8000
 
         if chat_id:
-            mem = my_db.blob_to_obj(my_db.get_user_property(chat_id, 'dialog_gemini')) or []
+            mem = get_mem(chat_id)
         else:
             mem = []
 
@@ -137,12 +159,10 @@ def chat(query: str,
             system = f'user_id: None User profile: none, do not try to update it'
 
         if not key__:
-            keys = cfg.gemini_keys[:] + ALL_KEYS
+            keys = KEYS.pick(cfg.gemini_keys + ALL_KEYS, 4)
         else:
             keys = [key__,]
 
-        random.shuffle(keys)
-        keys = keys[:4]
         badkeys = ['3166979107466835308',]
         for key in keys[:]:
             if hash(key) in badkeys:
@@ -184,6 +204,8 @@ def chat(query: str,
                     _user_id = int(chat_id.split(' ')[0].replace('[','').replace(']',''))
                     if _user_id in cfg.admins:
                         SKILLS += [run_script,]
+                if cancelled is not None:
+                    SKILLS = [unless_cancelled(x, cancelled) if x in (update_user_profile, run_script) else x for x in SKILLS]
 
                 model_ = genai.GenerativeModel(model,
                                         tools=SKILLS,
@@ -203,11 +225,13 @@ def chat(query: str,
 
             chat = model_.start_chat(history=mem, enable_automatic_function_calling=True)
             # chat = model_.start_chat(history=mem)
+            time_request = time.time()
             try:
                 resp = chat.send_message(query,
                                     safety_settings=SAFETY_SETTINGS,
                                     request_options=request_options,
                                     )
+                KEYS.success(key, time.time() - time_request)
             except Exception as error:
                 # my_log.log_gemini(f'my_gemini:chat: {error}\n{key}\nRequest size: {sys.getsizeof(query) + sys.getsizeof(mem)}\n{query}\n{mem}')
                 my_log.log_gemini(f'my_gemini:chat: {error}\n{key}\nRequest size: {sys.getsizeof(query) + sys.getsizeof(mem)} {query[:100]}')
@@ -218,6 +242,7 @@ def chat(query: str,
                     remove_key(key)
                 if 'finish_reason: ' in str(error) or 'block_reason: ' in str(error) or 'User location is not supported for the API use.' in str(error):
                     return ''
+                KEYS.failure(key, str(error))
                 continue
 
             result = resp.text
@@ -235,12 +260,14 @@ def chat(query: str,
                 if 'gemini-1.5-flash' in model: model_ = 'gemini15_flash'
                 if 'gemini-1.0-pro' in model: model_ = 'gemini10_pro'
                 if not model: model_ = 'gemini15_flash'
+                if cancelled is not None and cancelled.is_set():
+                    # ответил другой, этот ответ никто не увидит
+                    return ''
                 my_db.add_msg(chat_id, model_)
-                if chat_id:
-                    mem = chat.history[-MAX_CHAT_LINES*2:]
-                    while sys.getsizeof(mem) > MAX_CHAT_MEM_BYTES:
-                        mem = mem[2:]
-                    my_db.set_user_property(chat_id, 'dialog_gemini', my_db.obj_to_blob(mem))
+                if chat_id and update_memory:
+                    # в истории только текст, картинки из запроса не сохраняются
+                    query_text = query if isinstance(query, str) else ' '.join(x for x in query if isinstance(x, str))
+                    MEM.update(chat_id, query_text, result)
 
                 return result
             else:
@@ -362,6 +389,19 @@ def transform_mem(data):
         return []
 
 
+def get_mem(chat_id: str) -> list:
+    """
+    Get chat history for the given chat ID in genai format.
+
+    Parameters:
+        chat_id (str): The ID of the chat.
+
+    Returns:
+        list: The chat history as a list of dictionaries with role and parts.
+    """
+    return [{'role': role, 'parts': [{'text': text}]} for role, text in MEM.get_messages(chat_id)]
+
+
 def update_mem(query: str, resp: str, mem):
     """
     Update the memory with the given query and response.
@@ -374,20 +414,16 @@ def update_mem(query: str, resp: str, mem):
     Returns:
         list: The updated memory object.
     """
-    chat_id = ''
     if isinstance(mem, str): # if mem - chat_id
-        chat_id = mem
-        mem = transform_mem(my_db.blob_to_obj(my_db.get_user_property(chat_id, 'dialog_gemini'))) or []
+        MEM.update(mem, query, resp)
+        return get_mem(mem)
 
     mem.append({"role": "user", "parts": [{"text": query}]})
     mem.append({"role": "model", "parts": [{"text": resp}]})
 
     mem = mem[-MAX_CHAT_LINES*2:]
-    while sys.getsizeof(mem) > MAX_CHAT_MEM_BYTES:
-        mem = mem[2:]
+    mem = my_chatmem.trim_tokens(mem, MAX_CHAT_MEM_TOKENS)
 
-    if chat_id:
-        my_db.set_user_property(chat_id, 'dialog_gemini', my_db.obj_to_blob(mem))
     return mem
 
 
@@ -404,22 +440,7 @@ def undo(chat_id: str):
     Returns:
         None
     """
-    try:
-        global LOCKS
-
-        if chat_id in LOCKS:
-            lock = LOCKS[chat_id]
-        else:
-            lock = threading.Lock()
-            LOCKS[chat_id] = lock
-        with lock:
-            mem = transform_mem(my_db.blob_to_obj(my_db.get_user_property(chat_id, 'dialog_gemini'))) or []
-            # remove 2 last lines from mem
-            mem = mem[:-2]
-            my_db.set_user_property(chat_id, 'dialog_gemini', my_db.obj_to_blob(mem))
-    except Exception as error:
-        error_traceback = traceback.format_exc()
-        my_log.log_gemini(f'Failed to undo chat {chat_id}: {error}\n\n{error_traceback}')
+    MEM.undo(chat_id)
 
 
 def reset(chat_id: str):
@@ -432,8 +453,7 @@ def reset(chat_id: str):
     Returns:
         None
     """
-    mem = []
-    my_db.set_user_property(chat_id, 'dialog_gemini', my_db.obj_to_blob(mem))
+    MEM.reset(chat_id)
 
 
 def get_mem_for_llama(chat_id: str, l: int = 3):
@@ -450,7 +470,7 @@ def get_mem_for_llama(chat_id: str, l: int = 3):
     res_mem = []
     l = l*2
 
-    mem = transform_mem(my_db.blob_to_obj(my_db.get_user_property(chat_id, 'dialog_gemini'))) or []
+    mem = get_mem(chat_id)
     mem = mem[-l:]
 
     for x in mem:
@@ -477,7 +497,7 @@ def get_mem_as_string(chat_id: str) -> str:
     Returns:
         str: The chat history as a string.
     """
-    mem = transform_mem(my_db.blob_to_obj(my_db.get_user_property(chat_id, 'dialog_gemini'))) or []
+    mem = get_mem(chat_id)
     # print(type(mem), mem)
     result = ''
     for x in mem:
@@ -731,6 +751,7 @@ def remove_key(key: str):
     try:
         if key in ALL_KEYS:
             del ALL_KEYS[ALL_KEYS.index(key)]
+        KEYS.remove(key)
         with USER_KEYS_LOCK:
             # remove key from USER_KEYS
             for user in USER_KEYS:
@@ -17,7 +17,6 @@ from io import BytesIO
 import gradio_client
 import langdetect
 import PIL
-import requests
 from sqlitedict import SqliteDict
 from PIL import Image
 
@@ -25,6 +24,8 @@ import bing_img
 import cfg
 import my_gemini
 import my_groq
+import my_http
+import my_keys
 import my_log
 import my_runware_ai
 import my_trans
@@ -40,6 +41,8 @@ DEBUG = cfg.DEBUG if hasattr(cfg, 'DEBUG') else False
 USER_KEYS = SqliteDict('db/huggingface_user_keys.db', autocommit=True)
 # list of all users keys
 ALL_KEYS = []
+# порядок в котором пробовать ключи, с учетом их ошибок и лимитов
+KEYS = my_keys.KeyPool('Huggingface')
 USER_KEYS_LOCK = threading.Lock()
 
 
@@ -120,6 +123,7 @@ def remove_huggin_face_key(api_key: str):
     '''Remove an API key from the list of valid API keys'''
     try:
         global ALL_KEYS
+        KEYS.remove(api_key)
         ALL_KEYS.remove(api_key)
         user = 'unknown'
         for user in USER_KEYS:
@@ -239,27 +243,27 @@ def huggin_face_api(prompt: str, negative_prompt: str = "") -> list:
         while n > 0:
             n -= 1
 
-            if hasattr(cfg, 'bing_proxy'):
-                proxy = {'http': random.choice(cfg.bing_proxy), 'https': random.choice(cfg.bing_proxy)}
-            else:
-                proxy = None
-            api_key = random.choice(ALL_KEYS)
+            proxy = my_http.bing_proxy()
+            api_key = KEYS.pick(ALL_KEYS, 1)[0]
             headers = {"Authorization": f"Bearer {api_key}"}
 
+            time_request = time.time()
             try:
-                response = requests.post(url, headers=headers, json=p, timeout=120, proxies=proxy)
+                response = my_http.post(url, headers=headers, json=p, timeout=120, proxy=proxy)
             except Exception as error:
                 my_log.log_huggin_face_api(f'my_genimg:huggin_face_api: {error}\nPrompt: {prompt}\nAPI key: {api_key}\nProxy: {proxy}\nURL: {url}')
                 continue
 
             if '"error":"Authorization header is correct, but the token seems invalid' in response.text:
                 remove_huggin_face_key(api_key)
-                api_key = random.choice(ALL_KEYS)
                 continue
             resp_text = str(response.content)[:300]
+            if response.status_code == 429 or 'rate limit' in resp_text.lower():
+                KEYS.failure(api_key, f'rate limit {resp_text}')
             if 'read timeout=' in resp_text or "SOCKSHTTPSConnectionPool(host='api-inference.huggingface.co', port=443): Max retries exceeded with url" in resp_text: # и так долго ждали
                 return []
             if response.content and '{"error"' not in resp_text and len(response.content) > 10000:
+                KEYS.success(api_key, time.time() - time_request)
                 # resize small images, upscale
                 upscaled = upscale(response.content)
                 result.append(upscaled)
@@ -532,7 +536,7 @@ def kandinski(prompt: str, width: int = 1024, height: int = 1024, num: int = 1,
 		    }
 	    }
         def get_model():
-            response = requests.get('https://api-key.fusionbrain.ai/key/api/v1/models', headers=AUTH_HEADERS)
+            response = my_http.get('https://api-key.fusionbrain.ai/key/api/v1/models', headers=AUTH_HEADERS)
             data = response.json()
             return data[0]['id']
 
@@ -540,7 +544,7 @@ def kandinski(prompt: str, width: int = 1024, height: int = 1024, num: int = 1,
             'model_id': (None, get_model()),
             'params': (None, json.dumps(params), 'application/json')
         }
-        response = requests.post('https://api-key.fusionbrain.ai/key/api/v1/text2image/run', headers=AUTH_HEADERS, files=data, timeout=120)
+        response = my_http.post('https://api-key.fusionbrain.ai/key/api/v1/text2image/run', headers=AUTH_HEADERS, files=data, timeout=120)
         data = response.json()
         try:
             uuid = data['uuid']
@@ -549,7 +553,7 @@ def kandinski(prompt: str, width: int = 1024, height: int = 1024, num: int = 1,
 
         def check_generation(request_id, attempts=10, delay=10):
             while attempts > 0:
-                response = requests.get('https://api-key.fusionbrain.ai/key/api/v1/text2image/status/' + request_id, headers=AUTH_HEADERS)
+                response = my_http.get('https://api-key.fusionbrain.ai/key/api/v1/text2image/status/' + request_id, headers=AUTH_HEADERS)
                 data = response.json()
                 if  data['censored']:
                     return []
@@ -591,7 +595,7 @@ def get_ynd_iam_token(oauth_tokens):
   for oauth_token in oauth_tokens:
     data = {"yandexPassportOauthToken": oauth_token}
 
-    response = requests.post(url, headers=headers, json=data, timeout=10)
+    response = my_http.post(url, headers=headers, json=data, timeout=10)
 
     if response.status_code == 200:
         return response.json()['iamToken']
@@ -627,14 +631,14 @@ def yandex_cloud_generate_image_async(iam_token: str, prompt: str, seed=None, ti
         else:
             data["generation_options"]["seed"] = random.randint(0, 2**64 - 1)
 
-        response = requests.post(url, headers=headers, json=data, timeout=20)
+        response = my_http.post(url, headers=headers, json=data, timeout=20)
 
         if response.status_code == 200:
             url = f" https://llm.api.cloud.yandex.net:443/operations/{response.json()['id']}"
             time.sleep(30)
             while timeout > 0:
                 try:
-                    response = requests.get(url, headers=headers, timeout=20)
+                    response = my_http.get(url, headers=headers, timeout=20)
                     if response.status_code == 200:
                         if hasattr(response, 'text'):
                             response = response.json()
@@ -1188,15 +1192,12 @@ def test_hkey(key: str):
     while n > 0:
         n -= 1
 
-        if hasattr(cfg, 'bing_proxy'):
-            proxy = {'http': random.choice(cfg.bing_proxy), 'https': random.choice(cfg.bing_proxy)}
-        else:
-            proxy = None
+        proxy = my_http.bing_proxy()
         api_key = key
         headers = {"Authorization": f"Bearer {api_key}"}
 
         try:
-            response = requests.post(API_URL[0], headers=headers, json=payload, timeout=5, proxies=proxy)
+            response = my_http.post(API_URL[0], headers=headers, json=payload, timeout=5, proxy=proxy)
         except Exception as error:
             # print(error)
             continue
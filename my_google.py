@@ -10,6 +10,7 @@ import my_log
 import my_gemini
 import my_ddg
 import my_groq
+import my_hedge
 import my_sum
 import utils
 
@@ -66,22 +67,16 @@ Search results:
 
 {text[:my_gemini.MAX_SUM_REQUEST]}
 '''
-    r = ''
-    r =  my_gemini.ai(q[:my_gemini.MAX_SUM_REQUEST], model='gemini-1.5-flash', temperature=1)
-    if r:
-        r += '\n\n--\n[Gemini Flash]'
-    # if not r:
-    #     r = my_gemini.ai(q[:32000], model='gemini-1.5-flash', temperature=1)
-    #     if r:
-    #         r += '\n\n--\n[Gemini Flash]'
-    if not r:
-        r = my_groq.ai(q[:my_groq.MAX_SUM_REQUEST], max_tokens_ = 4000, model_= 'llama-3.1-70b-versatile')
-        if r:
-            r += '\n\n--\n[Llama 3.1 70b]'
-    if not r:
-        r = my_groq.ai(q[:32000], max_tokens_ = 4000, model_ = 'mixtral-8x7b-32768')
-        if r:
-            r += '\n\n--\n[Mixtral-8x7b-32768]'
+    def signed(answer: str, name: str) -> str:
+        return f'{answer}\n\n--\n[{name}]' if answer else ''
+
+    # следующий запускается если предыдущий ответил пустотой или думает дольше обычного
+    _, r = my_hedge.hedge(
+        ('search_gemini', lambda: signed(my_gemini.ai(q[:my_gemini.MAX_SUM_REQUEST], model='gemini-1.5-flash', temperature=1), 'Gemini Flash')),
+        # ('search_gemini', lambda: signed(my_gemini.ai(q[:32000], model='gemini-1.5-flash', temperature=1), 'Gemini Flash')),
+        ('search_llama31', lambda: signed(my_groq.ai(q[:my_groq.MAX_SUM_REQUEST], max_tokens_ = 4000, model_= 'llama-3.1-70b-versatile'), 'Llama 3.1 70b')),
+        ('search_mixtral', lambda: signed(my_groq.ai(q[:32000], max_tokens_ = 4000, model_ = 'mixtral-8x7b-32768'), 'Mixtral-8x7b-32768')),
+        )
 
     return r, f'Data extracted from Google with query "{query}":\n\n' + text
 
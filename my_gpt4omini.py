@@ -3,15 +3,15 @@
 import cachetools.func
 import base64
 import json
-import requests
-import threading
 import traceback
 
 import langcodes
 from sqlitedict import SqliteDict
 
 import cfg
+import my_chatmem
 import my_db
+import my_http
 import my_log
 
 
@@ -19,10 +19,6 @@ import my_log
 MAX_MEM_LINES = 20
 
 
-# блокировка чатов что бы не испортить историю 
-# {id:lock}
-LOCKS = {}
-
 # не принимать запросы больше чем, это ограничение для телеграм бота, в этом модуле оно не используется
 MAX_REQUEST = 10000
 MAX_SUM_REQUEST = 30000
@@ -30,29 +26,15 @@ MAX_SUM_REQUEST = 30000
 maxhistchars = 20000
 maxhistlines = MAX_MEM_LINES
 
+# память диалогов и блокировки чатов что бы не испортить историю
+MEM = my_chatmem.ChatMemory('gpt4omini', max_lines=maxhistlines*2, max_chars=maxhistchars, log=my_log.log_gpt4omini)
+
 
 # {user_id:bool} в каких чатах добавлять разблокировку цензуры
 # не работает с гпт 4о мини
 MEM_UNCENSORED = []
 
 
-def clear_mem(mem):
-    while 1:
-        sizeofmem = count_tokens(mem)
-        if sizeofmem <= maxhistchars:
-            break
-        try:
-            mem = mem[2:]
-        except IndexError:
-            mem = []
-            break
-    return mem[-maxhistlines*2:]
-
-
-def count_tokens(mem) -> int:
-    return sum([len(m['content']) for m in mem])
-
-
 def ai(prompt: str = '',
        mem = None,
        user_id: str = '',
@@ -82,7 +64,7 @@ def ai(prompt: str = '',
     YOUR_SITE_URL = 'https://t.me/kun4sun_bot'
     YOUR_APP_NAME = 'kun4sun_bot'
 
-    response = requests.post(
+    response = my_http.post(
         url=url,
         headers={
             "Authorization": f"Bearer {key}",
@@ -110,42 +92,22 @@ def ai(prompt: str = '',
     return status, text
 
 
-def update_mem(query: str, resp: str, chat_id: str):
-    mem = my_db.blob_to_obj(my_db.get_user_property(chat_id, 'dialog_gpt4omini')) or []
-    mem += [{'role': 'user', 'content': query}]
-    mem += [{'role': 'assistant', 'content': resp}]
-    mem = clear_mem(mem)
+def get_mem(chat_id: str) -> list:
+    '''Get chat history for chat_id as list of messages'''
+    return MEM.get(chat_id)
 
-    mem__ = []
-    try:
-        i = 0
-        while i < len(mem):
-            if i == 0 or mem[i] != mem[i-1]:
-                mem__.append(mem[i])
-            i += 1
-    except Exception as error:
-        error_traceback = traceback.format_exc()
-        my_log.log_gpt4omini(f'my_gpt4omini:update_mem: {error}\n\n{error_traceback}\n\n{query}\n\n{resp}\n\n{mem}')
 
-    my_db.set_user_property(chat_id, 'dialog_gpt4omini', my_db.obj_to_blob(mem__))
+def update_mem(query: str, resp: str, chat_id: str):
+    MEM.update(chat_id, query, resp)
 
 
 def chat(query: str, chat_id: str = '', temperature: float = 1, system: str = '', model: str = '') -> str:
-    global LOCKS
-    if chat_id in LOCKS:
-        lock = LOCKS[chat_id]
-    else:
-        lock = threading.Lock()
-        LOCKS[chat_id] = lock
-    with lock:
-        mem = my_db.blob_to_obj(my_db.get_user_property(chat_id, 'dialog_gpt4omini')) or []
+    with MEM.lock(chat_id):
+        mem = get_mem(chat_id)
         status_code, text = ai(query, mem, user_id=chat_id, temperature = temperature, system=system, model=model)
         if text:
             my_db.add_msg(chat_id, 'gpt_4o_mini')
-            mem += [{'role': 'user', 'content': query}]
-            mem += [{'role': 'assistant', 'content': text}]
-            mem = clear_mem(mem)
-            my_db.set_user_property(chat_id, 'dialog_gpt4omini', my_db.obj_to_blob(mem))
+            update_mem(query, text, chat_id)
         return status_code, text
 
 
@@ -172,22 +134,7 @@ def undo(chat_id: str):
     Returns:
         None
     """
-    try:
-        global LOCKS
-
-        if chat_id in LOCKS:
-            lock = LOCKS[chat_id]
-        else:
-            lock = threading.Lock()
-            LOCKS[chat_id] = lock
-        with lock:
-            mem = my_db.blob_to_obj(my_db.get_user_property(chat_id, 'dialog_gpt4omini')) or []
-            # remove 2 last lines from mem
-            mem = mem[:-2]
-            my_db.set_user_property(chat_id, 'dialog_gpt4omini', my_db.obj_to_blob(mem))
-    except Exception as error:
-        error_traceback = traceback.format_exc()
-        my_log.log_gpt4omini(f'Failed to undo chat {chat_id}: {error}\n\n{error_traceback}')
+    MEM.undo(chat_id)
 
 
 def reset(chat_id: str):
@@ -200,8 +147,7 @@ def reset(chat_id: str):
     Returns:
         None
     """
-    mem = []
-    my_db.set_user_property(chat_id, 'dialog_gpt4omini', my_db.obj_to_blob(mem))
+    MEM.reset(chat_id)
 
 
 def get_mem_as_string(chat_id: str) -> str:
@@ -214,26 +160,7 @@ def get_mem_as_string(chat_id: str) -> str:
     Returns:
         str: The chat history as a string.
     """
-    try:
-        mem = my_db.blob_to_obj(my_db.get_user_property(chat_id, 'dialog_gpt4omini')) or []
-        result = ''
-        for x in mem:
-            role = x['role']
-            if role == 'user': role = '𝐔𝐒𝐄𝐑'
-            if role == 'assistant': role = '𝐁𝐎𝐓'
-            if role == 'system': role = '𝐒𝐘𝐒𝐓𝐄𝐌'
-            text = x['content']
-            if text.startswith('[Info to help you answer'):
-                end = text.find(']') + 1
-                text = text[end:].strip()
-            result += f'{role}: {text}\n'
-            if role == '𝐁𝐎𝐓':
-                result += '\n'
-        return result 
-    except Exception as error:
-        error_traceback = traceback.format_exc()
-        my_log.log_gpt4omini(f'my_gpt4omini:get_mem_as_string: {error}\n\n{error_traceback}')
-        return ''
+    return MEM.as_string(chat_id)
 
 
 def sum_big_text(text:str, query: str, temperature: float = 1, model: str = '', max_size: int = None) -> str:
@@ -377,7 +304,7 @@ def img2txt(data_: bytes, prompt: str = "Что на картинке, подр
         "max_tokens": 1000
     }
 
-    response = requests.post(url, headers=headers, json=payload, timeout = timeout)
+    response = my_http.post(url, headers=headers, json=payload, timeout = timeout)
 
     try:
         resp = response.json()['choices'][0]['message']['content']
@@ -15,7 +15,9 @@ from groq import Groq, PermissionDeniedError
 from sqlitedict import SqliteDict
 
 import cfg
+import my_chatmem
 import my_db
+import my_keys
 import my_log
 import my_sum
 
@@ -27,13 +29,11 @@ import my_sum
 USER_KEYS = SqliteDict('db/groq_user_keys.db', autocommit=True)
 # list of all users keys
 ALL_KEYS = []
+# порядок в котором пробовать ключи, с учетом их ошибок и лимитов
+KEYS = my_keys.KeyPool('Groq', rpm=30)
 USER_KEYS_LOCK = threading.Lock()
 
 
-# блокировка чатов что бы не испортить историю 
-# {id:lock}
-LOCKS = {}
-
 # не принимать запросы больше чем, это ограничение для телеграм бота, в этом модуле оно не используется
 MAX_REQUEST = 6000
 MAX_REQUEST_LLAMA31 = 20000
@@ -41,9 +41,15 @@ MAX_REQUEST_GEMMA2_9B = 12000
 
 MAX_QUERY_LENGTH = 10000
 MAX_MEM_LLAMA31 = 50000
+# сколько токенов истории отправлять в запросе (оценка, см. my_db.estimate_tokens)
+MAX_MEM_TOKENS = 2500
+MAX_MEM_TOKENS_LLAMA31 = 12500
 # максимальное количество запросов которые можно хранить в памяти
 MAX_LINES = 20
 
+# память диалогов и блокировки чатов что бы не испортить историю
+MEM = my_chatmem.ChatMemory('groq', max_lines=MAX_LINES*2, max_tokens=MAX_MEM_TOKENS_LLAMA31, log=my_log.log_groq)
+
 # limit for summarize
 MAX_SUM_REQUEST = MAX_MEM_LLAMA31
 
@@ -68,6 +74,7 @@ def ai(prompt: str = '',
        max_tokens_: int = 4000,
        key_: str = '',
        timeout: int = 180,
+       stream_callback = None,
        ) -> str:
     """
     Generates a response using the GROQ AI model.
@@ -81,6 +88,8 @@ def ai(prompt: str = '',
             (llama3-8b-8192, mixtral-8x7b-32768, gemma-7b-it, gemma2-9b-itб llama-3.1-405b-reasoning, llama-3.1-70b-versatile, llama-3.1-8b-instant)
         max_tokens_ (int, optional): The maximum number of tokens in the generated response. Defaults to 2000.
         key_ (str, optional): The API key for the GROQ model. Defaults to ''.
+        stream_callback (callable, optional): If set the response is streamed and
+            stream_callback(text) is called with the text received so far. Defaults to None.
 
     Returns:
         str: The generated response from the GROQ AI model. Returns an empty string if error.
@@ -112,18 +121,15 @@ def ai(prompt: str = '',
         if key_:
             keys = [key_, ]
         else:
-            keys = ALL_KEYS
-            random.shuffle(keys)
-            keys = keys[:4]
+            keys = KEYS.pick(ALL_KEYS, 4)
 
         # model="llama3-70b-8192", # llama3-8b-8192, mixtral-8x7b-32768, gemma-7b-it, gemma2-9b-it, 'llama-3.1-70b-versatile' 'llama-3.1-405b-reasoning'
         model = model_ if model_ else 'llama-3.1-70b-versatile'
 
-        max_mem = MAX_QUERY_LENGTH
+        max_mem = MAX_MEM_TOKENS
         if 'llama-3.1' in model:
-            max_mem = MAX_MEM_LLAMA31
-        while token_count(mem) > max_mem + 100:
-            mem = mem[2:]
+            max_mem = MAX_MEM_TOKENS_LLAMA31
+        mem = my_chatmem.trim_tokens(mem, max_mem)
 
         if 'llama-3.1' in model_ or 'llama3' in model_:
             temperature = temperature / 2
@@ -138,25 +144,36 @@ def ai(prompt: str = '',
             else:
                 client = Groq(api_key=key, timeout = timeout)
 
+            time_request = time.time()
             try:
-                chat_completion = client.chat.completions.create(
-                    messages=mem,
-                    model=model,
-                    temperature=temperature,
-                    max_tokens=max_tokens_,
-                )
+                if stream_callback:
+                    resp = read_stream(client.chat.completions.create(
+                        messages=mem,
+                        model=model,
+                        temperature=temperature,
+                        max_tokens=max_tokens_,
+                        stream=True,
+                    ), stream_callback)
+                else:
+                    chat_completion = client.chat.completions.create(
+                        messages=mem,
+                        model=model,
+                        temperature=temperature,
+                        max_tokens=max_tokens_,
+                    )
+                    resp = chat_completion.choices[0].message.content.strip()
+                KEYS.success(key, time.time() - time_request)
             except PermissionDeniedError:
                 my_log.log_groq(f'GROQ PermissionDeniedError: {key}')
+                KEYS.failure(key, 'PermissionDeniedError')
                 continue
             except Exception as error:
                 if 'invalid api key' in str(error).lower():
                     remove_key(key)
                     continue
-                if 'Rate limit reached for model' in str(error).lower():
+                KEYS.failure(key, str(error))
+                if 'rate limit reached for model' in str(error).lower():
                     continue
-            try:
-                resp = chat_completion.choices[0].message.content.strip()
-            except UnboundLocalError:
                 resp = ''
             if not resp and 'llama-3.1' in model_:
                 if model_ == 'llama-3.1-405b-reasoning':
@@ -167,7 +184,7 @@ def ai(prompt: str = '',
                     model__ = 'llama3-8b-8192'
                 else:
                     return ''
-                return ai(prompt, system, mem_, temperature*2, model__, max_tokens_, key_, timeout)
+                return ai(prompt, system, mem_, temperature*2, model__, max_tokens_, key_, timeout, stream_callback)
             if resp:
                 return resp
         return ''
@@ -178,11 +195,28 @@ def ai(prompt: str = '',
     return ''
 
 
+def read_stream(stream, callback) -> str:
+    '''Collect streamed chat completion, callback(text) is called with the text received so far'''
+    resp = ''
+    for chunk in stream:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if delta:
+            resp += delta
+            try:
+                callback(resp)
+            except Exception as error:
+                my_log.log_groq(f'my_groq:read_stream: callback error {error}')
+    return resp.strip()
+
+
 def remove_key(key: str):
     '''Removes a given key from the ALL_KEYS list and from the USER_KEYS dictionary.'''
     try:
         if key in ALL_KEYS:
             del ALL_KEYS[ALL_KEYS.index(key)]
+        KEYS.remove(key)
         with USER_KEYS_LOCK:
             # remove key from USER_KEYS
             for user in USER_KEYS:
@@ -195,25 +229,26 @@ def remove_key(key: str):
 
 
 def token_count(mem, model:str = "meta-llama/Meta-Llama-3-8B") -> int:
-    '''broken, only counts symbols not tokens'''
+    '''Estimated tokens in text or list of messages, no real tokenizer (see my_db.estimate_tokens)'''
     if isinstance(mem, str):
-        text = mem
-    else:
-        text = ' '.join([m['content'] for m in mem])
-    l = len(text)
-    return l
+        return my_db.estimate_tokens(mem)
+    return sum(my_chatmem.message_tokens(m) for m in mem)
+
+
+def get_mem(chat_id: str) -> list:
+    '''Get chat history for chat_id as list of messages for groq'''
+    return MEM.get(chat_id)
 
 
 def update_mem(query: str, resp: str, mem):
     chat_id = None
     if isinstance(mem, str): # if mem - chat_id
         chat_id = mem
-        mem = my_db.blob_to_obj(my_db.get_user_property(chat_id, 'dialog_groq')) or []
+        MEM.update(chat_id, query, resp)
+        return
     mem += [{'role': 'user', 'content': query}]
     mem += [{'role': 'assistant', 'content': resp}]
-    # while token_count(mem) > MAX_QUERY_LENGTH:
-    #     mem = mem[2:]
-    mem = mem[:MAX_LINES*2]
+    mem = mem[-MAX_LINES*2:]
 
     # непонятный глюк с задвоением памяти, убираем дубли
     mem__ = []
@@ -226,11 +261,8 @@ def update_mem(query: str, resp: str, mem):
     except Exception as error:
         error_traceback = traceback.format_exc()
         my_log.log_groq(f'my_groq:update_mem: {error}\n\n{error_traceback}\n\n{query}\n\n{resp}\n\n{mem}')
-    
-    if chat_id:
-        my_db.set_user_property(chat_id, 'dialog_groq', my_db.obj_to_blob(mem__))
-    else:
-        return mem__
+
+    return mem__
 
 
 def chat(query: str, chat_id: str,
@@ -239,19 +271,14 @@ def chat(query: str, chat_id: str,
          model: str = '',
          style: str = '',
          timeout = 180,
+         stream_callback = None,
          ) -> str:
-    global LOCKS
-    if chat_id in LOCKS:
-        lock = LOCKS[chat_id]
-    else:
-        lock = threading.Lock()
-        LOCKS[chat_id] = lock
-    with lock:
-        mem = my_db.blob_to_obj(my_db.get_user_property(chat_id, 'dialog_groq')) or []
+    with MEM.lock(chat_id):
+        mem = get_mem(chat_id)
         if style:
-            r = ai(query, system = style, mem_ = mem, temperature = temperature, model_ = model, timeout = timeout)
+            r = ai(query, system = style, mem_ = mem, temperature = temperature, model_ = model, timeout = timeout, stream_callback = stream_callback)
         else:
-            r = ai(query, mem_ = mem, temperature = temperature, model_ = model, timeout = timeout)
+            r = ai(query, mem_ = mem, temperature = temperature, model_ = model, timeout = timeout, stream_callback = stream_callback)
         if r:
             # if not model or model == 'llama3-70b-8192': model_ = 'llama3-70b-8192'
             if not model or model == 'llama-3.1-70b-versatile': model_ = 'llama-3.1-70b-versatile'
@@ -264,8 +291,7 @@ def chat(query: str, chat_id: str,
             if model == 'gemma2-9b-it': model_ = 'gemma2-9b-it'
             my_db.add_msg(chat_id, model_)
         if r and update_memory:
-            mem = update_mem(query, r, mem)
-            my_db.set_user_property(chat_id, 'dialog_groq', my_db.obj_to_blob(mem))
+            update_mem(query, r, chat_id)
         return r
 
 
@@ -279,8 +305,7 @@ def reset(chat_id: str):
     Returns:
         None
     """
-    mem = []
-    my_db.set_user_property(chat_id, 'dialog_groq', my_db.obj_to_blob(mem))
+    MEM.reset(chat_id)
 
 
 def undo(chat_id: str):
@@ -296,22 +321,7 @@ def undo(chat_id: str):
     Returns:
         None
     """
-    try:
-        global LOCKS
-
-        if chat_id in LOCKS:
-            lock = LOCKS[chat_id]
-        else:
-            lock = threading.Lock()
-            LOCKS[chat_id] = lock
-        with lock:
-            mem = my_db.blob_to_obj(my_db.get_user_property(chat_id, 'dialog_groq')) or []
-            # remove 2 last lines from mem
-            mem = mem[:-2]
-            my_db.set_user_property(chat_id, 'dialog_groq', my_db.obj_to_blob(mem))
-    except Exception as error:
-        error_traceback = traceback.format_exc()
-        my_log.log_groq(f'Failed to undo chat {chat_id}: {error}\n\n{error_traceback}')
+    MEM.undo(chat_id)
 
 
 def get_mem_as_string(chat_id: str) -> str:
@@ -324,22 +334,7 @@ def get_mem_as_string(chat_id: str) -> str:
     Returns:
         str: The chat history as a string.
     """
-    mem = my_db.blob_to_obj(my_db.get_user_property(chat_id, 'dialog_groq')) or []
-    result = ''
-    for x in mem:
-        role = x['role']
-        if role == 'user': role = '𝐔𝐒𝐄𝐑'
-        if role == 'assistant': role = '𝐁𝐎𝐓'
-
-        text = x['content']
-
-        if text.startswith('[Info to help you answer'):
-            end = text.find(']') + 1
-            text = text[end:].strip()
-        result += f'{role}: {text}\n'
-        if role == '𝐁𝐎𝐓':
-            result += '\n'
-    return result
+    return MEM.as_string(chat_id)
 
 
 def chat_cli(model = ''):
@@ -391,6 +386,7 @@ def stt(data: bytes = None,
     Returns:
         str: Transcribed text.
     """
+    key = ''
     try:
         if not data:
             with open('1.ogg', 'rb') as f:
@@ -404,7 +400,7 @@ def stt(data: bytes = None,
         if key_:
             key = key_
         else:
-            key = random.choice(ALL_KEYS)
+            key = KEYS.pick(ALL_KEYS, 1)[0]
 
         if hasattr(cfg, 'GROQ_PROXIES') and cfg.GROQ_PROXIES:
             client = Groq(
@@ -425,6 +421,8 @@ def stt(data: bytes = None,
     except Exception as error:
         error_traceback = traceback.format_exc()
         my_log.log_groq(f'my_groq:stt: {error}\n\n{error_traceback}\n\n{lang}\n\n{key_}')
+        if key:
+            KEYS.failure(key, str(error))
         if not last_try and "'type': 'internal_server_error'" in str(error):
             time.sleep(4)
             return stt(data, lang, key_, prompt, True)
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# гонка запросов к нескольким ИИ (hedged requests)
+# сначала спрашиваем первого, если он не ответил за обычное для него время (p95)
+# то параллельно спрашиваем следующего, берем первый хороший ответ,
+# опоздавшие доделывают работу в своих потоках и их ответы выкидываются
+
+
+import queue
+import threading
+import time
+import traceback
+
+import my_log
+
+
+# границы корзин гистограммы задержек, секунды
+HISTOGRAM_BOUNDS = (0.5, 1, 2, 3, 5, 8, 13, 20, 30, 45, 60, 90, 120, 180)
+# сколько ответов надо набрать что бы доверять p95
+MIN_SAMPLES = 20
+# задержка перед запуском следующего пока статистики мало
+DEFAULT_DELAY = 20
+MIN_DELAY = 2
+MAX_DELAY = 60
+PERCENTILE = 0.95
+
+# {provider name: Histogram}
+HISTOGRAMS = {}
+HISTOGRAMS_LOCK = threading.Lock()
+
+# сколько раз запускали запасного и сколько раз он выиграл
+STATS = {'calls': 0, 'hedged': 0, 'hedge_won': 0, 'failed': 0}
+
+# у каждого потока гонки свое, см. is_hedged
+LOCAL = threading.local()
+
+
+class Histogram:
+    '''Latency histogram of one provider, only good answers are counted in buckets'''
+    def __init__(self):
+        self.counts = [0] * (len(HISTOGRAM_BOUNDS) + 1)
+        self.total = 0
+        self.errors = 0
+        self.sum = 0.0
+
+    def add(self, seconds: float, ok: bool):
+        if not ok:
+            self.errors += 1
+            return
+        for i, bound in enumerate(HISTOGRAM_BOUNDS):
+            if seconds <= bound:
+                break
+        else:
+            i = len(HISTOGRAM_BOUNDS)
+        self.counts[i] += 1
+        self.total += 1
+        self.sum += seconds
+
+    def percentile(self, p: float) -> float:
+        '''Upper bound of the bucket with p-th percentile, 0 if no data'''
+        if not self.total:
+            return 0
+        need = p * self.total
+        n = 0
+        for i, count in enumerate(self.counts):
+            n += count
+            if n >= need:
+                return HISTOGRAM_BOUNDS[i] if i < len(HISTOGRAM_BOUNDS) else HISTOGRAM_BOUNDS[-1] * 2
+        return HISTOGRAM_BOUNDS[-1] * 2
+
+
+def record(name: str, seconds: float, ok: bool):
+    with HISTOGRAMS_LOCK:
+        if name not in HISTOGRAMS:
+            HISTOGRAMS[name] = Histogram()
+        HISTOGRAMS[name].add(seconds, ok)
+
+
+def count(name: str):
+    with HISTOGRAMS_LOCK:
+        STATS[name] += 1
+
+
+def hedge_delay(name: str) -> float:
+    '''How long to wait for provider before asking the next one'''
+    with HISTOGRAMS_LOCK:
+        histogram = HISTOGRAMS.get(name)
+        if not histogram or histogram.total < MIN_SAMPLES:
+            return DEFAULT_DELAY
+        return min(max(histogram.percentile(PERCENTILE), MIN_DELAY), MAX_DELAY)
+
+
+def is_hedged() -> bool:
+    '''True inside provider function that was started while the previous one
+    was still running, False if it runs alone (the previous ones failed)'''
+    return getattr(LOCAL, 'hedged', False)
+
+
+def hedge(*providers, delay: float = None, is_good = bool, default = '', cancelled: threading.Event = None):
+    '''Ask providers in order, the next one is started when the previous one
+    failed or did not answer in its p95 time (or in delay seconds).
+
+    providers - (name, function without arguments), for example
+                ('gemini', lambda: my_gemini.ai(q)), ('groq', lambda: my_groq.ai(q))
+    is_good - function(result) -> bool, what answer is acceptable
+    default - result if nobody answered
+    cancelled - event that is set when the race is decided, give it to the providers
+                so that losers can skip their side effects (history, counters, tools)
+
+    Inside provider function is_hedged() tells if it runs alongside the previous one.
+
+    Returns (name, result) of the first good answer or ('', default).
+    Functions of losers are not stopped, their results are ignored,
+    so they should not have side effects that conflict with the winner.
+    '''
+    if cancelled is None:
+        cancelled = threading.Event()
+    results = queue.Queue()
+    pending = list(providers)
+    running = 0
+    # кого запустили параллельно с еще работающим предыдущим
+    hedged = set()
+    count('calls')
+
+    def worker(name, func, hedged_):
+        LOCAL.hedged = hedged_
+        start_time = time.time()
+        result = None
+        try:
+            result = func()
+        except Exception as error:
+            error_traceback = traceback.format_exc()
+            my_log.log2(f'my_hedge:hedge: {name} {error}\n\n{error_traceback}')
+        ok = False
+        try:
+            ok = bool(is_good(result))
+        except Exception as error:
+            my_log.log2(f'my_hedge:hedge:is_good: {name} {error}')
+        record(name, time.time() - start_time, ok)
+        results.put((name, result, ok))
+
+    next_start = 0
+    while pending or running:
+        if pending and (not running or time.time() >= next_start):
+            name, func = pending.pop(0)
+            if running:
+                # предыдущий еще думает, запускаем запасного параллельно
+                count('hedged')
+                hedged.add(name)
+            threading.Thread(target=worker, args=(name, func, name in hedged), daemon=True).start()
+            running += 1
+            next_start = time.time() + (delay if delay is not None else hedge_delay(name))
+            continue
+        try:
+            timeout = max(next_start - time.time(), 0) if pending else None
+            name, result, ok = results.get(timeout=timeout)
+        except queue.Empty:
+            continue
+        running -= 1
+        if ok:
+            if name in hedged:
+                count('hedge_won')
+            cancelled.set()
+            return name, result
+        # плохой ответ, следующего запускаем сразу не дожидаясь p95 остальных
+        next_start = 0
+
+    count('failed')
+    cancelled.set()
+    return '', default
+
+
+def get_stats_text() -> str:
+    '''Latency percentiles of providers for /stats'''
+    with HISTOGRAMS_LOCK:
+        lines = []
+        for name, h in sorted(HISTOGRAMS.items()):
+            if not h.total and not h.errors:
+                continue
+            avg = h.sum / h.total if h.total else 0
+            lines.append(f'  {name}: {h.total} ok, {h.errors} bad, avg {avg:.1f}s, p50 {h.percentile(0.5)}s, p95 {h.percentile(PERCENTILE)}s')
+    if not lines:
+        return ''
+    return (f"Hedged requests: {STATS['calls']}, hedged {STATS['hedged']}, "
+            f"hedge won {STATS['hedge_won']}, failed {STATS['failed']}\n" + '\n'.join(lines))
+
+
+if __name__ == '__main__':
+    pass
+
+    # print(hedge(('slow', lambda: time.sleep(5) or 'slow'), ('fast', lambda: 'fast'), delay=1))
+    # print(get_stats_text())
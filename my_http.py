@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# общий пул http соединений для всех модулей
+# вместо requests.get/post надо вызывать my_http.get/post, тогда соединения
+# с хостами переиспользуются (keep-alive) а не открываются заново на каждый запрос
+
+
+import random
+import threading
+import time
+import traceback
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import cfg
+import my_log
+
+
+# сколько разных хостов держать в пуле
+POOL_HOSTS = 50
+# сколько соединений держать открытыми к одному хосту
+POOL_MAXSIZE = 16
+# сколько одновременных запросов к одному хосту, {host: limit} для исключений, 0 - без ограничения.
+# Запросы к api моделей долгие (ответ, картинка) и их число ограничивают ключи и сам сервис,
+# лимит на них только держал бы очередь. В cfg.HTTP_HOST_LIMITS можно добавить свои
+HOST_LIMIT = cfg.HTTP_HOST_LIMIT if hasattr(cfg, 'HTTP_HOST_LIMIT') else 16
+HOST_LIMITS = {
+    'openrouter.ai': 0,
+    'api-inference.huggingface.co': 0,
+}
+if hasattr(cfg, 'GPT4OMINI_URL') and cfg.GPT4OMINI_URL:
+    HOST_LIMITS[urlparse(cfg.GPT4OMINI_URL).hostname] = 0
+if hasattr(cfg, 'HTTP_HOST_LIMITS'):
+    HOST_LIMITS.update(cfg.HTTP_HOST_LIMITS)
+# сколько ждать свободного места в лимите хоста, потом HostBusyError
+HOST_WAIT = 60
+
+# таймаут по умолчанию если не указан
+TIMEOUT = 30
+
+# повторы при ошибках соединения и при 429/5xx ответах.
+# POST повторяются только если не удалось соединиться (запрос еще не отправлен),
+# повтор по статусу и по ошибке чтения только для идемпотентных запросов (GET, HEAD...)
+RETRY = Retry(
+    total=3,
+    connect=3,
+    read=1,
+    status=2,
+    backoff_factor=0.5,
+    status_forcelist=(429, 500, 502, 503, 504),
+    respect_retry_after_header=True,
+    raise_on_status=False,
+)
+
+# {proxy: requests.Session}, '' - без прокси
+SESSIONS = {}
+SESSIONS_LOCK = threading.Lock()
+
+# {host: threading.BoundedSemaphore или None если без ограничения}
+HOST_SEMAPHORES = {}
+
+# {host: {'requests': int, 'errors': int, 'time': float, 'max_time': float}}
+STATS = {}
+STATS_LOCK = threading.Lock()
+
+
+class HostBusyError(requests.exceptions.RequestException):
+    '''Too many requests to the host are running, no free place in HOST_WAIT seconds'''
+
+
+def new_session(proxy: str = '') -> requests.Session:
+    '''Create session with keep-alive pool and retry policy'''
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=POOL_HOSTS, pool_maxsize=POOL_MAXSIZE, max_retries=RETRY)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    if proxy:
+        session.proxies.update({'http': proxy, 'https': proxy})
+    return session
+
+
+def get_session(proxy: str = '') -> requests.Session:
+    '''Shared session for proxy ('' - direct connection)'''
+    with SESSIONS_LOCK:
+        if proxy not in SESSIONS:
+            SESSIONS[proxy] = new_session(proxy)
+        return SESSIONS[proxy]
+
+
+def bing_proxy() -> str:
+    '''Random proxy from cfg.bing_proxy or empty string'''
+    if hasattr(cfg, 'bing_proxy') and cfg.bing_proxy:
+        return random.choice(cfg.bing_proxy)
+    return ''
+
+
+def host_semaphore(host: str) -> threading.BoundedSemaphore:
+    with SESSIONS_LOCK:
+        if host not in HOST_SEMAPHORES:
+            limit = HOST_LIMITS.get(host, HOST_LIMIT)
+            HOST_SEMAPHORES[host] = threading.BoundedSemaphore(limit) if limit else None
+        return HOST_SEMAPHORES[host]
+
+
+def update_stats(host: str, elapsed: float, error: bool):
+    with STATS_LOCK:
+        if host not in STATS:
+            STATS[host] = {'requests': 0, 'errors': 0, 'time': 0.0, 'max_time': 0.0}
+        s = STATS[host]
+        s['requests'] += 1
+        s['time'] += elapsed
+        s['max_time'] = max(s['max_time'], elapsed)
+        if error:
+            s['errors'] += 1
+
+
+def request(method: str, url: str, proxy: str = '', **kwargs) -> requests.Response:
+    '''Same as requests.request but uses shared connection pool.
+
+    proxy - proxy url, the same proxy for http and https, '' - no proxy
+    timeout - default TIMEOUT
+    With stream=True response must be closed (use it as context manager)
+    otherwise connection does not return to the pool.
+    Raises requests exceptions like requests.request, HostBusyError if
+    there are too many requests to the host (see HOST_LIMIT).
+    '''
+    kwargs.setdefault('timeout', TIMEOUT)
+    host = urlparse(url).hostname or ''
+    start_time = time.time()
+    error = True
+    try:
+        semaphore = host_semaphore(host)
+        if semaphore and not semaphore.acquire(timeout=HOST_WAIT):
+            raise HostBusyError(f'my_http: too many requests to {host}')
+        try:
+            response = get_session(proxy).request(method, url, **kwargs)
+        finally:
+            if semaphore:
+                semaphore.release()
+        error = response.status_code >= 400
+        return response
+    finally:
+        update_stats(host, time.time() - start_time, error)
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    return request('GET', url, **kwargs)
+
+
+def post(url: str, **kwargs) -> requests.Response:
+    return request('POST', url, **kwargs)
+
+
+def get_pools_stats() -> dict:
+    '''{host: (requests, new connections)} from urllib3 pools of all sessions'''
+    result = {}
+    with SESSIONS_LOCK:
+        sessions = list(SESSIONS.values())
+    for session in sessions:
+        for adapter in set(session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                requests_, connections = result.get(pool.host, (0, 0))
+                result[pool.host] = (requests_ + pool.num_requests, connections + pool.num_connections)
+    return result
+
+
+def get_stats() -> dict:
+    '''Per host stats
+    {host: {'requests', 'errors', 'avg_time', 'max_time', 'reused'}}
+    reused - share of requests that used already opened connection
+    '''
+    try:
+        pools = get_pools_stats()
+        result = {}
+        with STATS_LOCK:
+            for host, s in STATS.items():
+                pool_requests, pool_connections = pools.get(host, (0, 0))
+                reused = (pool_requests - pool_connections) / pool_requests if pool_requests else 0
+                result[host] = {
+                    'requests': s['requests'],
+                    'errors': s['errors'],
+                    'avg_time': s['time'] / s['requests'],
+                    'max_time': s['max_time'],
+                    'reused': max(reused, 0),
+                }
+        return result
+    except Exception as error:
+        error_traceback = traceback.format_exc()
+        my_log.log2(f'my_http:get_stats: {error}\n\n{error_traceback}')
+        return {}
+
+
+def get_stats_text(top: int = 5) -> str:
+    '''Short text report for /stats, top hosts by number of requests'''
+    stats = get_stats()
+    if not stats:
+        return ''
+    total = sum(x['requests'] for x in stats.values())
+    result = f'HTTP: {total} requests to {len(stats)} hosts\n'
+    for host, s in sorted(stats.items(), key=lambda x: x[1]['requests'], reverse=True)[:top]:
+        result += f"  {host}: {s['requests']} req, {s['errors']} err, avg {s['avg_time']:.2f}s, max {s['max_time']:.2f}s, reused {s['reused']*100:.0f}%\n"
+    return result
+
+
+if __name__ == '__main__':
+    pass
+
+    # for _ in range(3):
+    #     print(get('https://example.com').status_code)
+    # print(get_stats_text())
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+# планировщик тяжелых задач (рисование, пересказ, распознавание голоса и т.д.)
+# у каждого типа задач свой пул слотов, один юзер может выполнять только одну
+# задачу каждого типа за раз, остальные его задачи ждут в очереди.
+# Из очереди первыми берутся задачи с большим приоритетом (админы, короткие чаты),
+# среди равных - задача того юзера которого обслуживали давнее всех,
+# так что один активный юзер не может занять все слоты.
+# Ждущая задача это просто запись в очереди, а не поток, в пул своего типа
+# она попадает только когда для нее освободился слот
+
+
+import concurrent.futures
+import itertools
+import threading
+import time
+import traceback
+
+import my_log
+
+
+# {тип задачи: сколько таких задач может выполняться одновременно}
+JOB_CLASSES = {
+    'chat': 50,
+    'image': 10,
+    'sum': 10,
+    'voice': 10,
+    'document': 10,
+    'photo': 10,
+    'google': 10,
+    'tts': 10,
+}
+# для неизвестных типов
+DEFAULT_WORKERS = 10
+
+# меньше - раньше
+PRIORITY_ADMIN = 0
+PRIORITY_HIGH = 1
+PRIORITY_NORMAL = 2
+
+# last_served чистится от юзеров которых не обслуживали дольше часа,
+# не чаще раза в минуту и только если в нем больше LAST_SERVED_MAX записей
+LAST_SERVED_MAX = 1000
+LAST_SERVED_TTL = 60 * 60
+LAST_SERVED_PRUNE_EVERY = 60
+
+# все очереди под одной блокировкой, операции с ними очень короткие
+LOCK = threading.Lock()
+SEQ = itertools.count()
+CLASSES = {}
+
+# сообщения о месте в очереди (обычно это запросы к телеграму) отправляются
+# отдельными потоками, а не под блокировкой и не в потоке закончившейся задачи
+NOTIFY_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix='jobs-notify')
+
+
+class Ticket:
+    '''Job waiting in the queue, it is not a thread, just a function with arguments'''
+    def __init__(self, priority: int, user: str, func, args: tuple, kwargs: dict, on_wait):
+        self.priority = priority
+        self.user = user
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.on_wait = on_wait
+        self.seq = next(SEQ)
+        self.time = time.time()
+        self.future = concurrent.futures.Future()
+        # последнее место в очереди о котором сообщили, 0 - не сообщали
+        self.position = 0
+        self.waited = False
+        # on_wait вызывается по очереди, пока он работает новые места копятся тут
+        self.pending = None
+        self.notifying = False
+
+
+class JobClass:
+    '''Queue and running jobs of one type, must be used with LOCK.
+    Jobs run in its own pool with as many threads as slots, a job is given
+    to the pool only when there is a free slot for it, so no thread waits'''
+    def __init__(self, name: str, workers: int):
+        self.name = name
+        self.workers = workers
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f'job-{name}')
+        # {user: сколько задач выполняется}
+        self.running = {}
+        self.waiting = []
+        # {user: когда последний раз запустили его задачу}
+        self.last_served = {}
+        self.last_prune = time.time()
+        self.stats = {'done': 0, 'waited': 0, 'wait_time': 0.0, 'max_wait_time': 0.0, 'max_queue': 0}
+
+    def key(self, ticket: Ticket) -> tuple:
+        return (ticket.priority, self.last_served.get(ticket.user, 0), ticket.seq)
+
+    def full(self) -> bool:
+        return sum(self.running.values()) >= self.workers
+
+    def next_ticket(self) -> Ticket:
+        '''The best job that can run now or None'''
+        if self.full():
+            return None
+        candidates = [x for x in self.waiting if x.user not in self.running]
+        if not candidates:
+            return None
+        return min(candidates, key=self.key)
+
+    def grant(self, ticket: Ticket):
+        self.waiting.remove(ticket)
+        self.running[ticket.user] = self.running.get(ticket.user, 0) + 1
+        now = time.time()
+        self.last_served[ticket.user] = now
+        self.prune(now)
+        wait_time = now - ticket.time
+        self.stats['wait_time'] += wait_time
+        self.stats['max_wait_time'] = max(self.stats['max_wait_time'], wait_time)
+
+    def prune(self, now: float):
+        '''Forget users that were served long ago, for them the queue is fair anyway'''
+        if len(self.last_served) <= LAST_SERVED_MAX or now - self.last_prune < LAST_SERVED_PRUNE_EVERY:
+            return
+        self.last_prune = now
+        busy = set(self.running) | {x.user for x in self.waiting}
+        for user, served in list(self.last_served.items()):
+            if served < now - LAST_SERVED_TTL and user not in busy:
+                del self.last_served[user]
+
+    def positions(self) -> dict:
+        '''{ticket: place in the queue, starting from 1}'''
+        return {x: n for n, x in enumerate(sorted(self.waiting, key=self.key), 1)}
+
+    def release(self, user: str):
+        self.running[user] -= 1
+        if not self.running[user]:
+            del self.running[user]
+        self.stats['done'] += 1
+
+
+def get_class(name: str) -> JobClass:
+    if name not in CLASSES:
+        CLASSES[name] = JobClass(name, JOB_CLASSES.get(name, DEFAULT_WORKERS))
+    return CLASSES[name]
+
+
+def schedule(job_class: JobClass) -> list:
+    '''Give free slots to the best waiting jobs, must be called with LOCK.
+    Returns [(ticket, position), ...] - changed places in the queue to report
+    (position 0 - the job has started), see notify'''
+    changes = []
+    while True:
+        ticket = job_class.next_ticket()
+        if not ticket:
+            break
+        job_class.grant(ticket)
+        if ticket.waited:
+            job_class.stats['waited'] += 1
+        if ticket.position:
+            changes.append((ticket, 0))
+        job_class.executor.submit(run, job_class, ticket)
+    # место в очереди сообщается только если все слоты заняты, если юзер ждет
+    # окончания своей же предыдущей задачи то очередь тут ни при чем
+    if job_class.full():
+        for ticket, position in job_class.positions().items():
+            if ticket.on_wait and position != ticket.position:
+                ticket.position = position
+                changes.append((ticket, position))
+    return changes
+
+
+def notify(changes: list):
+    for ticket, position in changes:
+        with LOCK:
+            ticket.pending = position
+            if ticket.notifying:
+                continue
+            ticket.notifying = True
+        NOTIFY_POOL.submit(call_on_wait, ticket)
+
+
+def call_on_wait(ticket: Ticket):
+    '''Report places of the ticket one by one, only the last one if several were queued'''
+    while True:
+        with LOCK:
+            position = ticket.pending
+            ticket.pending = None
+            if position is None:
+                ticket.notifying = False
+                return
+        try:
+            ticket.on_wait(position)
+        except Exception as error:
+            my_log.log2(f'my_jobs:on_wait: {error}')
+
+
+def run(job_class: JobClass, ticket: Ticket):
+    try:
+        ticket.future.set_result(ticket.func(*ticket.args, **ticket.kwargs))
+    except Exception as error:
+        error_traceback = traceback.format_exc()
+        my_log.log2(f'my_jobs:run: {job_class.name} {getattr(ticket.func, "__name__", ticket.func)} {error}\n\n{error_traceback}')
+        ticket.future.set_result(None)
+    finally:
+        with LOCK:
+            job_class.release(ticket.user)
+            changes = schedule(job_class)
+        notify(changes)
+
+
+def submit(job: str,
+           user: str,
+           func,
+           args: tuple = (),
+           kwargs: dict = None,
+           priority: int = PRIORITY_NORMAL,
+           on_wait = None) -> concurrent.futures.Future:
+    '''Queue func(*args, **kwargs) as a job of the user, returns future with its result
+    (None if func raised an exception, it is logged). Does not block, the job
+    waits in the queue as a ticket and runs in the pool of its job type.
+
+    job - type of the job, see JOB_CLASSES
+    user - who runs the job (chat_id_full), one job of each type per user at a time
+    priority - PRIORITY_ADMIN, PRIORITY_HIGH or PRIORITY_NORMAL
+    on_wait - function(position) called when the job has to wait because all
+              slots are busy and then every time its place in the queue changes,
+              position 0 means the job has started, for example to tell user
+              his place in queue and remove this message later
+    '''
+    with LOCK:
+        job_class = get_class(job)
+        ticket = Ticket(priority, user, func, args, kwargs or {}, on_wait)
+        job_class.waiting.append(ticket)
+        job_class.stats['max_queue'] = max(job_class.stats['max_queue'], len(job_class.waiting))
+        changes = schedule(job_class)
+        ticket.waited = ticket in job_class.waiting
+    notify(changes)
+    return ticket.future
+
+
+def get_stats_text() -> str:
+    '''Queue depth and waits of job types for /stats'''
+    lines = []
+    with LOCK:
+        for name, c in sorted(CLASSES.items()):
+            started = c.stats['done'] + sum(c.running.values())
+            avg_wait = c.stats['wait_time'] / started if started else 0
+            lines.append(f"  {name}: {sum(c.running.values())}/{c.workers} running, {len(c.waiting)} queued "
+                         f"(max {c.stats['max_queue']}), done {c.stats['done']}, waited {c.stats['waited']}, "
+                         f"wait avg {avg_wait:.1f}s max {c.stats['max_wait_time']:.0f}s")
+    if not lines:
+        return ''
+    return 'Jobs:\n' + '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    pass
+
+    # for u in ('a', 'a', 'a', 'b', 'c'):
+    #     submit('image', u, time.sleep, (1,), on_wait=lambda n, u=u: print(u, 'in queue', n))
+    # time.sleep(5)
+    # print(get_stats_text())
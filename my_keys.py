@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# пул api ключей со статистикой и паузами для ключей которые упираются в лимиты
+# ключи по прежнему хранятся в ALL_KEYS модулей, KeyPool только решает в каком
+# порядке их пробовать и какие временно не трогать
+
+
+import random
+import threading
+import time
+
+
+# пауза для ключа после 429/rate limit, удваивается при повторах
+RATE_LIMIT_COOLDOWN = 60
+MAX_COOLDOWN = 60 * 60
+# пауза для ключа с исчерпанной квотой (суточный/месячный лимит)
+QUOTA_COOLDOWN = 6 * 60 * 60
+# после скольких ошибок подряд ставить на паузу ключ который падает по другим причинам
+FAIL_STREAK = 3
+FAIL_COOLDOWN = 5 * 60
+
+RATE_LIMIT_ERRORS = ('error code: 429', 'rate limit', 'resource has been exhausted', 'too many requests', 'rate_limit_exceeded')
+QUOTA_ERRORS = ('quota exceeded', 'exceeded your current quota', 'quota for this billing period', 'free usage limit')
+
+# все созданные пулы, для /stats
+POOLS = []
+
+
+class KeyPool:
+    '''Health-aware order of API keys.
+
+    pick() returns keys healthiest first: keys in cooldown and keys without
+    tokens in their bucket (rpm) go last, then by errors in a row and by how
+    long ago the key failed, keys with equal health are shuffled to spread load.
+    The first key gets its token taken right in pick(), so concurrent callers
+    do not all get the same almost empty key.
+    Callers report the result with success() or failure(), failure gives the token back.
+
+    name - name for /stats
+    rpm - requests per minute allowed for one key, 0 - unknown
+    '''
+    def __init__(self, name: str, rpm: int = 0):
+        self.name = name
+        self.rpm = rpm
+        self.lock = threading.Lock()
+        # {key: dict}
+        self.keys = {}
+        POOLS.append(self)
+
+    def state(self, key: str) -> dict:
+        '''Must be called with lock'''
+        if key not in self.keys:
+            self.keys[key] = {'ok': 0, 'errors': 0, 'rate_limited': 0, 'streak': 0,
+                              'last_fail': 0.0, 'cooldown': 0.0, 'latency': 0.0,
+                              'tokens': float(self.rpm), 'tokens_time': time.time(),
+                              # сколько токенов взято в pick() и еще не отчитано
+                              'reserved': 0}
+        return self.keys[key]
+
+    def bucket(self, state: dict, now: float) -> float:
+        '''Refill token bucket and return tokens available'''
+        if self.rpm:
+            state['tokens'] = min(self.rpm, state['tokens'] + (now - state['tokens_time']) * self.rpm / 60)
+            state['tokens_time'] = now
+        return state['tokens']
+
+    def pick(self, keys: list, n: int = 0) -> list:
+        '''Sort keys healthiest first, n - return only first n keys (0 - all).
+        Keys in cooldown are returned only if there are not enough healthy ones.'''
+        now = time.time()
+        with self.lock:
+            ranked = []
+            for key in set(keys):
+                s = self.state(key)
+                cooldown = s['cooldown'] if s['cooldown'] > now else 0
+                # давние ошибки не важны
+                last_fail = s['last_fail'] if s['last_fail'] > now - MAX_COOLDOWN else 0
+                ranked.append((cooldown,
+                               bool(self.rpm) and self.bucket(s, now) < 1,
+                               s['streak'],
+                               last_fail,
+                               random.random(),
+                               key))
+            ranked.sort()
+            result = [x[-1] for x in ranked]
+            # первый ключ будет использован сразу, токен берем пока держим lock
+            if result and self.rpm:
+                s = self.keys[result[0]]
+                self.use(s)
+                s['reserved'] += 1
+        return result[:n] if n else result
+
+    def use(self, state: dict):
+        if self.rpm:
+            self.bucket(state, time.time())
+            state['tokens'] = max(state['tokens'] - 1, 0)
+
+    def success(self, key: str, latency: float = 0):
+        with self.lock:
+            s = self.state(key)
+            if s['reserved']:
+                s['reserved'] -= 1
+            else:
+                self.use(s)
+            s['ok'] += 1
+            s['streak'] = 0
+            s['cooldown'] = 0.0
+            s['latency'] = latency if not s['latency'] else s['latency'] * 0.8 + latency * 0.2
+
+    def failure(self, key: str, error: str = ''):
+        '''Report failed request, rate limit and quota errors put the key on pause'''
+        error = str(error).lower()
+        now = time.time()
+        with self.lock:
+            s = self.state(key)
+            # неудачный запрос лимит не тратит, возвращаем токен взятый в pick()
+            if s['reserved']:
+                s['reserved'] -= 1
+                s['tokens'] = min(s['tokens'] + 1, self.rpm)
+            s['errors'] += 1
+            s['streak'] += 1
+            s['last_fail'] = now
+            if any(x in error for x in QUOTA_ERRORS):
+                s['rate_limited'] += 1
+                s['cooldown'] = now + QUOTA_COOLDOWN
+            elif any(x in error for x in RATE_LIMIT_ERRORS):
+                s['rate_limited'] += 1
+                s['cooldown'] = now + min(RATE_LIMIT_COOLDOWN * 2 ** (s['streak'] - 1), MAX_COOLDOWN)
+            elif s['streak'] >= FAIL_STREAK:
+                s['cooldown'] = now + FAIL_COOLDOWN
+
+    def remove(self, key: str):
+        with self.lock:
+            self.keys.pop(key, None)
+
+    def get_stats(self) -> dict:
+        now = time.time()
+        with self.lock:
+            ok = sum(x['ok'] for x in self.keys.values())
+            errors = sum(x['errors'] for x in self.keys.values())
+            latencies = [x['latency'] for x in self.keys.values() if x['latency']]
+            return {
+                'keys': len(self.keys),
+                'cooldown': sum(1 for x in self.keys.values() if x['cooldown'] > now),
+                'ok': ok,
+                'errors': errors,
+                'rate_limited': sum(x['rate_limited'] for x in self.keys.values()),
+                'success_rate': ok / (ok + errors) if ok + errors else 0,
+                'latency': sum(latencies) / len(latencies) if latencies else 0,
+            }
+
+    def get_stats_text(self) -> str:
+        s = self.get_stats()
+        return (f"{self.name} keys: {s['keys']}, on pause {s['cooldown']}, ok {s['ok']}, "
+                f"errors {s['errors']} (rate limit {s['rate_limited']}), "
+                f"success {s['success_rate']:.0%}, avg {s['latency']:.1f}s")
+
+
+def get_stats_text() -> str:
+    '''Stats of all pools for /stats'''
+    return '\n'.join(pool.get_stats_text() for pool in POOLS)
+
+
+if __name__ == '__main__':
+    pass
+
+    # pool = KeyPool('test', rpm=2)
+    # pool.failure('a', '429 Resource has been exhausted')
+    # pool.success('b', 1.5)
+    # print(pool.pick(['a', 'b', 'c']))
+    # print(get_stats_text())
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# дисковый кеш файлов скачанных из телеграма и результатов их распознавания
+# ключ - file_unique_id, он одинаковый у одного и того же файла во всех чатах,
+# так что пересланные много раз голосовые, картинки и документы скачиваются
+# и распознаются только один раз. Старые файлы удаляются когда кеш больше MAX_SIZE.
+# Распознанная речь хранится не тут а в my_db (stt_cache по хешу звука)
+
+
+import collections
+import hashlib
+import os
+import re
+import threading
+import traceback
+
+import my_log
+
+
+CACHE_DIR = os.path.join('db', 'media_cache')
+# общий размер кеша
+MAX_SIZE = 1024 * 1024 * 1024
+# файлы больше этого не кешируются (бот все равно не может скачать больше 20мб)
+MAX_FILE_SIZE = 20 * 1024 * 1024
+
+# {имя файла: размер}, в порядке последнего использования
+INDEX = collections.OrderedDict()
+INDEX_LOCK = threading.Lock()
+LOADED = False
+TOTAL_SIZE = 0
+
+STATS = {'hits': 0, 'misses': 0, 'results_hits': 0, 'results_misses': 0, 'evicted': 0}
+
+
+def load():
+    '''Read existing cache files into index, oldest first. Must be called with INDEX_LOCK'''
+    global LOADED, TOTAL_SIZE
+    if LOADED:
+        return
+    LOADED = True
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    files = []
+    for entry in os.scandir(CACHE_DIR):
+        if entry.name.endswith('.tmp'):
+            # недописанный файл от прошлого запуска
+            os.remove(entry.path)
+        elif entry.is_file():
+            stat = entry.stat()
+            files.append((stat.st_mtime, entry.name, stat.st_size))
+    for _, name, size in sorted(files):
+        INDEX[name] = size
+        TOTAL_SIZE += size
+
+
+def file_name(key: str) -> str:
+    return re.sub(r'[^\w.-]', '_', key)[:200]
+
+
+def read(key: str) -> bytes:
+    '''Cached data for key or b'' '''
+    name = file_name(key)
+    try:
+        with INDEX_LOCK:
+            load()
+            if name not in INDEX:
+                return b''
+            INDEX.move_to_end(name)
+        path = os.path.join(CACHE_DIR, name)
+        with open(path, 'rb') as f:
+            data = f.read()
+        # время изменения файла это время последнего использования, нужно после перезапуска
+        os.utime(path)
+        return data
+    except Exception as error:
+        my_log.log2(f'my_mediacache:read: {key} {error}')
+        with INDEX_LOCK:
+            remove(name)
+        return b''
+
+
+def count(name: str):
+    with INDEX_LOCK:
+        STATS[name] += 1
+
+
+def get(key: str) -> bytes:
+    '''Cached file for key (file_unique_id) or b'' '''
+    data = read(key)
+    count('hits' if data else 'misses')
+    return data
+
+
+def put(key: str, data: bytes):
+    '''Save data for key, evict least recently used files if cache is too big'''
+    global TOTAL_SIZE
+    if not data or len(data) > MAX_FILE_SIZE:
+        return
+    name = file_name(key)
+    try:
+        path = os.path.join(CACHE_DIR, name)
+        with INDEX_LOCK:
+            load()
+        # пишем во временный файл и переименовываем что бы никто не прочитал недописанный
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with INDEX_LOCK:
+            TOTAL_SIZE -= INDEX.pop(name, 0)
+            INDEX[name] = len(data)
+            TOTAL_SIZE += len(data)
+            while TOTAL_SIZE > MAX_SIZE and len(INDEX) > 1:
+                remove(next(iter(INDEX)))
+                STATS['evicted'] += 1
+    except Exception as error:
+        error_traceback = traceback.format_exc()
+        my_log.log2(f'my_mediacache:put: {key} {error}\n\n{error_traceback}')
+
+
+def remove(name: str):
+    '''Delete file from cache, must be called with INDEX_LOCK'''
+    global TOTAL_SIZE
+    TOTAL_SIZE -= INDEX.pop(name, 0)
+    try:
+        os.remove(os.path.join(CACHE_DIR, name))
+    except FileNotFoundError:
+        pass
+    except Exception as error:
+        my_log.log2(f'my_mediacache:remove: {name} {error}')
+
+
+def result_key(file_unique_id: str, kind: str, params: str = '') -> str:
+    '''Key of recognition result, params - everything that changes the result (language, prompt)'''
+    return f'{file_unique_id}.{kind}.{hashlib.md5(params.encode()).hexdigest()[:16]}'
+
+
+def get_result(file_unique_id: str, kind: str, params: str = '') -> str:
+    '''Cached result of recognition of the file (kind - 'ocr', 'img2txt'...) or '' '''
+    if not file_unique_id:
+        return ''
+    data = read(result_key(file_unique_id, kind, params))
+    count('results_hits' if data else 'results_misses')
+    return data.decode('utf-8', errors='replace')
+
+
+def put_result(file_unique_id: str, kind: str, text: str, params: str = ''):
+    if file_unique_id and text:
+        put(result_key(file_unique_id, kind, params), text.encode('utf-8'))
+
+
+def get_file_path(file_unique_id: str) -> str:
+    '''Telegram file_path of the cached file (it has the extension) or '',
+    it is not a recognition result and is not counted in stats'''
+    return read(f'{file_unique_id}.path').decode('utf-8', errors='replace')
+
+
+def put_file_path(file_unique_id: str, file_path: str):
+    if file_unique_id and file_path:
+        put(f'{file_unique_id}.path', file_path.encode('utf-8'))
+
+
+def get_stats_text() -> str:
+    '''Short text report for /stats'''
+    with INDEX_LOCK:
+        files = STATS['hits'] + STATS['misses']
+        results = STATS['results_hits'] + STATS['results_misses']
+        return (f"Media cache: {len(INDEX)} items, {TOTAL_SIZE / 1024 / 1024:.0f}/{MAX_SIZE / 1024 / 1024:.0f} MB, "
+                f"files hit {STATS['hits'] / files if files else 0:.0%} of {files}, "
+                f"results hit {STATS['results_hits'] / results if results else 0:.0%} of {results}, "
+                f"evicted {STATS['evicted']}")
+
+
+if __name__ == '__main__':
+    pass
+
+    # put('test', b'123')
+    # print(get('test'))
+    # put_result('test', 'ocr', 'текст', 'rus')
+    # print(get_result('test', 'ocr', 'rus'))
+    # print(get_stats_text())
@@ -1,15 +1,15 @@
 #!/usr/bin/env python3
 
 import json
-import requests
-import threading
 import traceback
 
 import langcodes
 from sqlitedict import SqliteDict
 
 import cfg
+import my_chatmem
 import my_db
+import my_http
 import my_log
 
 
@@ -23,9 +23,9 @@ PARAMS_DEFAULT = ['google/gemma-2-9b-it:free', 1, 4000, 20, 12000]
 MAX_MEM_LINES = 10
 
 
-# блокировка чатов что бы не испортить историю 
-# {id:lock}
-LOCKS = {}
+# память диалогов и блокировки чатов что бы не испортить историю,
+# размер истории у каждого юзера свой, см. PARAMS
+MEM = my_chatmem.ChatMemory('openrouter', limits=lambda chat_id: get_mem_limits(chat_id), log=my_log.log_openrouter)
 
 # не принимать запросы больше чем, это ограничение для телеграм бота, в этом модуле оно не используется
 MAX_REQUEST = 1000000
@@ -46,27 +46,10 @@ MEM_UNCENSORED = [
 ]
 
 
-def clear_mem(mem, user_id: str):
-    if user_id not in PARAMS:
-        PARAMS[user_id] = ['meta-llama/llama-3-8b-instruct:free', 1, 2000, 5, 6000]
-    model, temperature, max_tokens, maxhistlines, maxhistchars = PARAMS[user_id]
-
-    while 1:
-        sizeofmem = count_tokens(mem)
-        if sizeofmem <= maxhistchars:
-            break
-        try:
-            mem = mem[2:]
-        except IndexError:
-            mem = []
-            break
-
-    return mem[-maxhistlines*2:]
-    #return mem[-MAX_MEM_LINES*2:]
-
-
-def count_tokens(mem) -> int:
-    return sum([len(m['content']) for m in mem])
+def get_mem_limits(chat_id: str):
+    '''(max lines, max chars) of chat history for user'''
+    _, _, _, maxhistlines, maxhistchars = PARAMS[chat_id] if chat_id in PARAMS else PARAMS_DEFAULT
+    return maxhistlines*2, maxhistchars
 
 
 def ai(prompt: str = '',
@@ -76,7 +59,11 @@ def ai(prompt: str = '',
        model = '',
        temperature: float = 1,
        max_tokens: int = 8000,
-       timeout: int = 120) -> str:
+       timeout: int = 120,
+       stream_callback = None) -> str:
+    '''Returns (http status, answer text).
+    stream_callback - if set the answer is streamed and stream_callback(text)
+                      is called with the text received so far'''
 
     if not prompt and not mem:
         return 0, ''
@@ -121,7 +108,7 @@ def ai(prompt: str = '',
     YOUR_SITE_URL = 'https://t.me/kun4sun_bot'
     YOUR_APP_NAME = 'kun4sun_bot'
 
-    response = requests.post(
+    response = my_http.post(
         url="https://openrouter.ai/api/v1/chat/completions",
         headers={
             "Authorization": f"Bearer {key}",
@@ -133,12 +120,17 @@ def ai(prompt: str = '',
             "messages": mem_,
             "max_tokens": max_tokens,
             "temperature": temperature,
+            "stream": bool(stream_callback),
         }),
         timeout = timeout,
+        stream = bool(stream_callback),
     )
 
     status = response.status_code
-    if status == 200:
+    if status == 200 and stream_callback:
+        with response:
+            text = read_stream(response, stream_callback)
+    elif status == 200:
         try:
             text = response.json()['choices'][0]['message']['content'].strip()
         except Exception as error:
@@ -149,42 +141,49 @@ def ai(prompt: str = '',
     return status, text
 
 
-def update_mem(query: str, resp: str, chat_id: str):
-    mem = my_db.blob_to_obj(my_db.get_user_property(chat_id, 'dialog_openrouter')) or []
-    mem += [{'role': 'user', 'content': query}]
-    mem += [{'role': 'assistant', 'content': resp}]
-    mem = clear_mem(mem, chat_id)
-
-    mem__ = []
+def read_stream(response, callback) -> str:
+    '''Collect server-sent events of streamed completion,
+    callback(text) is called with the text received so far'''
+    text = ''
     try:
-        i = 0
-        while i < len(mem):
-            if i == 0 or mem[i] != mem[i-1]:
-                mem__.append(mem[i])
-            i += 1
+        for line in response.iter_lines(decode_unicode=True):
+            # пустые строки и комментарии ': OPENROUTER PROCESSING' пропускаем
+            if not line or not line.startswith('data:'):
+                continue
+            data = line[5:].strip()
+            if data == '[DONE]':
+                break
+            try:
+                delta = json.loads(data)['choices'][0]['delta'].get('content')
+            except (ValueError, KeyError, IndexError):
+                continue
+            if delta:
+                text += delta
+                try:
+                    callback(text)
+                except Exception as error:
+                    my_log.log_openrouter(f'my_openrouter:read_stream: callback error {error}')
     except Exception as error:
-        error_traceback = traceback.format_exc()
-        my_log.log_openrouter(f'my_openrouter:update_mem: {error}\n\n{error_traceback}\n\n{query}\n\n{resp}\n\n{mem}')
+        my_log.log_openrouter(f'my_openrouter:read_stream: {error}')
+    return text.strip()
 
-    my_db.set_user_property(chat_id, 'dialog_openrouter', my_db.obj_to_blob(mem__))
 
+def get_mem(chat_id: str) -> list:
+    '''Get chat history for chat_id as list of messages'''
+    return MEM.get(chat_id)
 
-def chat(query: str, chat_id: str = '', temperature: float = 1, system: str = '', model: str = '') -> str:
-    global LOCKS
-    if chat_id in LOCKS:
-        lock = LOCKS[chat_id]
-    else:
-        lock = threading.Lock()
-        LOCKS[chat_id] = lock
-    with lock:
-        mem = my_db.blob_to_obj(my_db.get_user_property(chat_id, 'dialog_openrouter')) or []
-        status_code, text = ai(query, mem, user_id=chat_id, temperature = temperature, system=system, model=model)
+
+def update_mem(query: str, resp: str, chat_id: str):
+    MEM.update(chat_id, query, resp)
+
+
+def chat(query: str, chat_id: str = '', temperature: float = 1, system: str = '', model: str = '', stream_callback = None) -> str:
+    with MEM.lock(chat_id):
+        mem = get_mem(chat_id)
+        status_code, text = ai(query, mem, user_id=chat_id, temperature = temperature, system=system, model=model, stream_callback=stream_callback)
         if text:
             my_db.add_msg(chat_id, 'openrouter')
-            mem += [{'role': 'user', 'content': query}]
-            mem += [{'role': 'assistant', 'content': text}]
-            mem = clear_mem(mem, chat_id)
-            my_db.set_user_property(chat_id, 'dialog_openrouter', my_db.obj_to_blob(mem))
+            update_mem(query, text, chat_id)
         return status_code, text
 
 
@@ -211,22 +210,7 @@ def undo(chat_id: str):
     Returns:
         None
     """
-    try:
-        global LOCKS
-
-        if chat_id in LOCKS:
-            lock = LOCKS[chat_id]
-        else:
-            lock = threading.Lock()
-            LOCKS[chat_id] = lock
-        with lock:
-            mem = my_db.blob_to_obj(my_db.get_user_property(chat_id, 'dialog_openrouter')) or []
-            # remove 2 last lines from mem
-            mem = mem[:-2]
-            my_db.set_user_property(chat_id, 'dialog_openrouter', my_db.obj_to_blob(mem))
-    except Exception as error:
-        error_traceback = traceback.format_exc()
-        my_log.log_openrouter(f'Failed to undo chat {chat_id}: {error}\n\n{error_traceback}')
+    MEM.undo(chat_id)
 
 
 def reset(chat_id: str):
@@ -239,8 +223,7 @@ def reset(chat_id: str):
     Returns:
         None
     """
-    mem = []
-    my_db.set_user_property(chat_id, 'dialog_openrouter', my_db.obj_to_blob(mem))
+    MEM.reset(chat_id)
 
 
 def get_mem_as_string(chat_id: str) -> str:
@@ -253,26 +236,7 @@ def get_mem_as_string(chat_id: str) -> str:
     Returns:
         str: The chat history as a string.
     """
-    try:
-        mem = my_db.blob_to_obj(my_db.get_user_property(chat_id, 'dialog_openrouter')) or []
-        result = ''
-        for x in mem:
-            role = x['role']
-            if role == 'user': role = '𝐔𝐒𝐄𝐑'
-            if role == 'assistant': role = '𝐁𝐎𝐓'
-            if role == 'system': role = '𝐒𝐘𝐒𝐓𝐄𝐌'
-            text = x['content']
-            if text.startswith('[Info to help you answer'):
-                end = text.find(']') + 1
-                text = text[end:].strip()
-            result += f'{role}: {text}\n'
-            if role == '𝐁𝐎𝐓':
-                result += '\n'
-        return result 
-    except Exception as error:
-        error_traceback = traceback.format_exc()
-        my_log.log_openrouter(f'my_openrouter:get_mem_as_string: {error}\n\n{error_traceback}')
-        return ''
+    return MEM.as_string(chat_id)
 
 
 def sum_big_text(text:str, query: str, temperature: float = 1, model: str = '', max_size: int = None) -> str:
@@ -2,7 +2,6 @@
 
 import json
 import random
-import requests
 import threading
 import traceback
 
@@ -10,7 +9,9 @@ import langcodes
 from sqlitedict import SqliteDict
 
 import cfg
+import my_chatmem
 import my_db
+import my_http
 import my_log
 
 
@@ -23,9 +24,8 @@ maxhistchars = 11000
 BIG_LOCK = threading.Lock()
 
 
-# блокировка чатов что бы не испортить историю 
-# {id:lock}
-LOCKS = {}
+# память диалогов и блокировки чатов что бы не испортить историю
+MEM = my_chatmem.ChatMemory('shadow', max_lines=maxhistlines*2, max_chars=maxhistchars, log=my_log.log_shadowjourney)
 
 # не принимать запросы больше чем, это ограничение для телеграм бота, в этом модуле оно не используется
 MAX_REQUEST = 10000
@@ -44,24 +44,6 @@ MEM_UNCENSORED = [
 ]
 
 
-def clear_mem(mem, user_id: str):
-    while 1:
-        sizeofmem = count_tokens(mem)
-        if sizeofmem <= maxhistchars:
-            break
-        try:
-            mem = mem[2:]
-        except IndexError:
-            mem = []
-            break
-
-    return mem[-maxhistlines*2:]
-
-
-def count_tokens(mem) -> int:
-    return sum([len(m['content']) for m in mem])
-
-
 def ai(prompt: str = '',
        mem = None,
        user_id: str = '',
@@ -110,7 +92,7 @@ def ai(prompt: str = '',
         }
 
         with BIG_LOCK:
-            response = requests.post(url, headers=headers, json=data, timeout=timeout)
+            response = my_http.post(url, headers=headers, json=data, timeout=timeout)
 
         status = response.status_code
         if status == 200:
@@ -128,7 +110,7 @@ def ai(prompt: str = '',
                         "temperature": temperature,
                     }
                     with BIG_LOCK:
-                        response = requests.post(url, headers=headers, json=data, timeout=timeout)
+                        response = my_http.post(url, headers=headers, json=data, timeout=timeout)
 
                     status = response.status_code
                     if status == 200:
@@ -153,42 +135,22 @@ def ai(prompt: str = '',
     return ''
 
 
-def update_mem(query: str, resp: str, chat_id: str):
-    mem = my_db.blob_to_obj(my_db.get_user_property(chat_id, 'dialog_shadow')) or []
-    mem += [{'role': 'user', 'content': query}]
-    mem += [{'role': 'assistant', 'content': resp}]
-    mem = clear_mem(mem, chat_id)
+def get_mem(chat_id: str) -> list:
+    '''Get chat history for chat_id as list of messages'''
+    return MEM.get(chat_id)
 
-    mem__ = []
-    try:
-        i = 0
-        while i < len(mem):
-            if i == 0 or mem[i] != mem[i-1]:
-                mem__.append(mem[i])
-            i += 1
-    except Exception as error:
-        error_traceback = traceback.format_exc()
-        my_log.log_shadowjourney(f'my_shadowjourney:update_mem: {error}\n\n{error_traceback}\n\n{query}\n\n{resp}\n\n{mem}')
 
-    my_db.set_user_property(chat_id, 'dialog_shadow', my_db.obj_to_blob(mem__))
+def update_mem(query: str, resp: str, chat_id: str):
+    MEM.update(chat_id, query, resp)
 
 
 def chat(query: str, chat_id: str = '', temperature: float = 1, system: str = '') -> str:
-    global LOCKS
-    if chat_id in LOCKS:
-        lock = LOCKS[chat_id]
-    else:
-        lock = threading.Lock()
-        LOCKS[chat_id] = lock
-    with lock:
-        mem = my_db.blob_to_obj(my_db.get_user_property(chat_id, 'dialog_shadow')) or []
+    with MEM.lock(chat_id):
+        mem = get_mem(chat_id)
         text = ai(query, mem, user_id=chat_id, temperature = temperature, system=system)
         if text:
             my_db.add_msg(chat_id, 'gpt4o')
-            mem += [{'role': 'user', 'content': query}]
-            mem += [{'role': 'assistant', 'content': text}]
-            mem = clear_mem(mem, chat_id)
-            my_db.set_user_property(chat_id, 'dialog_shadow', my_db.obj_to_blob(mem))
+            update_mem(query, text, chat_id)
         return text
 
 
@@ -215,22 +177,7 @@ def undo(chat_id: str):
     Returns:
         None
     """
-    try:
-        global LOCKS
-
-        if chat_id in LOCKS:
-            lock = LOCKS[chat_id]
-        else:
-            lock = threading.Lock()
-            LOCKS[chat_id] = lock
-        with lock:
-            mem = my_db.blob_to_obj(my_db.get_user_property(chat_id, 'dialog_shadow')) or []
-            # remove 2 last lines from mem
-            mem = mem[:-2]
-            my_db.set_user_property(chat_id, 'dialog_shadow', my_db.obj_to_blob(mem))
-    except Exception as error:
-        error_traceback = traceback.format_exc()
-        my_log.log_shadowjourney(f'Failed to undo chat {chat_id}: {error}\n\n{error_traceback}')
+    MEM.undo(chat_id)
 
 
 def reset(chat_id: str):
@@ -243,8 +190,7 @@ def reset(chat_id: str):
     Returns:
         None
     """
-    mem = []
-    my_db.set_user_property(chat_id, 'dialog_shadow', my_db.obj_to_blob(mem))
+    MEM.reset(chat_id)
 
 
 def get_mem_as_string(chat_id: str) -> str:
@@ -257,26 +203,7 @@ def get_mem_as_string(chat_id: str) -> str:
     Returns:
         str: The chat history as a string.
     """
-    try:
-        mem = my_db.blob_to_obj(my_db.get_user_property(chat_id, 'dialog_shadow')) or []
-        result = ''
-        for x in mem:
-            role = x['role']
-            if role == 'user': role = '𝐔𝐒𝐄𝐑'
-            if role == 'assistant': role = '𝐁𝐎𝐓'
-            if role == 'system': role = '𝐒𝐘𝐒𝐓𝐄𝐌'
-            text = x['content']
-            if text.startswith('[Info to help you answer'):
-                end = text.find(']') + 1
-                text = text[end:].strip()
-            result += f'{role}: {text}\n'
-            if role == '𝐁𝐎𝐓':
-                result += '\n'
-        return result 
-    except Exception as error:
-        error_traceback = traceback.format_exc()
-        my_log.log_shadowjourney(f'get_mem_as_string: {error}\n\n{error_traceback}')
-        return ''
+    return MEM.as_string(chat_id)
 
 
 def sum_big_text(text:str, query: str, temperature: float = 1, model: str = '') -> str:
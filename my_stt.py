@@ -2,77 +2,38 @@
 # pip install -U google-generativeai
 # pip install assemblyai
 
-import datetime
-import hashlib
-import os
+import concurrent.futures
+import io
 import random
-import subprocess
 import threading
 import traceback
-from io import BytesIO
 
 import speech_recognition as sr
 import assemblyai as aai
-from pydub import AudioSegment
 
 import cfg
+import my_audio
+import my_db
 import my_groq
 import my_transcribe
 import my_log
-import utils
 
 
 # locks for chat_ids
 LOCKS = {}
 
-# [(crc32, text recognized),...]
-STT_CACHE = []
-CACHE_SIZE = 100
+# пул для кусков голосовых и файлов которые прислали в чат, юзер ждет ответа,
+# поэтому не в общем пуле my_transcribe.POOL где могут стоять часовые видео
+STT_WORKERS = cfg.STT_WORKERS if hasattr(cfg, 'STT_WORKERS') else 4
+POOL = concurrent.futures.ThreadPoolExecutor(max_workers=STT_WORKERS, thread_name_prefix='stt')
 
 
-def audio_duration(audio_file: str) -> int:
-    """
-    Get the duration of an audio file.
-
-    Args:
-        audio_file (str): The path to the audio file.
-
-    Returns:
-        int: The duration of the audio file in seconds.
-    """
-    result = subprocess.run(['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'default=noprint_wrappers=1:nokey=1', audio_file], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    try:
-        r = float(result.stdout)
-    except ValueError:
-        r = 0
-    try:
-        r = int(r)
-    except ValueError:
-        r = 0
-    return r
-
-
-def convert_to_ogg_with_ffmpeg(audio_file: str) -> str:
-    """
-    Converts an audio file to a ogg format using FFmpeg.
-
-    Args:
-        audio_file (str): The path to the audio file to be converted.
-
-    Returns:
-        str: The path to the converted wave file.
-    """
-    tmp_wav_file = utils.get_tmp_fname() + '.ogg'
-    subprocess.run(['ffmpeg', '-i', audio_file, '-map', '0:a', '-c:a','libvorbis', tmp_wav_file], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-    return tmp_wav_file
-
-
-def stt_google(audio_file: str, language: str = 'ru') -> str:
+def stt_google(audio_file: bytes, language: str = 'ru') -> str:
     """
     Speech-to-text using Google's speech recognition API.
     
     Args:
-        audio_file (str): The path to the audio file to be transcribed.
+        audio_file (bytes): The audio data (or path to the audio file) to be transcribed.
         language (str, optional): The language of the audio file. Defaults to 'ru'.
     
     Returns:
@@ -80,26 +41,20 @@ def stt_google(audio_file: str, language: str = 'ru') -> str:
     """
     google_recognizer = sr.Recognizer()
 
-    audio = AudioSegment.from_file(audio_file)
-    # Сохраняем сегмент в BytesIO
-    wav_bytes = BytesIO()
-    audio.export(wav_bytes, format="wav")
-    wav_bytes.seek(0)
-
-    with sr.AudioFile(wav_bytes) as source:
-        audio = google_recognizer.record(source)  # read the entire audio file
+    # сырой звук из ffmpeg сразу в память, без pydub и wav файла
+    audio = sr.AudioData(my_audio.to_pcm(audio_file), my_audio.PCM_RATE, 2)
 
     text = google_recognizer.recognize_google(audio, language=language)
 
     return text
 
 
-def stt(input_file: str, lang: str = 'ru', chat_id: str = '_', prompt: str = '') -> str:
+def stt(input_file: bytes, lang: str = 'ru', chat_id: str = '_', prompt: str = '') -> str:
     """
-    Generate the function comment for the given function body in a markdown code block with the correct language syntax.
+    Speech to text, tries groq, google, gemini and assemblyai.
 
     Args:
-        input_file (str): The path to the input file.
+        input_file (bytes): Audio data or the path to the input file.
         lang (str, optional): The language for speech recognition. Defaults to 'ru'.
         chat_id (str, optional): The ID of the chat. Defaults to '_'.
 
@@ -110,147 +65,109 @@ def stt(input_file: str, lang: str = 'ru', chat_id: str = '_', prompt: str = '')
         LOCKS[chat_id] = threading.Lock()
     with LOCKS[chat_id]:
         text = ''
-        with open(input_file, 'rb') as f:
-            data_from_file = f.read()
-        data = hashlib.sha256(data_from_file).hexdigest()
-        global STT_CACHE
-        for x in STT_CACHE:
-            if x[0] == data:
-                text = x[1]
-                return text
-
-        dur = audio_duration(input_file)
-        input_file2 = convert_to_ogg_with_ffmpeg(input_file)
-
-        try:
-            if not text and dur < 30:
-                text = my_groq.stt(input_file2, lang, prompt=prompt)
-
-            if not text and dur < 55:
-                # быстро и хорошо распознает но до 1 минуты всего
-                # и часто глотает последнее слово
-                try: # пробуем через гугл
-                    text = stt_google(input_file2, lang)
-                except Exception as unknown_error:
-                    my_log.log2(str(unknown_error))
-
-            if not text:
-                try: # gemini
-                    # может выдать до 8000 токенов (30000 русских букв) более чем достаточно для голосовух
-                    # у него в качестве fallback используется тот же гугл но с разбиением на части
-                    text = stt_genai(input_file2, lang)
-                except Exception as error:
-                    my_log.log2(f'my_stt:stt:genai:{error}')
-
-            if not text:
-                text = my_groq.stt(input_file2, lang, prompt=prompt)
-
-            if not text:
-                text = assemblyai(input_file2, lang)
-
-        finally:
-            utils.remove_file(input_file2)
+        if isinstance(input_file, str):
+            with open(input_file, 'rb') as f:
+                input_file = f.read()
+        # результат всей цепочки движков, пересланное много раз голосовое распознается один раз
+        cache_key = my_db.stt_cache_key(input_file, lang, 'auto')
+        text = my_db.get_stt_cache(cache_key)
+        if text:
+            return text
 
-        if text and len(text) > 1:
-            text_ = text
-            STT_CACHE.append([data, text_])
-            STT_CACHE = STT_CACHE[-CACHE_SIZE:]
-            return text_
+        # один запуск ffmpeg, и конвертация и длительность, все в памяти
+        input_file2, dur = my_audio.convert(input_file)
+        if not input_file2:
+            return ''
 
-    return ''
+        if not text and dur < 30:
+            text = my_groq.stt(input_file2, lang, prompt=prompt)
 
+        if not text and dur < 55:
+            # быстро и хорошо распознает но до 1 минуты всего
+            # и часто глотает последнее слово
+            try: # пробуем через гугл
+                text = stt_google(input_file2, lang)
+            except Exception as unknown_error:
+                my_log.log2(str(unknown_error))
 
-def stt_genai_worker(audio_file: str, part: tuple, n: int, fname: str, language: str = 'ru') -> None:
-    with my_transcribe.download_worker_semaphore:
-        utils.remove_file(f'{fname}_{n}.ogg')
+        if not text:
+            try: # gemini
+                # может выдать до 8000 токенов (30000 русских букв) более чем достаточно для голосовух
+                # у него в качестве fallback используется тот же гугл но с разбиением на части
+                text = stt_genai(input_file2, lang, dur)
+            except Exception as error:
+                my_log.log2(f'my_stt:stt:genai:{error}')
 
-        proc = subprocess.run([my_transcribe.FFMPEG, '-ss', str(part[0]), '-i', audio_file, '-t',
-                        str(part[1]), f'{fname}_{n}.ogg'],
-                        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        out_ = proc.stdout.decode('utf-8', errors='replace').strip()
-        err_ = proc.stderr.decode('utf-8', errors='replace').strip()
-        if 'error' in err_:
-            my_log.log2(f'my_stt:stt_genai_worker: Error in FFMPEG: {err_}')
-        if 'error' in out_:
-            my_log.log2(f'my_stt:stt_genai_worker: Error in FFMPEG: {out_}')
+        if not text:
+            text = my_groq.stt(input_file2, lang, prompt=prompt)
 
-        text = ''
-        # text = my_groq.stt(f'{fname}_{n}.ogg', language)
         if not text:
-            text = my_transcribe.transcribe_genai(f'{fname}_{n}.ogg', language=language)
+            text = assemblyai(input_file2, lang)
 
-        if text:
-            with open(f'{fname}_{n}.txt', 'w', encoding='utf-8') as f:
-                f.write(text)
+        if text and len(text) > 1:
+            my_db.set_stt_cache(cache_key, lang, 'auto', text)
+            return text
 
-        utils.remove_file(f'{fname}_{n}.ogg')
+    return ''
+
+
+def stt_genai_worker(audio_file: bytes, part: tuple, language: str = 'ru') -> str:
+    # кусок вырезается прямо из памяти, без промежуточных файлов
+    data, _ = my_audio.convert(audio_file, start=part[0], length=part[1])
+    if not data:
+        return ''
 
+    text = ''
+    # text = my_groq.stt(data, language)
+    if not text:
+        text = my_transcribe.transcribe_genai(data, language=language)
+    return text or ''
 
-def stt_genai(audio_file: str, language: str = 'ru') -> str:
+
+def stt_genai(audio_file: bytes, language: str = 'ru', duration: float = 0) -> str:
     """
     Converts the given audio file to text using the Gemini API.
 
     Args:
-        audio_file (str): The path to the audio file to be converted.
+        audio_file (bytes): The audio data (or path to the audio file) to be converted.
+        duration (float): The duration of the audio if it is already known.
 
     Returns:
         str: The converted text.
     """
     prompt = "Listen carefully to the following audio file. Provide a transcript. Fix errors, make a fine text without time stamps."
-    duration = audio_duration(audio_file)
+    if isinstance(audio_file, str):
+        with open(audio_file, 'rb') as f:
+            audio_file = f.read()
+    if not duration:
+        duration = my_audio.duration(audio_file)
     # if duration <= 10*60:
     #     text = my_groq.stt(audio_file, language)
     #     if not text:
     #         text = my_transcribe.transcribe_genai(audio_file, prompt, language)
     #     return text
     # else:
-    part_size = 10 * 60 # размер куска несколько минут
-    treshold = 5 # захватывать +- несколько секунд в каждом куске
-    output_name = utils.get_tmp_fname()
-
-    parts = []
-    start = 0
-    while start < duration:
-        end = min(start + part_size, duration)
-        if start == 0:
-            parts.append((0, min(duration, end + treshold)))  # Первый фрагмент
-        elif end == duration:
-            parts.append((max(0, start - treshold), duration - start))  # Последний фрагмент
-        else:
-            parts.append((max(0, start - treshold), min(duration - start, part_size) + 2 * treshold))  # Остальные фрагменты
-        start = end
-
-    n = 0
-    threads = []
-
-    for part in parts:
-        n += 1
-        t = threading.Thread(target=stt_genai_worker, args=(audio_file, part, n, output_name))
-        threads.append(t)
-        t.start()
-
-    for t in threads:
-        t.join()
+    parts = my_transcribe.make_parts(duration)
+
+    # куски распознаются параллельно, результаты собираются в исходном порядке
+    texts = list(POOL.map(lambda part: stt_genai_worker(audio_file, part, language), parts))
 
     result = ''
-    for x in range(1, n + 1):
-        # check if file exists
-        if os.path.exists(f'{output_name}_{x}.txt'):
-            with open(f'{output_name}_{x}.txt', 'r', encoding='utf-8') as f:
-                result += f.read() + '\n\n'
-            utils.remove_file(f'{output_name}_{x}.txt')
+    for text in texts:
+        if text:
+            result += text + '\n\n'
 
     if 'please provide the audio file' in result.lower() and len(result) < 150:
         return ''
     return result
 
 
-def assemblyai(audio_file: str, language: str = 'ru'):
-    '''Converts the given audio file to text using the AssemblyAI API.'''
+def assemblyai(audio_file: bytes, language: str = 'ru'):
+    '''Converts the given audio file (path, url or bytes) to text using the AssemblyAI API.'''
     try:
         aai.settings.api_key = random.choice(cfg.ASSEMBLYAI_KEYS)
         transcriber = aai.Transcriber()
-        audio_url = (audio_file)
+        audio_url = io.BytesIO(audio_file) if isinstance(audio_file, bytes) else audio_file
         config = aai.TranscriptionConfig(speaker_labels=True, language_code = language)
         transcript = transcriber.transcribe(audio_url, config)
         # my_log.log2(f'my_stt:assemblyai:DEBUG: {transcript.text}')
@@ -16,7 +16,6 @@ from youtube_transcript_api import YouTubeTranscriptApi
 import chardet
 # import magic
 import PyPDF2
-import requests
 import trafilatura
 
 import cfg
@@ -24,6 +23,8 @@ import my_db
 import my_log
 import my_gemini
 import my_groq
+import my_hedge
+import my_http
 import my_stt
 import my_transcribe
 import utils
@@ -263,27 +264,23 @@ Markdown for links is mandatory.
 Text:
 '''
 
-    if not result:
-        try:
-            if query:
-                qq = query
-            r = my_gemini.sum_big_text(text[:my_gemini.MAX_SUM_REQUEST], qq).strip()
-            if r != '':
-                result = f'{r}\n\n--\nGemini Flash [{len(text[:my_gemini.MAX_SUM_REQUEST])}]'
-        except Exception as error:
-            print(f'my_sum:summ_text_worker:gpt: {error}')
-            my_log.log2(f'my_sum:summ_text_worker:gpt: {error}')
-
-    if not result:
-        try:
-            if query:
-                qq = query
-            r = my_groq.sum_big_text(text[:my_groq.MAX_SUM_REQUEST], qq).strip()
-            if r != '':
-                result = f'{r}\n\n--\nLlama 3.1 70b [Groq] [{len(text[:my_groq.MAX_SUM_REQUEST])}]'
-        except Exception as error:
-            print(f'my_sum:summ_text_worker:gpt: {error}')
-            my_log.log2(f'my_sum:summ_text_worker:gpt: {error}')
+    if query:
+        qq = query
+
+    def gemini_sum():
+        r = my_gemini.sum_big_text(text[:my_gemini.MAX_SUM_REQUEST], qq).strip()
+        if r != '':
+            return f'{r}\n\n--\nGemini Flash [{len(text[:my_gemini.MAX_SUM_REQUEST])}]'
+        return ''
+
+    def groq_sum():
+        r = my_groq.sum_big_text(text[:my_groq.MAX_SUM_REQUEST], qq).strip()
+        if r != '':
+            return f'{r}\n\n--\nLlama 3.1 70b [Groq] [{len(text[:my_groq.MAX_SUM_REQUEST])}]'
+        return ''
+
+    # если джемини отвечает дольше обычного то параллельно спрашиваем ламу
+    _, result = my_hedge.hedge(('sum_gemini', gemini_sum), ('sum_groq', groq_sum))
 
     return result
 
@@ -369,13 +366,13 @@ def summ_url(url:str, download_only: bool = False, lang: str = 'ru', deep: bool
         headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'}
 
         try:
-            response = requests.get(url, stream=True, headers=headers, timeout=20)
             content = b''
-            # Ограничиваем размер
-            for chunk in response.iter_content(chunk_size=1024):
-                content += chunk
-                if len(content) > 1 * 1024 * 1024: # 1 MB
-                    break
+            with my_http.get(url, stream=True, headers=headers, timeout=20) as response:
+                # Ограничиваем размер
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    content += chunk
+                    if len(content) > 1 * 1024 * 1024: # 1 MB
+                        break
         except:
             if download_only:
                 return ''
@@ -2,10 +2,10 @@
 # pip install -U deepl
 
 import cachetools.func
-import random
 import re
 import subprocess
 import threading
+import time
 import traceback
 import uuid
 from datetime import datetime, timedelta
@@ -18,6 +18,7 @@ from sqlitedict import SqliteDict
 from fuzzywuzzy import fuzz
 
 import cfg
+import my_keys
 import my_log
 import utils
 
@@ -34,6 +35,10 @@ USER_KEYS = SqliteDict('db/deepl_user_keys.db', autocommit=True)
 # list of all users keys
 ALL_KEYS = []
 USER_KEYS_LOCK = threading.Lock()
+# {auth_key: deepl.Translator}
+DEEPL_TRANSLATORS = {}
+# порядок в котором пробовать ключи, с учетом их ошибок и лимитов
+KEYS = my_keys.KeyPool('DEEPL')
 
 
 # keep in memory the translation
@@ -226,9 +231,22 @@ def get_deepl_stats() -> str:
     return result
 
 
+def get_deepl_translator(auth_key: str) -> deepl.Translator:
+    '''Translator for key, kept between calls so its http session keeps connections open'''
+    if auth_key not in DEEPL_TRANSLATORS:
+        DEEPL_TRANSLATORS[auth_key] = deepl.Translator(auth_key)
+    return DEEPL_TRANSLATORS[auth_key]
+
+
+@cachetools.func.ttl_cache(maxsize=100, ttl=24 * 60 * 60)
+def get_deepl_target_languages(auth_key: str) -> list:
+    '''List of target languages, it does not change, no need to ask on every translation'''
+    return get_deepl_translator(auth_key).get_target_languages()
+
+
 @cachetools.func.ttl_cache(maxsize=1000, ttl=1000 * 60)
 def translate_deepl(text: str, from_lang: str = None, to_lang: str = '') -> str:
-    auth_key = random.choice(cfg.DEEPL_KEYS) if hasattr(cfg, 'DEEPL_KEYS') and cfg.DEEPL_KEYS else None
+    auth_key = KEYS.pick(cfg.DEEPL_KEYS, 1)[0] if hasattr(cfg, 'DEEPL_KEYS') and cfg.DEEPL_KEYS else None
     if not auth_key:
         return ''
 
@@ -243,9 +261,9 @@ def translate_deepl(text: str, from_lang: str = None, to_lang: str = '') -> str:
         my_log.log_translate(f'translate_deepl: The limit on the number of translated characters has been exceeded. The limit is valid for 30 days.\n\n{text}\n\n{from_lang}\n\n{to_lang}')
         return ''
 
-    translator = deepl.Translator(auth_key)
+    translator = get_deepl_translator(auth_key)
     target_lang = None
-    for x in translator.get_target_languages():
+    for x in get_deepl_target_languages(auth_key):
         code = x.code
         if to_lang.upper() in code:
             target_lang = x
@@ -267,7 +285,9 @@ def translate_deepl(text: str, from_lang: str = None, to_lang: str = '') -> str:
     try:
         unique_id = str(uuid.uuid4())
         deepl_api_counter[unique_id] = (current_date, len(text), auth_key)
+        time_request = time.time()
         result = translator.translate_text(text, target_lang=target_lang)
+        KEYS.success(auth_key, time.time() - time_request)
         # не удалось перевести?
         ratio = fuzz.ratio(text, result.text)
         if ratio > 90:
@@ -276,6 +296,7 @@ def translate_deepl(text: str, from_lang: str = None, to_lang: str = '') -> str:
         # my_log.log_translate(f'{unique_id}: {text} -> {result.text}\n\ntokens_used_last_30_days: {tokens_used_last_30_days}\nper_month_tokens_limit: {per_month_tokens_limit}\n\n{from_lang}\n\n{to_lang}')
         return result.text
     except Exception as error:
+        KEYS.failure(auth_key, str(error))
         traceback_error = traceback.format_exc()
         my_log.log2(f'my_trans:translate_deepl: {error}\n\n{text}\n\n{to_lang}\n\n{traceback_error}')
         return ''
@@ -1,20 +1,19 @@
 #!/usr/bin/env python3
 
 import cachetools.func
+import contextlib
 import io
 import json
-import os
 import random
-import re
 import subprocess
 import threading
 import time
 import traceback
 import zlib
 from pydub import AudioSegment
-from io import BytesIO
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 
+import numpy
 import speech_recognition as sr
 import google.generativeai as genai
 from google.generativeai.types import HarmCategory, HarmBlockThreshold
@@ -23,6 +22,8 @@ from pydub.silence import split_on_silence
 
 
 import cfg
+import my_audio
+import my_db
 import my_gemini
 import my_groq
 import my_log
@@ -35,10 +36,32 @@ YT_DLP = 'yt-dlp'
 FFMPEG = 'ffmpeg'
 
 
-MAX_THREADS = 4  # Максимальное количество одновременных потоков
-MAX_THREADS_V2 = 2  # Максимальное количество одновременных потоков
-download_worker_semaphore = threading.Semaphore(MAX_THREADS)  # Создаем семафор здесь
-download_worker_semaphore_v2 = threading.Semaphore(MAX_THREADS_V2)  # Создаем семафор здесь
+# общий для всех юзеров пул распознавания кусков длинных записей,
+# сколько бы расшифровок ни запустили одновременно, кусков распознается не больше чем воркеров
+TRANSCRIBE_WORKERS = cfg.TRANSCRIBE_WORKERS if hasattr(cfg, 'TRANSCRIBE_WORKERS') else 4
+POOL = ThreadPoolExecutor(max_workers=TRANSCRIBE_WORKERS, thread_name_prefix='transcribe')
+
+PART_SIZE = 10 * 60 # размер куска несколько минут
+PART_TRESHOLD = 5 # захватывать +- несколько секунд в каждом куске
+# видео длиннее не расшифровываются
+MAX_DURATION = 4 * 60 * 60
+# незаконченные после перезапуска расшифровки старше этого не продолжаются
+JOB_MAX_AGE = 24 * 60 * 60
+
+# поиск пауз для нарезки на куски, см. split_on_pauses()
+SILENCE_DB = -30 # кадр тише этого (dBFS) считается тишиной
+SILENCE_MIN = 0.5 # пауза это хотя бы столько секунд тишины
+SILENCE_FRAME = 0.02 # длина кадра, секунд
+# паузы ближе к началу куска чем эта доля от его длины не годятся, режется по длине
+SILENCE_MIN_PART = 0.2
+
+# {url: [callback(готово кусков, всего кусков)]}, см. watch()
+WATCHERS = {}
+WATCHERS_LOCK = threading.Lock()
+# задания которые выполняются прямо сейчас {job_id: Future с результатом},
+# повторный запрос того же видео (или /sum во время resume_jobs) ждет уже идущее
+JOBS = {}
+JOBS_LOCK = threading.Lock()
 
 
 # не больше 4 потоков для распознавания речи гуглом
@@ -219,7 +242,7 @@ def transcribe_genai(audio_file: str, prompt: str = '', language: str = 'ru') ->
     This function takes an audio file path and an optional prompt as input and returns the transcribed text.
 
     Parameters
-    audio_file: The path to the audio file. This can be a local file path or a YouTube URL.
+    audio_file: The path to the audio file. This can be a local file path, a YouTube URL or ogg data (bytes).
     prompt: An optional prompt to provide to the Gemini API. This can be used to guide the transcription process.
     language: The language of the audio file. This is used to select the appropriate language model for transcription.
     Returns
@@ -228,16 +251,14 @@ def transcribe_genai(audio_file: str, prompt: str = '', language: str = 'ru') ->
     Raises
     Exception: If an error occurs during transcription.
     '''
-    if my_ytb.valid_youtube_url(audio_file):
+    if isinstance(audio_file, str) and my_ytb.valid_youtube_url(audio_file):
         audio_file_ = my_ytb.download_ogg(audio_file)
         result = transcribe_genai(audio_file_, prompt, language)
         utils.remove_file(audio_file_)
         return result
 
     try:
-        keys = cfg.gemini_keys[:] + my_gemini.ALL_KEYS
-        random.shuffle(keys)
-        key = keys[0]
+        key = my_gemini.KEYS.pick(cfg.gemini_keys + my_gemini.ALL_KEYS, 1)[0]
 
         your_file = None
         if not prompt:
@@ -247,7 +268,10 @@ def transcribe_genai(audio_file: str, prompt: str = '', language: str = 'ru') ->
             try:
                 genai.configure(api_key=key) # здесь может быть рейс кондишн?
                 if your_file == None:
-                    your_file = genai.upload_file(audio_file)
+                    if isinstance(audio_file, bytes):
+                        your_file = genai.upload_file(io.BytesIO(audio_file), mime_type='audio/ogg')
+                    else:
+                        your_file = genai.upload_file(audio_file)
                     genai.configure(api_key=key) # здесь может быть рейс кондишн?
                 model = genai.GenerativeModel('models/gemini-1.5-flash')
                 # tokens_count = model.count_tokens([your_file])
@@ -266,6 +290,7 @@ def transcribe_genai(audio_file: str, prompt: str = '', language: str = 'ru') ->
                     break
             except Exception as error:
                 my_log.log_gemini(f'my_transcribe.py:transcribe_genai: Failed to convert audio data to text: {error}')
+                my_gemini.KEYS.failure(key, str(error))
                 response = ''
                 time.sleep(2)
 
@@ -293,7 +318,7 @@ def transcribe_groq(audio_file: str, prompt: str = '', language: str = 'ru') ->
     This function takes an audio file path and an optional prompt as input and returns the transcribed text.
 
     Parameters
-    audio_file: The path to the audio file. This can be a local file path or a YouTube URL.
+    audio_file: The path to the audio file. This can be a local file path, a YouTube URL or ogg data (bytes).
     prompt: An optional prompt to provide to the Grow API. This can be used to guide the transcription process.
     language: The language of the audio file. This is used to select the appropriate language model for transcription.
     Returns
@@ -302,7 +327,7 @@ def transcribe_groq(audio_file: str, prompt: str = '', language: str = 'ru') ->
     Raises
     Exception: If an error occurs during transcription.
     '''
-    if my_ytb.valid_youtube_url(audio_file):
+    if isinstance(audio_file, str) and my_ytb.valid_youtube_url(audio_file):
         audio_file_ = my_ytb.download_ogg(audio_file)
         result = transcribe_groq(audio_file_, prompt, language)
         utils.remove_file(audio_file_)
@@ -312,8 +337,11 @@ def transcribe_groq(audio_file: str, prompt: str = '', language: str = 'ru') ->
         if not prompt:
             prompt = "Listen carefully to the following audio file. Provide a transcript. Fix errors, make a fine text."
 
-        with open(audio_file, 'rb') as f:
-            data = f.read()
+        if isinstance(audio_file, bytes):
+            data = audio_file
+        else:
+            with open(audio_file, 'rb') as f:
+                data = f.read()
 
         for _ in range(3):
             text = my_groq.stt(data, lang=language, prompt=prompt).strip()
@@ -329,69 +357,193 @@ def transcribe_groq(audio_file: str, prompt: str = '', language: str = 'ru') ->
         return stt_google_pydub_v2(audio_file, lang = language)
 
 
-def download_worker(video_url: str, part: tuple, n: int, fname: str, language: str):
-    with download_worker_semaphore:
-        utils.remove_file(f'{fname}_{n}.ogg')
-        proc = subprocess.run([YT_DLP, '-x', '-g', video_url], stdout=subprocess.PIPE)
-        stream_url = proc.stdout.decode('utf-8', errors='replace').strip()
+# движки для кусков, если первый не справился кусок отдается следующему
+ENGINES = {
+    'groq': lambda data, language: transcribe_groq(data, language=language),
+    'genai': lambda data, language: transcribe_genai(data, language=language),
+}
 
-        proc = subprocess.run([FFMPEG, '-ss', str(part[0]), '-i', stream_url, '-t',
-                        str(part[1]), f'{fname}_{n}.ogg'],
-                        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        out_ = proc.stdout.decode('utf-8', errors='replace').strip()
-        err_ = proc.stderr.decode('utf-8', errors='replace').strip()
-        if 'error' in err_:
-            my_log.log2(f'my_transcribe:download_worker: Error in FFMPEG: {err_}')
-        if 'error' in out_:
-            my_log.log2(f'my_transcribe:download_worker: Error in FFMPEG: {out_}')
 
-        text = my_groq.stt(f'{fname}_{n}.ogg', language=language)
-        if not text:
-            text = transcribe_genai(f'{fname}_{n}.ogg', language=language)
+def make_parts(duration: float, part_size: int = PART_SIZE, treshold: int = PART_TRESHOLD) -> list:
+    '''Split record into parts with small overlaps, list of (start, length) in seconds'''
+    duration = int(duration)
+    parts = []
+    start = 0
+    while start < duration:
+        end = min(start + part_size, duration)
+        if start == 0:
+            parts.append((0, min(duration, end + treshold)))  # Первый фрагмент
+        elif end == duration:
+            parts.append((max(0, start - treshold), duration - start + treshold))  # Последний фрагмент
+        else:
+            parts.append((max(0, start - treshold), min(duration - start, part_size) + 2 * treshold))  # Остальные фрагменты
+        start = end
+    return parts
+
+
+@contextlib.contextmanager
+def watch(url: str, callback):
+    '''While in context callback(done, total) is called every time
+    one more part of transcription of the url is ready'''
+    with WATCHERS_LOCK:
+        WATCHERS.setdefault(url, []).append(callback)
+    try:
+        yield
+    finally:
+        with WATCHERS_LOCK:
+            WATCHERS[url].remove(callback)
+            if not WATCHERS[url]:
+                del WATCHERS[url]
+
+
+def notify(url: str, done: int, total: int):
+    with WATCHERS_LOCK:
+        callbacks = WATCHERS.get(url, [])[:]
+    for callback in callbacks:
+        try:
+            callback(done, total)
+        except Exception as error:
+            my_log.log2(f'my_transcribe:notify: {error}')
+
+
+def part_key(url: str, part: tuple, language: str) -> str:
+    '''Key of the transcribed part in stt cache, it is the checkpoint of the job'''
+    return my_db.stt_cache_key(f'{url}\n{part[0]}\n{part[1]}'.encode(), language, 'part')
+
 
+def transcribe_part(url: str, stream_url: str, part: tuple, language: str, engines: tuple) -> str:
+    '''Transcribe one part of the record, tries engines one by one.
+    Ready part is saved and is not transcribed again if the job is restarted'''
+    key = part_key(url, part, language)
+    text = my_db.get_stt_cache(key)
+    if text:
+        return text
+
+    # кусок сразу в память, без временного файла
+    data, _ = my_audio.convert(stream_url, start=part[0], length=part[1])
+    if not data:
+        return ''
+
+    for engine in engines:
+        try:
+            text = ENGINES[engine](data, language)
+        except Exception as error:
+            traceback_error = traceback.format_exc()
+            my_log.log2(f'my_transcribe:transcribe_part: {engine} {url} {part} {error}\n\n{traceback_error}')
+            text = ''
         if text:
-            with open(f'{fname}_{n}.txt', 'w', encoding='utf-8') as f:
-                f.write(text)
+            my_db.set_stt_cache(key, language, engine, text)
+            return text
+    return ''
 
-        utils.remove_file(f'{fname}_{n}.ogg')
 
+def transcribe_url(url: str, language: str, engines: tuple = ('groq', 'genai'), duration: float = 0) -> str:
+    '''Transcribe long video or audio by url (anything yt-dlp can download).
 
-def download_worker_v2(video_url: str, part: tuple, n: int, fname: str, language: str):
-    with download_worker_semaphore_v2:
-        utils.remove_file(f'{fname}_{n}.ogg')
-        proc = subprocess.run([YT_DLP, '-x', '-g', video_url], stdout=subprocess.PIPE)
-        stream_url = proc.stdout.decode('utf-8', errors='replace').strip()
+    Record is cut into parts that are transcribed in the common pool POOL and
+    assembled in order. Each part is a checkpoint, the job interrupted by
+    restart is continued by resume_jobs() from the parts that are not ready.
+    The same job requested again while it runs is not started twice, the second
+    caller waits for the first one. Progress can be watched with watch().
+    '''
+    job_id = my_db.stt_cache_key(url.encode(), language, ','.join(engines))
+    result = my_db.get_stt_cache(job_id)
+    if result:
+        return result
 
-        proc = subprocess.run([FFMPEG, '-ss', str(part[0]), '-i', stream_url, '-t',
-                        str(part[1]), f'{fname}_{n}.ogg'],
-                        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        out_ = proc.stdout.decode('utf-8', errors='replace').strip()
-        err_ = proc.stderr.decode('utf-8', errors='replace').strip()
-        if 'error' in err_:
-            my_log.log2(f'my_transcribe:download_worker_v2: Error in FFMPEG: {err_}')
-        if 'error' in out_:
-            my_log.log2(f'my_transcribe:download_worker_v2: Error in FFMPEG: {out_}')
+    with JOBS_LOCK:
+        future = JOBS.get(job_id)
+        running = future is not None
+        if not running:
+            future = Future()
+            JOBS[job_id] = future
+    if running:
+        return future.result()
 
-        text = transcribe_groq(f'{fname}_{n}.ogg', language=language)
+    # ждущие получают тот же результат или то же исключение что и первый
+    try:
+        result = transcribe_job(job_id, url, language, engines, duration)
+        future.set_result(result)
+        return result
+    except Exception as error:
+        future.set_exception(error)
+        raise
+    finally:
+        with JOBS_LOCK:
+            del JOBS[job_id]
+
+
+def transcribe_job(job_id: str, url: str, language: str, engines: tuple, duration: float) -> str:
+    '''Body of transcribe_url, runs once for the job_id at a time'''
+    if not duration:
+        duration = get_url_video_duration(url)
+    if not duration or duration > MAX_DURATION:
+        # продолженная после перезапуска задача с умершей ссылкой иначе повторялась бы
+        # при каждом запуске до JOB_MAX_AGE
+        my_log.log2(f'my_transcribe:transcribe_url: bad duration {duration} for {url}')
+        my_db.finish_transcribe_job(job_id)
+        return ''
+
+    my_db.add_transcribe_job(job_id, url, language, ','.join(engines))
+
+    # ссылка на поток одна на все куски
+    proc = subprocess.run([YT_DLP, '-x', '-g', url], stdout=subprocess.PIPE)
+    stream_url = proc.stdout.decode('utf-8', errors='replace').strip().split('\n')[0]
+    if not stream_url:
+        my_log.log2(f'my_transcribe:transcribe_url: no stream for {url}')
+        my_db.finish_transcribe_job(job_id)
+        return ''
+
+    parts = make_parts(duration)
+    texts = [''] * len(parts)
+    futures = {POOL.submit(transcribe_part, url, stream_url, part, language, engines): n for n, part in enumerate(parts)}
+    for done, future in enumerate(as_completed(futures), start=1):
+        try:
+            texts[futures[future]] = future.result()
+        except Exception as error:
+            my_log.log2(f'my_transcribe:transcribe_url: {url} {error}')
+        notify(url, done, len(parts))
 
+    result = ''
+    for text in texts:
         if text:
-            with open(f'{fname}_{n}.txt', 'w', encoding='utf-8') as f:
-                f.write(text)
+            result += text + '\n\n'
+
+    # с пропущенными кусками результат не запоминается, при следующем запросе
+    # готовые куски возьмутся из кеша а недостающие распознаются снова
+    if all(texts):
+        my_db.set_stt_cache(job_id, language, 'job', result)
+    my_db.finish_transcribe_job(job_id)
+    return result
 
-        utils.remove_file(f'{fname}_{n}.ogg')
+
+@async_run
+def resume_jobs():
+    '''Continue transcriptions interrupted by restart, run from tb.main after my_db.init.
+    Result goes to stt cache, /sum of the same video made meanwhile joins the running job'''
+    for _, url, language, engines in my_db.get_unfinished_transcribe_jobs(JOB_MAX_AGE):
+        try:
+            my_log.log2(f'my_transcribe:resume_jobs: {url} {language}')
+            transcribe_url(url, language, tuple(engines.split(',')))
+        except Exception as error:
+            traceback_error = traceback.format_exc()
+            my_log.log2(f'my_transcribe:resume_jobs: {url} {error}\n\n{traceback_error}')
 
 
 @cachetools.func.ttl_cache(maxsize=10, ttl=10 * 60)
-def get_url_video_duration(url: str) -> int:
-    '''return duration of video, get with yt-dlp'''
+def get_url_info(url: str) -> dict:
+    '''return info about video, get with yt-dlp'''
     proc = subprocess.run([YT_DLP, '--skip-download', '-J', url], stdout=subprocess.PIPE)
     output = proc.stdout.decode('utf-8', errors='replace')
-    info = json.loads(output)
     try:
-        duration = info['duration']
+        return json.loads(output)
     except:
-        duration = 0
-    return duration
+        return {}
+
+
+def get_url_video_duration(url: str) -> int:
+    '''return duration of video, get with yt-dlp'''
+    return get_url_info(url).get('duration') or 0
 
 
 def download_youtube_clip(video_url: str, language: str):
@@ -401,47 +553,8 @@ def download_youtube_clip(video_url: str, language: str):
     language - язык для транскрибации, используется только для кусков которые джемини сфейлил.
                у джемини автоопределение языков а у резерва нет
     """
-
-    part_size = 10 * 60 # размер куска несколько минут
-    treshold = 5 # захватывать +- несколько секунд в каждом куске
-
-    duration = get_url_video_duration(video_url)
-
-    output_name = utils.get_tmp_fname()
-
-    parts = []
-    start = 0
-    while start < duration:
-        end = min(start + part_size, duration)
-        if start == 0:
-            parts.append((0, min(duration, end + treshold)))  # Первый фрагмент
-        elif end == duration:
-            parts.append((max(0, start - treshold), duration - start))  # Последний фрагмент
-        else:
-            parts.append((max(0, start - treshold), min(duration - start, part_size) + 2 * treshold))  # Остальные фрагменты
-        start = end
-
-    n = 0
-    threads = []
-
-    for part in parts:
-        n += 1
-        t = threading.Thread(target=download_worker, args=(video_url, part, n, output_name, language))
-        threads.append(t)
-        t.start()
-
-    for t in threads:
-        t.join()
-
-    result = ''
-    for x in range(1, n + 1):
-        # check if file exists
-        if os.path.exists(f'{output_name}_{x}.txt'):
-            with open(f'{output_name}_{x}.txt', 'r', encoding='utf-8') as f:
-                result += f.read() + '\n\n'
-            utils.remove_file(f'{output_name}_{x}.txt')
-
-    return result, info
+    info = get_url_info(video_url)
+    return transcribe_url(video_url, language, ('genai', 'groq'), info.get('duration') or 0), info
 
 
 def download_youtube_clip_v2(video_url: str, language: str):
@@ -451,56 +564,12 @@ def download_youtube_clip_v2(video_url: str, language: str):
     language - язык для транскрибации, используется только для кусков которые groq.
                у groq автоопределение языков а у резерва нет
     """
-
-    part_size = 10 * 60 # размер куска несколько минут
-    treshold = 5 # захватывать +- несколько секунд в каждом куске
-
-    proc = subprocess.run([YT_DLP, '--skip-download', '-J', video_url], stdout=subprocess.PIPE)
-    output = proc.stdout.decode('utf-8', errors='replace')
-    info = json.loads(output)
-    try:
-        duration = info['duration']
-    except:
-        duration = 0
-    if not duration or duration == 0 or duration > 4*60*60:
+    info = get_url_info(video_url)
+    duration = info.get('duration') or 0
+    if not duration or duration > MAX_DURATION:
         return '', info
     my_log.log2(f'my_transcribe:download_youtube_clip_v2: {video_url} Duration: {duration}')
-
-    output_name = utils.get_tmp_fname()
-
-    parts = []
-    start = 0
-    while start < duration:
-        end = min(start + part_size, duration)
-        if start == 0:
-            parts.append((0, min(duration, end + treshold)))  # Первый фрагмент
-        elif end == duration:
-            parts.append((max(0, start - treshold), duration - start))  # Последний фрагмент
-        else:
-            parts.append((max(0, start - treshold), min(duration - start, part_size) + 2 * treshold))  # Остальные фрагменты
-        start = end
-
-    n = 0
-    threads = []
-
-    for part in parts:
-        n += 1
-        t = threading.Thread(target=download_worker_v2, args=(video_url, part, n, output_name, language))
-        threads.append(t)
-        t.start()
-
-    for t in threads:
-        t.join()
-
-    result = ''
-    for x in range(1, n + 1):
-        # check if file exists
-        if os.path.exists(f'{output_name}_{x}.txt'):
-            with open(f'{output_name}_{x}.txt', 'r', encoding='utf-8') as f:
-                result += f.read() + '\n\n'
-            utils.remove_file(f'{output_name}_{x}.txt')
-
-    return result, info
+    return transcribe_url(video_url, language, ('groq', 'genai'), duration), info
 
 
 def gemini_tokens_count(text: str) -> int:
@@ -510,107 +579,65 @@ def gemini_tokens_count(text: str) -> int:
     return response['token_count']
 
 
-def find_cut_positions(pauses, desired_chunk_size, audio_duration):
-    """
-    Находит оптимальные позиции для разрезания аудио на основе пауз и желаемой длины фрагмента,
-    гарантируя, что размер фрагментов не превышает желаемого.
-
-    Args:
-        pauses (list): Список пауз в формате [(начало, конец, длительность), ...].
-        desired_chunk_size (float): Желаемая длительность фрагмента в секундах.
-        audio_duration (float): Общая длительность аудио в секундах.
-
-    Returns:
-        list: Список кортежей (позиция разреза, длительность фрагмента).
-    """
-    segments = []
-    last_end = 0
-    for start, end, duration in pauses:
-        segments.append((last_end, round(start - last_end, 2)))
-        last_end = end
-    segments.append((last_end, audio_duration - last_end))  # Добавляем последний сегмент
-
-    def split_segment(segments, index):
-        start, duration = segments[index]
-        if duration <= desired_chunk_size:
-            return
-
-        half_duration = duration / 2
-        segments[index] = (start, half_duration)
-        segments.insert(index + 1, (start + half_duration, half_duration))
-        split_segment(segments, index)
-        split_segment(segments, index + 1)
-
-    i = 0
-    while i < len(segments):
-        split_segment(segments, i)
-        i += 1
-
-    merged_segments = []
-    current_segment_start = 0
-    current_segment_duration = 0
-    for start, duration in segments:
-        if current_segment_duration + duration <= desired_chunk_size:
-            current_segment_duration += duration
-        else:
-            merged_segments.append((current_segment_start, current_segment_duration))
-            current_segment_start = start
-            current_segment_duration = duration
-    merged_segments.append((current_segment_start, current_segment_duration))
-
-    merged_segments = [(round(x[0], 2), round(x[1], 2)) for x in merged_segments]
-    return merged_segments
-
-
-def find_split_segments(audio_file: str, max_size: int = 50) -> list:
+def split_on_pauses(audio_file, max_size: int = 50):
     """
-    Находит моменты тишины в аудиофайле и возвращает список точек для разрезания на основе этих моментов и желаемой длины фрагмента.
+    Режет аудио на куски не длиннее max_size секунд по паузам, за один проход.
+    Аудио декодируется один раз, паузы ищутся по громкости кадров прямо в потоке,
+    готовые куски отдаются сразу, пока ffmpeg декодирует остальное.
 
     Args:
-        audio_file (str): Путь к аудиофайлу (поддерживаются любые форматы, распознаваемые ffmpeg, и ссылки на YouTube).
+        audio_file: путь к аудиофайлу, ссылка на YouTube или данные (bytes), любые форматы которые понимает ffmpeg.
+        max_size (int): максимальная длина куска в секундах.
 
-    Returns:
-        list: Список кортежей (позиция разреза, длительность фрагмента).
+    Yields:
+        tuple: (начало куска в секундах, сырой звук куска, см. my_audio.to_pcm)
     """
-    if '/youtu.be/' in audio_file or 'youtube.com/' in audio_file:
-        proc = subprocess.run([YT_DLP, '--skip-download', '-J', audio_file], stdout=subprocess.PIPE)
-        output = proc.stdout.decode('utf-8', errors='replace')
-        info = json.loads(output)
-        duration__ = info['duration']
+    if isinstance(audio_file, str) and ('/youtu.be/' in audio_file or 'youtube.com/' in audio_file):
         proc = subprocess.run([YT_DLP, '-x', '-g', audio_file], stdout=subprocess.PIPE)
         audio_file = proc.stdout.decode('utf-8', errors='replace').strip()
-    else:
-        result = subprocess.run(['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'default=noprint_wrappers=1:nokey=1', audio_file], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        try:
-            r = float(result.stdout)
-        except ValueError:
-            r = 0
-        duration__ = r
 
-    proc = subprocess.run([FFMPEG, '-i', audio_file, '-af', 'silencedetect=noise=-30dB:d=0.5', '-f', 'null', '-'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    output = proc.stdout.decode('utf-8', errors='replace').strip()
-    error = proc.stderr.decode('utf-8', errors='replace').strip()
-
-    pattern_start = re.compile(r'silence_start:\s+(\d+\.\d+)')
-    pattern_end_duration = re.compile(r'silence_end:\s+(\d+\.\d+)\s+\|\s+silence_duration:\s+(\d+\.\d+)')
-    
-    silences = []
-    current_start = None
+    frame_bytes = int(my_audio.PCM_RATE * SILENCE_FRAME) * 2
+    min_silence_frames = int(SILENCE_MIN / SILENCE_FRAME)
+    max_bytes = max_size * my_audio.PCM_RATE * 2
+    min_bytes = int(max_bytes * SILENCE_MIN_PART)
+
+    chunk = bytearray()
+    chunk_start = 0
+    tail = b''
+    # сколько тихих кадров подряд в конце куска
+    silence = 0
+    # где резать, середина последней паузы, 0 если пауз не было
+    cut_at = 0
+    for block in my_audio.stream_pcm(audio_file):
+        block = tail + block
+        n = len(block) // frame_bytes * frame_bytes
+        block, tail = block[:n], block[n:]
+        if not n:
+            continue
+        frames = numpy.frombuffer(block, dtype=numpy.int16).reshape(-1, frame_bytes // 2).astype(numpy.float32)
+        rms = numpy.sqrt(numpy.mean(frames ** 2, axis=1))
+        quiet = 20 * numpy.log10(rms / 32768 + 1e-10) < SILENCE_DB
+
+        for i, is_quiet in enumerate(quiet):
+            chunk += block[i * frame_bytes:(i + 1) * frame_bytes]
+            if is_quiet:
+                silence += 1
+                if silence >= min_silence_frames:
+                    cut_at = len(chunk) - silence // 2 * frame_bytes
+            else:
+                silence = 0
 
-    for line in error.splitlines():
-        start_match = pattern_start.search(line)
-        end_duration_match = pattern_end_duration.search(line)
+            if len(chunk) >= max_bytes:
+                pos = cut_at if cut_at >= min_bytes else len(chunk)
+                yield chunk_start / my_audio.PCM_RATE / 2, bytes(chunk[:pos])
+                chunk_start += pos
+                del chunk[:pos]
+                cut_at = 0
+                silence = min(silence, len(chunk) // frame_bytes)
 
-        if start_match:
-            current_start = float(start_match.group(1))
-        elif end_duration_match and current_start is not None:
-            end = float(end_duration_match.group(1))
-            duration = float(end_duration_match.group(2))
-            silences.append((current_start, end, duration))
-            current_start = None
-    # print(silences)
-    # print()
-    return find_cut_positions(silences, max_size, duration__)
+    chunk += tail
+    if chunk:
+        yield chunk_start / my_audio.PCM_RATE / 2, bytes(chunk)
 
 
 def stt_google_pydub_v2(audio_file_path: str, lang: str = 'ru') -> str:
@@ -626,38 +653,16 @@ def stt_google_pydub_v2(audio_file_path: str, lang: str = 'ru') -> str:
     # Создаем объект распознавания речи
     r = sr.Recognizer()
 
-    # Загружаем аудио файл с помощью pydub
-    if isinstance(audio_file_path, bytes):
-        audio = AudioSegment.from_file(io.BytesIO(audio_file_path))
-    else:
-        audio = AudioSegment.from_file(audio_file_path)
-
-    # Находим точки разрезания аудио на сегменты
-    split_segments = find_split_segments(audio_file_path)
-
-    # Распознаем текст для каждого сегмента в параллельных потоках
-    recognized_text = [""] * len(split_segments)
+    # Куски уходят на распознавание по мере декодирования, не дожидаясь конца файла
     with ThreadPoolExecutor() as executor:
-        futures = []
-        for i, (start, duration) in enumerate(split_segments):
-            # Извлекаем сегмент
-            start_ = start*1000
-            end = (start + duration)*1000
-            segment = audio[start_:end]
-
-            # Сохраняем сегмент в BytesIO
-            wav_bytes = BytesIO()
-            segment.export(wav_bytes, format="wav")
-            wav_bytes.seek(0)
-
-            # Распознаем текст асинхронно
-            futures.append(executor.submit(recognize_segment, r, wav_bytes, lang, i))
+        futures = [executor.submit(recognize_segment, r, pcm, lang, i)
+                   for i, (_, pcm) in enumerate(split_on_pauses(audio_file_path))]
 
         # Собираем результаты в правильном порядке
+        recognized_text = [""] * len(futures)
         for future in as_completed(futures):
             try:
-                index = future.result()[0]
-                text = future.result()[1]
+                index, text = future.result()
                 recognized_text[index] = text
             except Exception as e:
                 print(f"Ошибка при распознавании сегмента: {e}")
@@ -665,21 +670,20 @@ def stt_google_pydub_v2(audio_file_path: str, lang: str = 'ru') -> str:
     return " ".join(recognized_text).strip()
 
 
-def recognize_segment(recognizer, wav_bytes, lang, index):
+def recognize_segment(recognizer, pcm: bytes, lang, index):
     """
     Распознает текст из сегмента аудио.
 
     Args:
         recognizer (speech_recognition.Recognizer): Объект распознавания речи.
-        wav_bytes (io.BytesIO): Байтовое представление сегмента аудио в формате WAV.
+        pcm (bytes): Сырой звук сегмента, см. my_audio.to_pcm.
         lang (str): Язык аудио.
         index (int): Индекс сегмента.
 
     Returns:
         tuple: Кортеж (index, text), где index - индекс сегмента, text - распознанный текст.
     """
-    with sr.AudioFile(wav_bytes) as source:
-        audio_data = recognizer.record(source)
+    audio_data = sr.AudioData(pcm, my_audio.PCM_RATE, 2)
     try:
         text = recognizer.recognize_google(audio_data, language=lang)
         return (index, text)
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# пакетный перевод строк интерфейса бота на новый язык
+# вместо сотен запросов по одной строке строки пакуются пачками в один запрос
+# с пронумерованными тегами, ответ разбирается обратно по номерам и проверяется,
+# все что прошло проверку пишется в таблицу translations одним махом
+
+
+import concurrent.futures
+import re
+import traceback
+
+import langcodes
+
+import my_db
+import my_gemini
+import my_groq
+import my_log
+
+
+# сколько символов исходного текста в одном запросе
+BATCH_CHARS = 3000
+BATCH_ITEMS = 40
+# сколько запросов делать одновременно
+BATCH_WORKERS = 4
+# строкой интерфейса считается текст который уже переведен хотя бы на столько языков,
+# разовые переводы (ответы, тексты юзеров) так отсеиваются
+MIN_LANGS = 3
+
+ITEM_RE = re.compile(r'<t id="?(\d+)"?>(.*?)</t>', re.S)
+TAG_RE = re.compile(r'</?([a-zA-Z]+)[^>]*>')
+COMMAND_RE = re.compile(r'(?<![\w/])/[a-zA-Z_0-9]+')
+
+
+def pack(texts: list) -> str:
+    '''Pack strings into one text with numbered tags'''
+    return '\n'.join(f'<t id="{i}">{text}</t>' for i, text in enumerate(texts))
+
+
+def unpack(answer: str, n: int) -> dict:
+    '''{number: text} from answer of the model, only numbers from 0 to n-1'''
+    result = {}
+    for number, text in ITEM_RE.findall(answer or ''):
+        number = int(number)
+        if number < n and number not in result and text.strip():
+            result[number] = text.strip()
+    return result
+
+
+def is_valid(original: str, translated: str) -> bool:
+    '''Translation keeps html tags and /commands and has sane length'''
+    if not translated:
+        return False
+    if len(translated) > len(original) * 3 + 30:
+        return False
+    if sorted(TAG_RE.findall(original)) != sorted(TAG_RE.findall(translated)):
+        return False
+    if sorted(COMMAND_RE.findall(original)) != sorted(COMMAND_RE.findall(translated)):
+        return False
+    return True
+
+
+def make_batches(texts: list) -> list:
+    '''Split texts into batches of BATCH_CHARS chars / BATCH_ITEMS items'''
+    batches = []
+    batch = []
+    size = 0
+    for text in texts:
+        if batch and (size + len(text) > BATCH_CHARS or len(batch) >= BATCH_ITEMS):
+            batches.append(batch)
+            batch = []
+            size = 0
+        batch.append(text)
+        size += len(text)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def make_query(texts: list, lang_name: str, help: str = '') -> str:
+    query = (f'Translate the text inside each <t> element to language [{lang_name}].\n'
+             f'Keep the <t id="..."> tags with the same numbers, one element for each input element, '
+             f'keep html tags, /commands, emoji and formatting inside elements, reply only with the elements.')
+    if help:
+        query += f'\nThis can help you to translate better [{help}]'
+    return query + f'\n\n{pack(texts)}'
+
+
+def translate_batch(texts: list, to_lang: str, help: str = '') -> list:
+    '''Translate list of strings with one request to LLM.
+    Returns list of the same size, '' for strings that were not translated well.'''
+    try:
+        lang_name = langcodes.Language.make(language=to_lang).display_name(language='en')
+    except Exception:
+        lang_name = to_lang
+    result = [''] * len(texts)
+    try:
+        # что не перевел первый - просим у второго
+        for provider in (lambda q: my_gemini.ai(q, temperature=0.1),
+                         lambda q: my_groq.ai(q, temperature=0.1, max_tokens_=8000)):
+            todo = [i for i, x in enumerate(result) if not x]
+            if not todo:
+                break
+            answer = provider(make_query([texts[i] for i in todo], lang_name, help))
+            for number, translated in unpack(answer, len(todo)).items():
+                i = todo[number]
+                if is_valid(texts[i], translated):
+                    result[i] = translated
+    except Exception as error:
+        error_traceback = traceback.format_exc()
+        my_log.log_translate(f'my_trbatch:translate_batch: {error}\n\n{error_traceback}')
+    return result
+
+
+def translate_lang(lang: str) -> list:
+    '''Translate all known interface strings to the language and save them to db.
+    Returns list of (original, lang, help, translation) that were saved.'''
+    strings = my_db.get_ui_strings(lang, MIN_LANGS)
+    if not strings:
+        return []
+
+    # подсказка переводчику общая для всех строк пачки
+    by_help = {}
+    for original, help in strings:
+        by_help.setdefault(help, []).append(original)
+    jobs = [(batch, help) for help, texts in by_help.items() for batch in make_batches(texts)]
+
+    values = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=BATCH_WORKERS) as executor:
+        futures = {executor.submit(translate_batch, batch, lang, help): (batch, help) for batch, help in jobs}
+        for future in concurrent.futures.as_completed(futures):
+            batch, help = futures[future]
+            for original, translated in zip(batch, future.result()):
+                if translated:
+                    values.append((original, lang, help, translated))
+
+    if values:
+        my_db.update_translations(values)
+    my_log.log_translate(f'my_trbatch:translate_lang: {lang} {len(values)} of {len(strings)} strings translated with {len(jobs)} requests')
+    return values
+
+
+if __name__ == '__main__':
+    pass
+    my_db.init(backup=False)
+
+    # print(translate_batch(['Hello', '<b>Bot name:</b> /name', 'Search failed.'], 'de'))
+    # print(len(translate_lang('eo')))
+
+    my_db.close()
@@ -2,19 +2,36 @@
 
 import cachetools.func
 import asyncio
+import concurrent.futures
 import io
 import glob
 import os
-import tempfile
+import threading
 import traceback
 
 import edge_tts
 import gtts
 
+import cfg
 import utils
 import my_log
 
 
+# edge-tts работает в своем потоке со своим циклом asyncio, запросы ставятся
+# в очередь этого цикла и их разбирают EDGE_WORKERS корутин, остальные ждут
+# в очереди, не занимая ни потоков ни цикла диспетчера
+EDGE_WORKERS = cfg.TTS_EDGE_WORKERS if hasattr(cfg, 'TTS_EDGE_WORKERS') else 8
+# сколько может идти одна озвучка
+EDGE_TIMEOUT = 120
+# сколько ждать результата вместе с очередью
+EDGE_QUEUE_TIMEOUT = 5 * 60
+
+EDGE_LOOP = None
+EDGE_LOOP_LOCK = threading.Lock()
+# asyncio.Queue с запросами (text, voice, rate, concurrent.futures.Future), создается в EDGE_LOOP
+EDGE_QUEUE = None
+
+
 VOICES = {
     'af': {'male': 'af-ZA-WillemNeural', 'female': 'af-ZA-AdriNeural'},
     'am': {'male': 'am-ET-AmehaNeural', 'female': 'am-ET-MekdesNeural'},
@@ -228,6 +245,60 @@ def get_voice(language_code: str, gender: str = 'female'):
     return VOICES[language_code][gender] or ''
 
 
+async def tts_edge(text: str, voice: str, rate: str) -> bytes:
+    '''Озвучка через edge-tts, звук собирается из потока прямо в память'''
+    data = io.BytesIO()
+    com = edge_tts.Communicate(text, voice, rate=rate)
+    async for chunk in com.stream():
+        if chunk['type'] == 'audio':
+            data.write(chunk['data'])
+    return data.getvalue()
+
+
+async def edge_worker():
+    '''Берет запросы из EDGE_QUEUE по одному и отдает результат в их future'''
+    while True:
+        text, voice, rate, future = await EDGE_QUEUE.get()
+        # тот кто ждал уже ушел по таймауту
+        if not future.set_running_or_notify_cancel():
+            continue
+        try:
+            future.set_result(await asyncio.wait_for(tts_edge(text, voice, rate), EDGE_TIMEOUT))
+        except Exception as error:
+            future.set_exception(error)
+
+
+async def edge_start():
+    global EDGE_QUEUE
+    EDGE_QUEUE = asyncio.Queue()
+    for _ in range(EDGE_WORKERS):
+        asyncio.get_running_loop().create_task(edge_worker())
+
+
+def get_edge_loop() -> asyncio.AbstractEventLoop:
+    '''Цикл asyncio озвучки, работает вечно в своем потоке'''
+    global EDGE_LOOP
+    with EDGE_LOOP_LOCK:
+        if EDGE_LOOP is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name='tts-loop', daemon=True).start()
+            asyncio.run_coroutine_threadsafe(edge_start(), loop).result()
+            EDGE_LOOP = loop
+        return EDGE_LOOP
+
+
+def tts_edge_sync(text: str, voice: str, rate: str) -> bytes:
+    '''Поставить озвучку в очередь цикла озвучки и дождаться результата'''
+    future = concurrent.futures.Future()
+    loop = get_edge_loop()
+    loop.call_soon_threadsafe(EDGE_QUEUE.put_nowait, (text, voice, rate, future))
+    try:
+        return future.result(EDGE_QUEUE_TIMEOUT)
+    except concurrent.futures.TimeoutError:
+        future.cancel()
+        raise
+
+
 @cachetools.func.ttl_cache(maxsize=10, ttl=10 * 60)
 def tts(text: str, voice: str = 'ru', rate: str = '+0%', gender: str = 'female') -> bytes:
     """
@@ -257,22 +328,8 @@ def tts(text: str, voice: str = 'ru', rate: str = '+0%', gender: str = 'female')
         text = text.replace('\r','') 
         text = text.replace('\n\n','\n')  
 
-        # Создаем временный файл для записи аудио
-        with tempfile.NamedTemporaryFile(suffix=".mp3", delete=True) as f: 
-            filename = f.name 
-
-        # Запускаем edge-tts для генерации аудио
-        com = edge_tts.Communicate(text, voice, rate=rate)
-        # com = edge_tts.Communicate(text, voice)
-        asyncio.run(com.save(filename))
-
-        # Читаем аудио из временного файла 
-        with open(filename, "rb") as f: 
-            data = io.BytesIO(f.read())
-
-        utils.remove_file(filename)
-        # Возвращаем байтовый поток с аудио
-        data = data.getvalue()
+        # edge-tts работает в своем постоянном цикле, без нового цикла и временного файла на каждый запрос
+        data = tts_edge_sync(text, voice, rate)
 
         return data
     except edge_tts.exceptions.NoAudioReceived:
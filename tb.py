@@ -3,14 +3,13 @@
 import chardet
 import concurrent.futures
 import datetime
+import functools
 import io
 import importlib
-import hashlib
 import os
 import pickle
 import re
 import subprocess
-import tempfile
 import traceback
 import threading
 import time
@@ -30,11 +29,18 @@ import my_init
 import my_genimg
 import my_db
 import my_ddg
+import my_debounce
+import my_dispatch
 import my_google
 import my_gemini
 import my_gpt4omini
 import my_groq
+import my_hedge
+import my_http
+import my_jobs
+import my_keys
 import my_log
+import my_mediacache
 import my_ocr
 import my_openrouter
 import my_pandoc
@@ -43,9 +49,10 @@ import my_stt
 import my_sum
 import my_trans
 import my_transcribe
+import my_trbatch
 import my_tts
 import utils
-from utils import async_run
+from my_dispatch import async_run
 
 
 START_TIME = time.time()
@@ -97,6 +104,7 @@ CHAT_LOCKS = {}
 
 # блокировка на выполнение одновременных команд sum, google, image, document handler, voice handler
 # {chat_id:threading.Lock()}
+# очереди тяжелых задач и их порядок между юзерами в my_jobs, см. job_submit
 GOOGLE_LOCKS = {}
 SUM_LOCKS = {}
 IMG_GEN_LOCKS = {}
@@ -126,11 +134,20 @@ CACHE_CHECK_PHONE = {}
 subscription_cache = {}
 
 # запоминаем прилетающие сообщения, если они слишком длинные и
-# были отправлены клиентом по кускам {id:[messages]}
-# ловим сообщение и ждем секунду не прилетит ли еще кусок
-MESSAGE_QUEUE = {}
+# были отправлены клиентом по кускам, части склеиваются и обрабатываются одним
+# запросом когда новые куски перестали приходить
+MESSAGE_QUEUE = my_debounce.Debouncer(lambda chat_id_full, parts: do_task_parts(parts), 'messages')
+# сколько ждать следующий кусок в зависимости от типа чата, секунды
+MESSAGE_QUEUE_DELAY = {'private': 1, 'group': 1.5, 'supergroup': 1.5}
+# клиент режет текст на куски по 4096 символов, кусок короче может быть
+# только последним, после него долго ждать незачем. Но короткий кусок может
+# прийти и раньше длинного (сообщения приходят не по порядку), в группах это
+# бывает чаще, поэтому и тут задержка зависит от типа чата
+MESSAGE_QUEUE_PART_LEN = 3500
+MESSAGE_QUEUE_DELAY_SHORT = {'private': 0.3, 'group': 0.5, 'supergroup': 0.5}
 # так же ловим пачки картинок(медиагруппы), телеграм их отправляет по одной
-MESSAGE_QUEUE_IMG = {}
+MESSAGE_QUEUE_IMG = my_debounce.Debouncer(lambda key, messages: job_submit('photo', messages[0], handle_photos, messages), 'images')
+MESSAGE_QUEUE_IMG_DELAY = 1
 
 # блокировать процесс отправки картинок что бы не было перемешивания разных запросов
 SEND_IMG_LOCK = threading.Lock()
@@ -149,8 +166,28 @@ DEBUG_MD_TO_HTML = {}
 # {user_id: 'chatbot'(gemini, gemini15 etc)}
 WHO_ANSWERED = {}
 
-# кеш для переводов в оперативной памяти
-TRANS_CACHE = my_db.SmartCache()
+# кеш для переводов в оперативной памяти {my_db.translation_key: translation}
+# при старте в него загружаются все переводы на самые популярные языки (tr_warmup)
+TRANS_CACHE = my_db.SmartCache(max_size=20000)
+# для скольких языков загружать
+TRANS_WARMUP_LANGS = 10
+# переводы которые делаются прямо сейчас {key: Future},
+# одновременные запросы того же текста ждут первый а не переводят заново
+TRANS_INFLIGHT = {}
+TRANS_INFLIGHT_LOCK = threading.Lock()
+# откуда брались переводы, для /stats
+TRANS_STATS = {'memory': 0, 'db': 0, 'translated': 0, 'waited': 0}
+# пакетный перевод всего интерфейса на язык (my_trbatch), запускается в фоне при
+# первом промахе tr для языка на который в базе еще нет ни одного перевода,
+# {lang: threading.Event}. Промахи его не ждут, переводятся сразу по одному
+TRANS_BATCHES = {}
+
+# ответы которые приходят потоком показываются сразу, сообщение с черновиком
+# редактируется не чаще чем раз в столько секунд (в группах реже, там лимиты жестче)
+STREAM_EDIT_INTERVAL = 1.5
+STREAM_EDIT_INTERVAL_GROUP = 3
+# черновик длиннее этого не обновляется, полный ответ может не влезть в одно сообщение
+STREAM_MAX_LEN = 3500
 
 
 # key - time.time() float
@@ -209,17 +246,72 @@ class RequestCounter:
 
 request_counter = RequestCounter()
 
-# {chat_id:lock}
-SHOW_ACTION_LOCKS = {}
+# действия (typing, upload_photo...) которые сейчас показываются в чатах
+# {(chat_id, thread_id, action): {'count': сколько запросов его показывают, 'started': time, 'next': time}}
+SHOW_ACTIONS = {}
+SHOW_ACTIONS_LOCK = threading.Lock()
+SHOW_ACTIONS_WAKEUP = threading.Event()
+# телеграм гасит уведомление через 5 секунд, повторяем чуть раньше
+SHOW_ACTION_INTERVAL = 4.5
+SHOW_ACTION_MAX_TIME = 60*5
+# после 429 не отправлять уведомления ни в какой чат до этого времени
+SHOW_ACTION_BACKOFF = 0
+
+
+@utils.async_run
+def show_action_daemon():
+    """One thread sends chat actions for all active ShowAction entries.
+    Several requests in the same chat with the same action share one entry,
+    on 429 all chats wait for retry_after."""
+    global SHOW_ACTION_BACKOFF
+    while True:
+        now = time.time()
+        with SHOW_ACTIONS_LOCK:
+            for key, entry in list(SHOW_ACTIONS.items()):
+                if now - entry['started'] > SHOW_ACTION_MAX_TIME:
+                    del SHOW_ACTIONS[key]
+                    my_log.log2(f'tb:show_action:stoped after 5min {key}')
+            due = [key for key, entry in SHOW_ACTIONS.items() if entry['next'] <= now] if now >= SHOW_ACTION_BACKOFF else []
+            for key in due:
+                SHOW_ACTIONS[key]['next'] = now + SHOW_ACTION_INTERVAL
+
+        for chat_id, thread_id, action in due:
+            if time.time() < SHOW_ACTION_BACKOFF:
+                break
+            try:
+                if thread_id:
+                    bot.send_chat_action(chat_id, action, message_thread_id = thread_id)
+                else:
+                    bot.send_chat_action(chat_id, action)
+            except Exception as error:
+                if 'Error code: 429' in str(error):
+                    retry_after = re.search(r'retry after (\d+)', str(error))
+                    SHOW_ACTION_BACKOFF = time.time() + (int(retry_after.group(1)) if retry_after else SHOW_ACTION_INTERVAL)
+                elif 'Forbidden: bot was blocked by the user' in str(error):
+                    with SHOW_ACTIONS_LOCK:
+                        SHOW_ACTIONS.pop((chat_id, thread_id, action), None)
+                else:
+                    my_log.log2(f'tb:show_action:run: {error}')
+
+        with SHOW_ACTIONS_LOCK:
+            times = [entry['next'] for entry in SHOW_ACTIONS.values()]
+        timeout = max(min(times) - time.time(), SHOW_ACTION_BACKOFF - time.time(), 0.05) if times else None
+        SHOW_ACTIONS_WAKEUP.wait(timeout)
+        SHOW_ACTIONS_WAKEUP.clear()
+
 
-class ShowAction(threading.Thread):
-    """A thread that can be stopped. Continuously sends a notification of activity to the chat.
-    Telegram automatically extinguishes the notification after 5 seconds, so it must be repeated.
+class ShowAction:
+    """Continuously shows a notification of activity in the chat while in context.
+    Telegram automatically extinguishes the notification after 5 seconds, so it must be repeated,
+    this is done by show_action_daemon for all chats at once.
 
     To use in the code, you need to do something like this:
     with ShowAction(message, 'typing'):
         do something and while doing it the notification does not go out
     """
+    actions = ["typing", "upload_photo", "record_video", "upload_video", "record_audio",
+               "upload_audio", "upload_document", "find_location", "record_video_note", "upload_video_note"]
+
     def __init__(self, message, action):
         """_summary_
 
@@ -228,51 +320,36 @@ class ShowAction(threading.Thread):
             action (_type_):  "typing", "upload_photo", "record_video", "upload_video", "record_audio", 
                               "upload_audio", "upload_document", "find_location", "record_video_note", "upload_video_note"
         """
-        super().__init__()
-        self.actions = [  "typing", "upload_photo", "record_video", "upload_video", "record_audio",
-                         "upload_audio", "upload_document", "find_location", "record_video_note", "upload_video_note"]
         assert action in self.actions, f'Допустимые actions = {self.actions}'
-        self.chat_id = message.chat.id
-        self.full_chat_id = get_topic_id(message)
-        self.thread_id = message.message_thread_id
-        self.is_topic = True if message.is_topic_message else False
-        self.action = action
+        thread_id = message.message_thread_id if message.is_topic_message else 0
+        self.key = (message.chat.id, thread_id, action)
+        self.entry = None
+        self.is_running = False
+
+    def start(self):
+        if self.is_running:
+            return
         self.is_running = True
-        self.timerseconds = 1
-        self.started_time = time.time()
-
-    def run(self):
-        if self.full_chat_id not in SHOW_ACTION_LOCKS:
-            SHOW_ACTION_LOCKS[self.full_chat_id] = threading.Lock()
-        with SHOW_ACTION_LOCKS[self.full_chat_id]:
-            while self.is_running:
-                if time.time() - self.started_time > 60*5:
-                    self.stop()
-                    my_log.log2(f'tb:show_action:stoped after 5min [{self.chat_id}] [{self.thread_id}] is topic: {self.is_topic} action: {self.action}')
-                    return
-                try:
-                    if self.is_topic:
-                        bot.send_chat_action(self.chat_id, self.action, message_thread_id = self.thread_id)
-                    else:
-                        bot.send_chat_action(self.chat_id, self.action)
-                except Exception as error:
-                    if 'A request to the Telegram API was unsuccessful. Error code: 429. Description: Too Many Requests' not in str(error):
-                        if 'Forbidden: bot was blocked by the user' in str(error):
-                            self.stop()
-                            return
-                        my_log.log2(f'tb:show_action:run: {error}')
-                n = 50
-                while n > 0:
-                    time.sleep(0.1)
-                    n = n - self.timerseconds
+        with SHOW_ACTIONS_LOCK:
+            if self.key in SHOW_ACTIONS:
+                self.entry = SHOW_ACTIONS[self.key]
+                self.entry['count'] += 1
+                self.entry['started'] = time.time()
+                return
+            self.entry = {'count': 1, 'started': time.time(), 'next': 0}
+            SHOW_ACTIONS[self.key] = self.entry
+        SHOW_ACTIONS_WAKEUP.set()
 
     def stop(self):
-        self.timerseconds = 50
+        if not self.is_running:
+            return
         self.is_running = False
-        try:
-            bot.send_chat_action(self.chat_id, 'cancel', message_thread_id = self.thread_id)
-        except Exception as error:
-            my_log.log2(f'tb:show_action: {error}')
+        with SHOW_ACTIONS_LOCK:
+            # запись могла быть удалена демоном по таймауту и создана заново другим запросом
+            if SHOW_ACTIONS.get(self.key) is self.entry:
+                self.entry['count'] -= 1
+                if self.entry['count'] <= 0:
+                    del SHOW_ACTIONS[self.key]
 
     def __enter__(self):
         self.start()
@@ -282,6 +359,51 @@ class ShowAction(threading.Thread):
         self.stop()
 
 
+def queue_notice(message: telebot.types.Message):
+    '''on_wait for my_jobs, tells user his place in the queue in one message
+    that is edited when the place changes and removed when the job starts'''
+    notice_message = []
+
+    def on_wait(position: int):
+        lang = get_lang(get_topic_id(message), message)
+        text = f'{tr("Server is busy, you are in queue", lang)} #{position}'
+        try:
+            if position == 0:
+                if notice_message:
+                    bot.delete_message(notice_message[0].chat.id, notice_message[0].message_id)
+            elif not notice_message:
+                notice_message.append(bot.reply_to(message, text, disable_notification=True))
+            else:
+                bot.edit_message_text(chat_id=notice_message[0].chat.id,
+                                      message_id=notice_message[0].message_id,
+                                      text=text)
+        except Exception as error:
+            my_log.log2(f'tb:queue_notice: {error}')
+
+    return on_wait
+
+
+def job_submit(job: str, message: telebot.types.Message, func, *args,
+               priority: int = my_jobs.PRIORITY_NORMAL, **kwargs):
+    '''Run func(*args, **kwargs) as a heavy job (see my_jobs.submit) of the chat of the message,
+    admins go first. The job waits for its slot in the queue, not in a worker of the dispatcher'''
+    chat_id_full = get_topic_id(message)
+    if message.from_user.id in cfg.admins:
+        priority = my_jobs.PRIORITY_ADMIN
+    return my_jobs.submit(job, chat_id_full, func, args, kwargs, priority, queue_notice(message))
+
+
+def async_job(job: str):
+    '''Decorator like async_run but the handler func(message, ...) runs as a heavy job
+    of the type job, see job_submit'''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(message, *args, **kwargs):
+            job_submit(job, message, func, message, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
 def get_uptime() -> str:
     """Calculates and returns the uptime in a human-readable format (English).
 
@@ -326,39 +448,79 @@ def tr(text: str, lang: str, help: str = '', save_cache: bool = True) -> str:
     if lang == 'ua':
         lang = 'uk'
 
-    cache_key = (text, lang, help)
-    cache_key_hash = hashlib.md5(str(cache_key).encode()).hexdigest()
+    cache_key_hash = my_db.translation_key(text, lang, help)
     translated = TRANS_CACHE.get(cache_key_hash)
     if translated:
+        tr_count('memory')
         return translated
 
+    with TRANS_INFLIGHT_LOCK:
+        future = TRANS_INFLIGHT.get(cache_key_hash)
+        waiting = future is not None
+        if not waiting:
+            future = concurrent.futures.Future()
+            TRANS_INFLIGHT[cache_key_hash] = future
+    if waiting:
+        tr_count('waited')
+        try:
+            return future.result(timeout=120)
+        except Exception as error:
+            my_log.log_translate(f'tb:tr: waiting for translation failed {error}\n\n{text}\n\n{lang}')
+            return text
+
+    translated = text
+    try:
+        translated = tr_(text, lang, help, save_cache, cache_key_hash)
+    finally:
+        with TRANS_INFLIGHT_LOCK:
+            del TRANS_INFLIGHT[cache_key_hash]
+        future.set_result(translated)
+    return translated
+
+
+def tr_count(source: str):
+    with TRANS_INFLIGHT_LOCK:
+        TRANS_STATS[source] += 1
+
+
+def tr_(text: str, lang: str, help: str, save_cache: bool, cache_key_hash: str) -> str:
+    '''Translation from db or from translators, result is saved in caches'''
     translated = my_db.get_translation(text, lang, help)
     if translated:
+        tr_count('db')
         TRANS_CACHE.set(cache_key_hash, translated)
         return translated
 
+    # первый промах для нового языка запускает перевод всего интерфейса пачками
+    # в фоне, остальные строки потом будут браться из базы
+    if save_cache:
+        tr_batch(lang)
+
+    tr_count('translated')
     translated = ''
 
+    # переводчики спрашиваются по очереди, следующий запускается параллельно
+    # если предыдущий не ответил или думает дольше обычного
     if help:
-        translated = my_groq.translate(text, to_lang=lang, help=help)
-        if not translated:
-            # time.sleep(1)
+        _, translated = my_hedge.hedge(
+            ('tr_groq', lambda: my_groq.translate(text, to_lang=lang, help=help)),
             # try again and another ai engine
-            translated = my_gemini.translate(text, to_lang=lang, help=help)
-            if not translated:
-                my_log.log_translate(f'gemini\n\n{text}\n\n{lang}\n\n{help}')
-
-    if not translated:
-        translated = my_trans.translate_text2(text, lang)
+            ('tr_gemini', lambda: my_gemini.translate(text, to_lang=lang, help=help)),
+            )
+        if not translated:
+            my_log.log_translate(f'gemini\n\n{text}\n\n{lang}\n\n{help}')
 
     if not translated:
-        translated = my_trans.translate_deepl(text, to_lang = lang)
-
-    if not translated and not help:
-        translated = my_groq.translate(text, to_lang=lang, help=help)
-
-    if not translated and not help:
-        translated = my_gemini.translate(text, to_lang=lang, help=help)
+        providers = [
+            ('tr_trans', lambda: my_trans.translate_text2(text, lang)),
+            ('tr_deepl', lambda: my_trans.translate_deepl(text, to_lang = lang)),
+            ]
+        if not help:
+            providers += [
+                ('tr_groq', lambda: my_groq.translate(text, to_lang=lang, help=help)),
+                ('tr_gemini', lambda: my_gemini.translate(text, to_lang=lang, help=help)),
+                ]
+        _, translated = my_hedge.hedge(*providers)
 
     if not translated:
         translated = text
@@ -370,6 +532,62 @@ def tr(text: str, lang: str, help: str = '', save_cache: bool = True) -> str:
     return translated
 
 
+def tr_batch(lang: str) -> threading.Event:
+    '''Start batch translation of interface strings to the language in background,
+    once per language and only if there are no translations to it in db yet.
+    Returns event that is set when it is done.'''
+    with TRANS_INFLIGHT_LOCK:
+        if lang in TRANS_BATCHES:
+            return TRANS_BATCHES[lang]
+        event = threading.Event()
+        TRANS_BATCHES[lang] = event
+
+    if my_db.get_translations_count(lang):
+        # язык уже известен, его строки переводятся по одной по мере надобности
+        event.set()
+        return event
+
+    def worker():
+        try:
+            for original, lang_, help, translation in my_trbatch.translate_lang(lang):
+                TRANS_CACHE.set(my_db.translation_key(original, lang_, help), translation)
+        except Exception as error:
+            error_traceback = traceback.format_exc()
+            my_log.log_translate(f'tb:tr_batch: {lang} {error}\n\n{error_traceback}')
+        finally:
+            event.set()
+
+    # долгая фоновая работа, не для пула обработчиков
+    threading.Thread(target=worker, daemon=True).start()
+    return event
+
+
+@async_run
+def tr_warmup():
+    '''Load translations for the most popular languages into memory cache'''
+    try:
+        start_time = time.time()
+        langs = my_db.get_top_langs(TRANS_WARMUP_LANGS)
+        translations = my_db.get_translations(langs)
+        for original, lang, help, translation in translations:
+            if translation:
+                TRANS_CACHE.set(my_db.translation_key(original, lang, help), translation)
+        my_log.log2(f'tb:tr_warmup: {len(translations)} translations for {langs} loaded in {time.time() - start_time:.1f}s')
+    except Exception as error:
+        error_traceback = traceback.format_exc()
+        my_log.log2(f'tb:tr_warmup: {error}\n\n{error_traceback}')
+
+
+def get_tr_stats_text() -> str:
+    '''Where translations came from, for /stats'''
+    with TRANS_INFLIGHT_LOCK:
+        s = dict(TRANS_STATS)
+    total = sum(s.values())
+    hit_rate = (total - s['translated']) / total if total else 0
+    return (f"Translations: memory {s['memory']}, db {s['db']}, translated {s['translated']}, "
+            f"waited {s['waited']}, hit rate {hit_rate:.0%}, cached {len(TRANS_CACHE.cache)}, batched langs {len(TRANS_BATCHES)}")
+
+
 def add_to_bots_mem(query: str, resp: str, chat_id_full: str):
     """
     Updates the memory of the selected bot based on the chat mode.
@@ -402,7 +620,7 @@ def add_to_bots_mem(query: str, resp: str, chat_id_full: str):
         my_ddg.update_mem(query, resp, chat_id_full)
 
 
-def img2txt(text, lang: str, chat_id_full: str, query: str = '') -> str:
+def img2txt(text, lang: str, chat_id_full: str, query: str = '', file_unique_id: str = '') -> str:
     """
     Generate the text description of an image.
 
@@ -410,6 +628,7 @@ def img2txt(text, lang: str, chat_id_full: str, query: str = '') -> str:
         text (str): The image file URL or downloaded data(bytes).
         lang (str): The language code for the image description.
         chat_id_full (str): The full chat ID.
+        file_unique_id (str): Telegram id of the image, if given the answer is cached.
 
     Returns:
         str: The text description of the image.
@@ -426,11 +645,14 @@ def img2txt(text, lang: str, chat_id_full: str, query: str = '') -> str:
     if not my_db.get_user_property(chat_id_full, 'chat_mode'):
         my_db.set_user_property(chat_id_full, 'chat_mode', cfg.chat_mode_default)
 
-    text = ''
+    # ту же картинку с тем же вопросом уже описывали
+    text = my_mediacache.get_result(file_unique_id, 'img2txt', f'{lang}\n{query}')
 
     try:
-        # text = my_gemini.img2txt(data, query, temp = 1,  model = 'gemini-1.5-flash')
-        text = my_gemini.img2txt(data, query, temp = 1,  model = 'gemini-1.5-pro-exp-0801')
+        if not text:
+            # text = my_gemini.img2txt(data, query, temp = 1,  model = 'gemini-1.5-flash')
+            text = my_gemini.img2txt(data, query, temp = 1,  model = 'gemini-1.5-pro-exp-0801')
+            my_mediacache.put_result(file_unique_id, 'img2txt', text, f'{lang}\n{query}')
         # text = my_gemini.img2txt(data, query, temp = 1,  model = 'gemini-1.5-pro')
 
         # if not text:
@@ -602,7 +824,8 @@ def is_for_me(message: telebot.types.Message) -> bool:
         return (True, cmd)
 
 
-@async_run
+# демон работает в своем потоке а не в пуле обработчиков
+@utils.async_run
 def log_group_daemon():
     """
     This daemon function processes messages stored in the LOG_GROUP_MESSAGES queue.
@@ -1396,6 +1619,20 @@ def get_keyboard(kbd: str, message: telebot.types.Message, flag: str = '', paylo
         raise f"Неизвестная клавиатура '{kbd}'"
 
 
+@async_job('google')
+def search_pics(message: telebot.types.Message, hash_: str):
+    '''Поиск картинок в дак дак гоу по запросу из SEARCH_PICS, для кнопки под ответом /google'''
+    with ShowAction(message, 'upload_photo'):
+        query = SEARCH_PICS[hash_]
+        images = my_ddg.get_images(query)
+        medias = [telebot.types.InputMediaPhoto(x[0], caption = x[1][:900]) for x in images]
+        msgs_ids = bot.send_media_group(message.chat.id, medias, reply_to_message_id=message.message_id, disable_notification=True)
+        # for _ in range(10):
+        #     my_db.add_msg(chat_id_full, 'gemini15_flash')
+        #     time.sleep(0.01)
+        log_message(msgs_ids)
+
+
 @bot.callback_query_handler(func=authorized_callback)
 @async_run
 def callback_inline_thread(call: telebot.types.CallbackQuery):
@@ -1484,19 +1721,7 @@ def callback_inline_thread(call: telebot.types.CallbackQuery):
 
         elif call.data.startswith('search_pics_'):
             # Поиск картинок в дак дак гоу
-            if chat_id_full not in GOOGLE_LOCKS:
-                GOOGLE_LOCKS[chat_id_full] = threading.Lock()
-            with GOOGLE_LOCKS[chat_id_full]:
-                with ShowAction(message, 'upload_photo'):
-                    hash_ = call.data[12:]
-                    query = SEARCH_PICS[hash_]
-                    images = my_ddg.get_images(query)
-                    medias = [telebot.types.InputMediaPhoto(x[0], caption = x[1][:900]) for x in images]
-                    msgs_ids = bot.send_media_group(message.chat.id, medias, reply_to_message_id=message.message_id, disable_notification=True)
-                    # for _ in range(10):
-                    #     my_db.add_msg(chat_id_full, 'gemini15_flash')
-                    #     time.sleep(0.01)
-                    log_message(msgs_ids)
+            search_pics(message, call.data[12:])
 
 
         elif call.data == 'download_saved_text':
@@ -1660,8 +1885,23 @@ def callback_inline_thread(call: telebot.types.CallbackQuery):
                                   text = MSG_CONFIG, reply_markup=get_keyboard('config', message))
 
 
+def download_file(file) -> tuple:
+    '''Download telegram file (voice, photo, document...) through the media cache.
+    Returns (data, telegram file_path), the path is needed for the file extension.
+    Raises ApiTelegramException like bot.get_file (file is too big)'''
+    data = my_mediacache.get(file.file_unique_id)
+    file_path = my_mediacache.get_file_path(file.file_unique_id)
+    if data and file_path:
+        return data, file_path
+    file_info = bot.get_file(file.file_id)
+    data = bot.download_file(file_info.file_path)
+    my_mediacache.put(file.file_unique_id, data)
+    my_mediacache.put_file_path(file.file_unique_id, file_info.file_path)
+    return data, file_info.file_path
+
+
 @bot.message_handler(content_types = ['voice', 'video', 'video_note', 'audio'], func=authorized)
-@async_run
+@async_job('voice')
 def handle_voice(message: telebot.types.Message):
     """Автоматическое распознавание текст из голосовых сообщений и аудио файлов"""
     is_private = message.chat.type == 'private'
@@ -1683,20 +1923,13 @@ def handle_voice(message: telebot.types.Message):
 
     with lock:
         with semaphore_talks:
-            # Скачиваем аудиофайл во временный файл
+            # Скачиваем аудиофайл в память, ffmpeg получит его через трубу
+            file = message.voice or message.audio or message.video or message.video_note or message.document
+            if not file:
+                bot_reply_tr(message, 'Unknown message type')
+                return
             try:
-                if message.voice:
-                    file_info = bot.get_file(message.voice.file_id)
-                elif message.audio:
-                    file_info = bot.get_file(message.audio.file_id)
-                elif message.video:
-                    file_info = bot.get_file(message.video.file_id)
-                elif message.video_note:
-                    file_info = bot.get_file(message.video_note.file_id)
-                elif message.document:
-                    file_info = bot.get_file(message.document.file_id)
-                else:
-                    bot_reply_tr(message, 'Unknown message type')
+                downloaded_file, _ = download_file(file)
             except telebot.apihelper.ApiTelegramException as error:
                 if 'file is too big' in str(error):
                     bot_reply_tr(message, 'Too big file.')
@@ -1704,14 +1937,6 @@ def handle_voice(message: telebot.types.Message):
                 else:
                     raise error
 
-            # Создание временного файла
-            with tempfile.NamedTemporaryFile(delete=True) as temp_file:
-                file_path = temp_file.name + (utils.get_file_ext(file_info.file_path) or 'unknown')
-
-            downloaded_file = bot.download_file(file_info.file_path)
-            with open(file_path, 'wb') as new_file:
-                new_file.write(downloaded_file)
-
             # Распознаем текст из аудио
             if my_db.get_user_property(chat_id_full, 'voice_only_mode'):
                 action = 'record_audio'
@@ -1721,13 +1946,13 @@ def handle_voice(message: telebot.types.Message):
 
                 try:
                     prompt = tr('Распознай аудиозапись и исправь ошибки.', lang)
-                    text = my_stt.stt(file_path, lang, chat_id_full, prompt)
+                    # пересланное или отправленное повторно голосовое не скачивается (my_mediacache)
+                    # и не распознается заново, my_stt берет текст из кеша распознавания по хешу звука
+                    text = my_stt.stt(downloaded_file, lang, chat_id_full, prompt)
                 except Exception as error_stt:
                     my_log.log2(f'tb:handle_voice: {error_stt}')
                     text = ''
 
-                utils.remove_file(file_path)
-
                 text = text.strip()
                 # Отправляем распознанный текст
                 if text:
@@ -1762,7 +1987,7 @@ def handle_voice(message: telebot.types.Message):
 
 
 @bot.message_handler(content_types = ['document'], func=authorized)
-@async_run
+@async_job('document')
 def handle_document(message: telebot.types.Message):
     """Обработчик документов"""
     chat_id_full = get_topic_id(message)
@@ -1825,14 +2050,13 @@ def handle_document(message: telebot.types.Message):
                     return
                 with ShowAction(message, 'typing'):
                     try:
-                        file_info = bot.get_file(message.document.file_id)
+                        downloaded_file, tg_file_path = download_file(message.document)
                     except telebot.apihelper.ApiTelegramException as error:
                         if 'file is too big' in str(error):
                             bot_reply_tr(message, 'Too big file')
                             return
                         else:
                             raise error
-                    downloaded_file = bot.download_file(file_info.file_path)
                     file_bytes = io.BytesIO(downloaded_file)
                     text = ''
                     if message.document.mime_type == 'application/pdf':
@@ -1842,7 +2066,7 @@ def handle_document(message: telebot.types.Message):
                         if not text.strip() or len(text) < 100:
                             text = my_ocr.get_text_from_pdf(file_bytes, get_ocr_language(message))
                     elif message.document.mime_type in pandoc_support:
-                        ext = utils.get_file_ext(file_info.file_path)
+                        ext = utils.get_file_ext(tg_file_path)
                         text = my_pandoc.fb2_to_text(file_bytes.read(), ext)
                     elif message.document.mime_type == 'image/svg+xml':
                         try:
@@ -1855,7 +2079,7 @@ def handle_document(message: telebot.types.Message):
                                         caption=message.document.file_name + '.png',
                                         reply_markup=get_keyboard('translate', message),
                                         disable_notification=True)
-                            text = img2txt(image, lang, chat_id_full, message.caption)
+                            text = img2txt(image, lang, chat_id_full, message.caption, message.document.file_unique_id)
                             # my_db.add_msg(chat_id_full, 'gemini15_flash')
                             if text:
                                 text = utils.bot_markdown_to_html(text)
@@ -1918,9 +2142,8 @@ def handle_document(message: telebot.types.Message):
                         bot_reply(message, f'{tr("Unsupported file type.", lang)} {document.mime_type}')
                         return
                     # скачиваем документ в байтовый поток
-                    file_id = message.document.file_id
                     try:
-                        file_info = bot.get_file(file_id)
+                        file, _ = download_file(message.document)
                     except telebot.apihelper.ApiTelegramException as error:
                         if 'file is too big' in str(error):
                             bot_reply_tr(message, 'Too big file.')
@@ -1928,9 +2151,12 @@ def handle_document(message: telebot.types.Message):
                         else:
                             raise error
                     file_name = message.document.file_name + '.txt'
-                    file = bot.download_file(file_info.file_path)
                     # распознаем текст в документе с помощью функции get_text
-                    text = my_ocr.get_text_from_pdf(file, get_ocr_language(message))
+                    ocr_lang = get_ocr_language(message)
+                    text = my_mediacache.get_result(document.file_unique_id, 'ocr', ocr_lang)
+                    if not text:
+                        text = my_ocr.get_text_from_pdf(file, ocr_lang)
+                        my_mediacache.put_result(document.file_unique_id, 'ocr', text, ocr_lang)
                     # отправляем распознанный текст пользователю
                     if text.strip() != '':
                         # если текст слишком длинный, отправляем его в виде текстового файла
@@ -1952,29 +2178,19 @@ def download_image_from_message(message: telebot.types.Message) -> bytes:
     '''Download image from message'''
     try:
         if message.photo:
-            photo = message.photo[-1]
-            try:
-                file_info = bot.get_file(photo.file_id)
-            except telebot.apihelper.ApiTelegramException as error:
-                if 'file is too big' in str(error):
-                    bot_reply_tr(message, 'Too big file.')
-                    return
-                else:
-                    raise error
-            image = bot.download_file(file_info.file_path)
+            file = message.photo[-1]
         elif message.document:
-            file_id = message.document.file_id
-            try:
-                file_info = bot.get_file(file_id)
-            except telebot.apihelper.ApiTelegramException as error:
-                if 'file is too big' in str(error):
-                    bot_reply_tr(message, 'Too big file.')
-                    return
-                else:
-                    raise error
-            file = bot.download_file(file_info.file_path)
-            fp = io.BytesIO(file)
-            image = fp.read()
+            file = message.document
+        else:
+            return b''
+        try:
+            image, _ = download_file(file)
+        except telebot.apihelper.ApiTelegramException as error:
+            if 'file is too big' in str(error):
+                bot_reply_tr(message, 'Too big file.')
+                return b''
+            else:
+                raise error
         return image
     except Exception as error:
         traceback_error = traceback.format_exc()
@@ -2000,34 +2216,18 @@ def handle_photo(message: telebot.types.Message):
     """Обработчик фотографий. Сюда же попадают новости которые создаются как фотография
     + много текста в подписи, и пересланные сообщения в том числе"""
 
-    chat_id_full = get_topic_id(message)
-    lang = get_lang(chat_id_full, message)
-
-
-
     # catch groups of images up to 10
-    if chat_id_full not in MESSAGE_QUEUE_IMG:
-        MESSAGE_QUEUE_IMG[chat_id_full] = [message,]
-        last_state = MESSAGE_QUEUE_IMG[chat_id_full]
-        n = 10
-        while n > 0:
-            n -= 1
-            time.sleep(0.1)
-            new_state = MESSAGE_QUEUE_IMG[chat_id_full]
-            if last_state != new_state:
-                last_state = new_state
-                n = 10
+    if message.media_group_id:
+        MESSAGE_QUEUE_IMG.add((get_topic_id(message), message.media_group_id), message, MESSAGE_QUEUE_IMG_DELAY)
     else:
-        MESSAGE_QUEUE_IMG[chat_id_full].append(message)
-        return
+        job_submit('photo', message, handle_photos, [message,])
 
 
-    if len(MESSAGE_QUEUE_IMG[chat_id_full]) > 1:
-        MESSAGES = MESSAGE_QUEUE_IMG[chat_id_full]
-    else:
-        MESSAGES = [message,]
-    del MESSAGE_QUEUE_IMG[chat_id_full]
-
+def handle_photos(MESSAGES: list):
+    '''Обработка одной картинки или альбома (медиагруппы), MESSAGES - сообщения с картинками'''
+    message = MESSAGES[0]
+    chat_id_full = get_topic_id(message)
+    lang = get_lang(chat_id_full, message)
 
     try:
         is_private = message.chat.type == 'private'
@@ -2100,7 +2300,8 @@ def handle_photo(message: telebot.types.Message):
                             my_log.log2(f'tb:handle_photo: не удалось распознать документ или фото {str(message)}')
                             return
 
-                        text = img2txt(image, lang, chat_id_full, message.caption)
+                        file = message.photo[-1] if message.photo else message.document
+                        text = img2txt(image, lang, chat_id_full, message.caption, file.file_unique_id if file else '')
                         # my_db.add_msg(chat_id_full, 'gemini15_flash')
                         if text:
                             text = utils.bot_markdown_to_html(text)
@@ -2113,32 +2314,8 @@ def handle_photo(message: telebot.types.Message):
                     return
                 elif state == 'ocr':
                     with ShowAction(message, 'typing'):
-                        if message.photo:
-                            photo = message.photo[-1]
-                            try:
-                                file_info = bot.get_file(photo.file_id)
-                            except telebot.apihelper.ApiTelegramException as error:
-                                if 'file is too big' in str(error):
-                                    bot_reply_tr(message, 'Too big file.')
-                                    return
-                                else:
-                                    raise error
-                            image = bot.download_file(file_info.file_path)
-                        elif message.document:
-                            # скачиваем документ в байтовый поток
-                            file_id = message.document.file_id
-                            try:
-                                file_info = bot.get_file(file_id)
-                            except telebot.apihelper.ApiTelegramException as error:
-                                if 'file is too big' in str(error):
-                                    bot_reply_tr(message, 'Too big file.')
-                                    return
-                                else:
-                                    raise error
-                            file = bot.download_file(file_info.file_path)
-                            fp = io.BytesIO(file)
-                            image = fp.read()
-                        else:
+                        image = download_image_from_message(message)
+                        if not image:
                             my_log.log2(f'tb:handle_photo: не удалось распознать документ или фото {str(message)}')
                             return
 
@@ -2146,7 +2323,11 @@ def handle_photo(message: telebot.types.Message):
                         llang = get_ocr_language(message)
                         if message.caption.strip()[3:]:
                             llang = message.caption.strip()[3:].strip()
-                        text = my_ocr.get_text_from_image(image, llang)
+                        file = message.photo[-1] if message.photo else message.document
+                        text = my_mediacache.get_result(file.file_unique_id, 'ocr', llang)
+                        if not text:
+                            text = my_ocr.get_text_from_image(image, llang)
+                            my_mediacache.put_result(file.file_unique_id, 'ocr', text, llang)
                         # отправляем распознанный текст пользователю
                         if text.strip() != '':
                             bot_reply(message, text, parse_mode='',
@@ -2409,9 +2590,7 @@ def translation_gui(message: telebot.types.Message):
                     if new_translation:
                         my_db.update_translation(original, lang, help, new_translation)
 
-                        cache_key = (original, lang, help)
-                        cache_key_hash = hashlib.md5(str(cache_key).encode()).hexdigest()
-                        TRANS_CACHE.set(cache_key_hash, new_translation)
+                        TRANS_CACHE.set(my_db.translation_key(original, lang, help), new_translation)
 
                         translated_counter += 1
                         bot_reply(message, f'New translation:\n\n{new_translation}', disable_web_page_preview=True)
@@ -3063,7 +3242,7 @@ def language(message: telebot.types.Message):
 
 
 # @bot.message_handler(commands=['tts'], func=authorized)
-@async_run
+@async_job('tts')
 def tts(message: telebot.types.Message, caption = None):
     """ /tts [ru|en|uk|...] [+-XX%] <текст>
         /tts <URL>
@@ -3185,7 +3364,7 @@ def tts(message: telebot.types.Message, caption = None):
 
 
 @bot.message_handler(commands=['google','Google'], func=authorized)
-@async_run
+@async_job('google')
 def google(message: telebot.types.Message):
     """ищет в гугле перед ответом"""
     chat_id_full = get_topic_id(message)
@@ -3339,7 +3518,7 @@ def image_bing_gen(message: telebot.types.Message):
 
 
 @bot.message_handler(commands=['image','img', 'IMG', 'Image', 'Img', 'i', 'I', 'imagine', 'imagine:', 'Imagine', 'Imagine:', 'generate', 'gen', 'Generate', 'Gen', 'art', 'Art'], func=authorized)
-@async_run
+@async_job('image')
 def image_gen(message: telebot.types.Message):
     """Generates a picture from a description"""
     chat_id_full = get_topic_id(message)
@@ -3640,10 +3819,29 @@ def stats(message: telebot.types.Message):
         msg += f'\nNew users in 7 day: {my_db.count_new_user_in_days(7)}'
         msg += f'\nNew users in 30 day: {my_db.count_new_user_in_days(30)}'
 
+        users_cache = my_db.get_users_cache_stats()
+        msg += f'\n\nUsers cache: {users_cache["size"]}/{users_cache["max_size"]}, hits {users_cache["hits"]}, misses {users_cache["misses"]}, evictions {users_cache["evictions"]}, hit rate {users_cache["hit_rate"]:.1%}'
+        stt_cache = my_db.get_stt_cache_stats()
+        msg += f'\nSTT cache: hits {stt_cache["hits"]}, misses {stt_cache["misses"]}, written {stt_cache["written"]}, evicted {stt_cache["evicted"]}, hit rate {stt_cache["hit_rate"]:.1%}'
+        msg_queue = my_db.get_msg_queue_stats()
+        msg += f'\nMsg counter queue: depth {msg_queue["depth"]} (max {msg_queue["max_depth"]}), written {msg_queue["written"]} in {msg_queue["batches"]} batches (max {msg_queue["max_batch"]}), full {msg_queue["full"]}, dropped {msg_queue["dropped"]}'
+        http_stats = my_http.get_stats_text()
+        if http_stats:
+            msg += f'\n\n{http_stats.strip()}'
         msg += f'\n\nGemini keys: {len(my_gemini.ALL_KEYS)+len(cfg.gemini_keys)}'
         msg += f'\nGroq keys: {len(my_groq.ALL_KEYS)}'
         msg += f'\nHuggingface keys: {len(my_genimg.ALL_KEYS)}'
         msg += f'\nDEEPL keys: {len(my_trans.ALL_KEYS)+len(cfg.DEEPL_KEYS if hasattr(cfg, "DEEPL_KEYS") else [])}'
+        msg += f'\n\n{my_keys.get_stats_text()}'
+        msg += f'\n\n{get_tr_stats_text()}'
+        msg += f'\n\n{my_dispatch.get_stats_text()}'
+        msg += f'\n\n{my_mediacache.get_stats_text()}'
+        jobs_stats = my_jobs.get_stats_text()
+        if jobs_stats:
+            msg += f'\n{jobs_stats}'
+        hedge_stats = my_hedge.get_stats_text()
+        if hedge_stats:
+            msg += f'\n\n{hedge_stats}'
         msg += f'\n\n Uptime: {get_uptime()}'
 
         bot_reply(message, msg)
@@ -3951,8 +4149,32 @@ def ping(message: telebot.types.Message):
     bot.reply_to(message, 'pong')
 
 
+def transcribe_progress(message: telebot.types.Message):
+    '''Callback for my_transcribe.watch, shows how many parts of the video
+    are transcribed in one message that is removed when all parts are ready'''
+    lang = get_lang(get_topic_id(message), message)
+    progress_message = []
+
+    def callback(done: int, total: int):
+        text = f'{tr("Transcribed", lang)} {done}/{total}'
+        try:
+            if done == total:
+                if progress_message:
+                    bot.delete_message(progress_message[0].chat.id, progress_message[0].message_id)
+            elif not progress_message:
+                progress_message.append(bot.reply_to(message, text, disable_notification=True))
+            else:
+                bot.edit_message_text(chat_id=progress_message[0].chat.id,
+                                      message_id=progress_message[0].message_id,
+                                      text=text)
+        except Exception as error:
+            my_log.log2(f'tb:transcribe_progress: {error}')
+
+    return callback
+
+
 @bot.message_handler(commands=['sum'], func=authorized)
-@async_run
+@async_job('sum')
 def summ_text(message: telebot.types.Message):
 
     chat_id_full = get_topic_id(message)
@@ -4004,7 +4226,8 @@ def summ_text(message: telebot.types.Message):
                                 has_subs = my_sum.check_ytb_subs_exists(url)
                                 if not has_subs and ('/youtu.be/' in url or 'youtube.com/' in url):
                                     bot_reply_tr(message, 'Видео с ютуба не содержит субтитров, обработка может занять некоторое время.')
-                                res, text = my_sum.summ_url(url, lang = lang, deep = False)
+                                with my_transcribe.watch(url, transcribe_progress(message)):
+                                    res, text = my_sum.summ_url(url, lang = lang, deep = False)
                                 my_db.set_user_property(chat_id_full, 'saved_file_name', url + '.txt')
                                 my_db.set_user_property(chat_id_full, 'saved_file', text)
                             except Exception as error2:
@@ -4666,6 +4889,95 @@ def send_long_message(message: telebot.types.Message, resp: str, parse_mode:str
                           allow_voice=allow_voice)
 
 
+class StreamMessage:
+    '''Shows streamed answer of LLM by editing one message while it is generated.
+
+    Object is passed to the model as stream_callback, it is called with the text
+    received so far. The first call sends a reply with the beginning of the answer,
+    next calls edit it not more often than every STREAM_EDIT_INTERVAL seconds
+    (telegram does not like frequent edits, in groups even less).
+    When the answer is ready finish() puts the final text with the keyboard
+    into the same message, if the answer does not fit into one message the
+    draft is deleted and the answer has to be sent as usual with bot_reply.
+    '''
+    def __init__(self, message: telebot.types.Message):
+        self.message = message
+        self.interval = STREAM_EDIT_INTERVAL if message.chat.type == 'private' else STREAM_EDIT_INTERVAL_GROUP
+        self.draft = None
+        self.last_edit = 0
+        self.last_text = ''
+        self.stopped = False
+
+    def __call__(self, text: str):
+        if self.stopped or not text.strip() or time.time() - self.last_edit < self.interval:
+            return
+        if len(text) > STREAM_MAX_LEN:
+            # дальше одно сообщение все равно не вместит, ждем полный ответ
+            text = text[:STREAM_MAX_LEN] + '...'
+            self.stopped = True
+        self.last_edit = time.time()
+        html = utils.bot_markdown_to_html(text)
+        try:
+            self.edit(html, 'HTML')
+        except Exception as error:
+            if 'message is not modified' in str(error):
+                return
+            # недописанный markdown может не разбираться, показываем как есть
+            try:
+                self.edit(text, '')
+            except Exception as error2:
+                my_log.log2(f'tb:StreamMessage: {error2}')
+                self.stopped = True
+
+    def edit(self, text: str, parse_mode: str, reply_markup: telebot.types.InlineKeyboardMarkup = None):
+        preview = telebot.types.LinkPreviewOptions(is_disabled=True)
+        if not self.draft:
+            self.draft = bot.reply_to(self.message, text, parse_mode=parse_mode,
+                                      link_preview_options=preview, reply_markup=reply_markup)
+        else:
+            m = bot.edit_message_text(chat_id=self.draft.chat.id, message_id=self.draft.message_id,
+                                      text=text, parse_mode=parse_mode,
+                                      link_preview_options=preview, reply_markup=reply_markup)
+            if isinstance(m, telebot.types.Message):
+                self.draft = m
+        self.last_text = text
+
+    def finish(self, answer: str, reply_markup: telebot.types.InlineKeyboardMarkup = None) -> bool:
+        '''Put final html answer into the draft.
+        Returns False if there is no draft or answer is too long,
+        then the caller should send the answer with bot_reply.'''
+        self.stopped = True
+        if not self.draft:
+            return False
+        if len(answer) > 4000:
+            self.cancel()
+            return False
+        try:
+            try:
+                self.edit(answer, 'HTML', reply_markup)
+            except Exception as error:
+                if 'message is not modified' not in str(error):
+                    if "Error code: 400. Description: Bad Request: can't parse entities" in str(error):
+                        my_log.log_parser_error(f'{str(error)}\n\n{DEBUG_MD_TO_HTML.get(answer, "")}\n=====================================================\n{answer}')
+                    self.edit(answer, '', reply_markup)
+            log_message(self.draft)
+            return True
+        except Exception as error:
+            my_log.log2(f'tb:StreamMessage:finish: {error}')
+            self.cancel()
+            return False
+
+    def cancel(self):
+        '''Delete the draft'''
+        self.stopped = True
+        if self.draft:
+            try:
+                bot.delete_message(self.draft.chat.id, self.draft.message_id)
+            except Exception as error:
+                my_log.log2(f'tb:StreamMessage:cancel: {error}')
+            self.draft = None
+
+
 def reply_to_long_message(message: telebot.types.Message, resp: str, parse_mode: str = None,
                           disable_web_page_preview: bool = None,
                           reply_markup: telebot.types.InlineKeyboardMarkup = None, send_message: bool = False,
@@ -4732,10 +5044,32 @@ def reply_to_long_message(message: telebot.types.Message, resp: str, parse_mode:
 
 @bot.message_handler(func=authorized)
 def echo_all(message: telebot.types.Message, custom_prompt: str = '') -> None:
-    thread = threading.Thread(target=do_task, args=(message, custom_prompt))
-    thread.start()
-def do_task(message, custom_prompt: str = ''):
-    """default handler"""
+    my_dispatch.submit(do_task, message, custom_prompt)
+
+
+def not_repetitive(answer: str) -> str:
+    '''Returns empty string instead of answer if it looks like a hung model'''
+    # если ответ длинный и в нем очень много повторений то вероятно это зависший ответ
+    # передаем эстафету следующему претенденту (ламе)
+    if answer and len(answer) > 2000 and my_transcribe.detect_repetitiveness_with_tail(answer):
+        return ''
+    return answer
+
+
+def do_task_parts(parts: list):
+    '''Glue parts of long message cut by telegram client and process them as one message,
+    parts - [(message, custom_prompt), ...]'''
+    message, custom_prompt = parts[0]
+    if len(parts) > 1:
+        message.text = '\n\n'.join(x.text for x, _ in parts if x.text)
+    # короткие сообщения в чате отвечаются быстро, пропускаем их вперед
+    priority = my_jobs.PRIORITY_HIGH if len(message.text or '') < 1000 else my_jobs.PRIORITY_NORMAL
+    job_submit('chat', message, do_task, message, custom_prompt, coalesced = True, priority = priority)
+
+
+def do_task(message, custom_prompt: str = '', coalesced: bool = False):
+    """default handler
+    coalesced - message parts are already glued (see MESSAGE_QUEUE)"""
 
     from_user_id = f'[{message.from_user.id}] [0]'
     if my_db.get_user_property(from_user_id, 'blocked'):
@@ -4745,25 +5079,17 @@ def do_task(message, custom_prompt: str = ''):
     lang = get_lang(chat_id_full, message)
 
     # catch too long messages
-    if chat_id_full not in MESSAGE_QUEUE:
-        MESSAGE_QUEUE[chat_id_full] = message.text
-        last_state = MESSAGE_QUEUE[chat_id_full]
-        n = 10
-        while n > 0:
-            n -= 1
-            time.sleep(0.1)
-            new_state = MESSAGE_QUEUE[chat_id_full]
-            if last_state != new_state:
-                last_state = new_state
-                n = 10
-        message.text = last_state
-        del MESSAGE_QUEUE[chat_id_full]
-    else:
-        MESSAGE_QUEUE[chat_id_full] += message.text + '\n\n'
-        u_id_ = str(message.chat.id)
-        if u_id_ in request_counter.counts:
-            if request_counter.counts[u_id_]:
-                request_counter.counts[u_id_].pop(0)
+    if not coalesced:
+        if len(message.text or '') < MESSAGE_QUEUE_PART_LEN:
+            delay = MESSAGE_QUEUE_DELAY_SHORT.get(message.chat.type, 0.3)
+        else:
+            delay = MESSAGE_QUEUE_DELAY.get(message.chat.type, 1)
+        if not MESSAGE_QUEUE.add(chat_id_full, (message, custom_prompt), delay):
+            # продолжение уже пойманного сообщения не считается отдельным запросом
+            u_id_ = str(message.chat.id)
+            if u_id_ in request_counter.counts:
+                if request_counter.counts[u_id_]:
+                    request_counter.counts[u_id_].pop(0)
         return
 
 
@@ -5052,20 +5378,33 @@ def do_task(message, custom_prompt: str = ''):
                             #                         my_db.get_user_property(chat_id_full, 'temperature'),
                             #                         model = 'gemini-1.5-flash')
 
-                            answer = my_gemini.chat(message.text,
-                                                    chat_id_full,
-                                                    my_db.get_user_property(chat_id_full, 'temperature'),
-                                                    model = 'gemini-1.5-flash',
-                                                    system = hidden_text,
-                                                    use_skills=True
-                                                    )
-
-                            # если ответ длинный и в нем очень много повторений то вероятно это зависший ответ
-                            # передаем эстафету следующему претенденту (ламе)
-                            if len(answer) > 2000 and my_transcribe.detect_repetitiveness_with_tail(answer):
-                                answer = ''
+                            query = message.text
+                            temperature = my_db.get_user_property(chat_id_full, 'temperature')
+                            style_ = my_db.get_user_property(chat_id_full, 'role') or hidden_text_for_llama370
+                            mem__ = my_gemini.get_mem_for_llama(chat_id_full)
+
+                            # историю пишем сами после ответа, иначе опоздавший в гонке тоже ее запишет,
+                            # опоздавший джемини не запускает скилы с побочными эффектами и не считается
+                            cancelled = threading.Event()
+                            gemini_answer = lambda: not_repetitive(my_gemini.chat(query,
+                                                                                  chat_id_full,
+                                                                                  temperature,
+                                                                                  model = 'gemini-1.5-flash',
+                                                                                  system = hidden_text,
+                                                                                  use_skills=True,
+                                                                                  update_memory=False,
+                                                                                  cancelled=cancelled,
+                                                                                  ))
+                            llama_answer = lambda: my_groq.ai(f'({style_}) {query}' if style_ else query,
+                                                              mem_ = mem__, model_ = 'llama-3.1-70b-versatile',)
+
+                            # если джемини думает дольше обычного то параллельно спрашиваем ламу
+                            who, answer = my_hedge.hedge(('gemini15flash', gemini_answer), ('llama370', llama_answer), cancelled=cancelled)
+                            flag_gpt_help = who == 'llama370'
+                            if flag_gpt_help:
+                                my_db.add_msg(chat_id_full, 'llama3-70b-8192')
+
                             if fuzz.ratio(answer, tr("images was generated successfully", lang)) > 80:
-                                my_gemini.undo(chat_id_full)
                                 message.text = f'/image {message.text}'
                                 image_gen(message)
                                 return
@@ -5073,25 +5412,10 @@ def do_task(message, custom_prompt: str = ''):
                                 WHO_ANSWERED[chat_id_full] = 'gemini15flash'
                             WHO_ANSWERED[chat_id_full] = f'👇{WHO_ANSWERED[chat_id_full]} {utils.seconds_to_str(time.time() - time_to_answer_start)}👇'
 
-                            flag_gpt_help = False
                             if not answer:
-                                style_ = my_db.get_user_property(chat_id_full, 'role') or hidden_text_for_llama370
-                                mem__ = my_gemini.get_mem_for_llama(chat_id_full)
-                                if style_:
-                                    answer = my_groq.ai(f'({style_}) {message.text}', mem_ = mem__, model_ = 'llama-3.1-70b-versatile',)
-                                else:
-                                    answer = my_groq.ai(message.text, mem_ = mem__, model_ = 'llama-3.1-70b-versatile',)
-                                if fuzz.ratio(answer, tr("images was generated successfully", lang)) > 80:
-                                    my_groq.undo(chat_id_full)
-                                    message.text = f'/image {message.text}'
-                                    image_gen(message)
-                                    return
-                                my_db.add_msg(chat_id_full, 'llama3-70b-8192')
-                                flag_gpt_help = True
-                                if not answer:
-                                    answer = 'Gemini ' + tr('did not answered, try to /reset and start again', lang)
-                                    return
-                                my_gemini.update_mem(message.text, answer, chat_id_full)
+                                answer = 'Gemini ' + tr('did not answered, try to /reset and start again', lang)
+                                return
+                            my_gemini.update_mem(query, answer, chat_id_full)
 
                             if not my_db.get_user_property(chat_id_full, 'voice_only_mode'):
                                 answer_ = utils.bot_markdown_to_html(answer)
@@ -5132,61 +5456,48 @@ def do_task(message, custom_prompt: str = ''):
                             #                         my_db.get_user_property(chat_id_full, 'temperature'),
                             #                         model = 'gemini-1.5-pro')
 
-                            exp_ = True
-                            WHO_ANSWERED[chat_id_full] = 'gemini15pro-exp'
-                            answer = my_gemini.chat(message.text,
-                                                    chat_id_full,
-                                                    my_db.get_user_property(chat_id_full, 'temperature'),
-                                                    # model = 'gemini-1.5-pro',
-                                                    model = 'gemini-1.5-pro-exp-0801',
-                                                    system = hidden_text,
-                                                    use_skills=True,
-                                                    )
-                            if not answer:
-                                exp_ = False
-                                WHO_ANSWERED[chat_id_full] = 'gemini15pro'
-                                answer = my_gemini.chat(message.text,
-                                                        chat_id_full,
-                                                        my_db.get_user_property(chat_id_full, 'temperature'),
-                                                        model = 'gemini-1.5-pro',
-                                                        system = hidden_text,
-                                                        use_skills=True,
-                                                        )
-
-                            # если ответ длинный и в нем очень много повторений то вероятно это зависший ответ
-                            # передаем эстафету следующему претенденту (ламе)
-                            if len(answer) > 2000 and my_transcribe.detect_repetitiveness_with_tail(answer):
-                                answer = ''
+                            query = message.text
+                            temperature = my_db.get_user_property(chat_id_full, 'temperature')
+                            style_ = my_db.get_user_property(chat_id_full, 'role') or hidden_text_for_llama370
+                            mem__ = my_gemini.get_mem_for_llama(chat_id_full)
+
+                            # историю пишем сами после ответа, иначе опоздавший в гонке тоже ее запишет.
+                            # Запасной pro получает скилы только если exp уже не работает, иначе
+                            # они оба могут выполнить одно и то же действие (профиль юзера, скрипты)
+                            cancelled = threading.Event()
+                            gemini_answer = lambda model, use_skills: not_repetitive(my_gemini.chat(query,
+                                                                                                    chat_id_full,
+                                                                                                    temperature,
+                                                                                                    model = model,
+                                                                                                    system = hidden_text,
+                                                                                                    use_skills=use_skills,
+                                                                                                    update_memory=False,
+                                                                                                    cancelled=cancelled,
+                                                                                                    ))
+                            llama_answer = lambda: my_groq.ai(f'({style_}) {query}' if style_ else query,
+                                                              mem_ = mem__, model_ = 'llama-3.1-70b-versatile',)
+
+                            # следующий запускается параллельно если предыдущий думает дольше обычного
+                            who, answer = my_hedge.hedge(('gemini15pro-exp', lambda: gemini_answer('gemini-1.5-pro-exp-0801', True)),
+                                                         ('gemini15pro', lambda: gemini_answer('gemini-1.5-pro', not my_hedge.is_hedged())),
+                                                         ('llama370', llama_answer),
+                                                         cancelled=cancelled)
+                            exp_ = who == 'gemini15pro-exp'
+                            flag_gpt_help = who == 'llama370'
+                            if flag_gpt_help:
+                                my_db.add_msg(chat_id_full, 'llama3-70b-8192')
+                            WHO_ANSWERED[chat_id_full] = 'gemini15pro-exp' if exp_ else 'gemini15pro'
+
                             if fuzz.ratio(answer, tr("images was generated successfully", lang)) > 80:
-                                my_gemini.undo(chat_id_full)
                                 message.text = f'/image {message.text}'
                                 image_gen(message)
                                 return
-                            if chat_id_full not in WHO_ANSWERED:
-                                if exp_:
-                                    WHO_ANSWERED[chat_id_full] = 'gemini15pro-exp'
-                                else:
-                                    WHO_ANSWERED[chat_id_full] = 'gemini15pro'
                             WHO_ANSWERED[chat_id_full] = f'👇{WHO_ANSWERED[chat_id_full]} {utils.seconds_to_str(time.time() - time_to_answer_start)}👇'
-                            flag_gpt_help = False
+
                             if not answer:
-                                style_ = my_db.get_user_property(chat_id_full, 'role') or hidden_text_for_llama370
-                                mem__ = my_gemini.get_mem_for_llama(chat_id_full)
-                                if style_:
-                                    answer = my_groq.ai(f'({style_}) {message.text}', mem_ = mem__, model_ = 'llama-3.1-70b-versatile',)
-                                else:
-                                    answer = my_groq.ai(message.text, mem_ = mem__, model_ = 'llama-3.1-70b-versatile',)
-                                if fuzz.ratio(answer, tr("images was generated successfully", lang)) > 80:
-                                    my_groq.undo(chat_id_full)
-                                    message.text = f'/image {message.text}'
-                                    image_gen(message)
-                                    return
-                                my_db.add_msg(chat_id_full, 'llama3-70b-8192')
-                                flag_gpt_help = True
-                                if not answer:
-                                    answer = 'Gemini ' + tr('did not answered, try to /reset and start again', lang)
-                                    return
-                                my_gemini.update_mem(message.text, answer, chat_id_full)
+                                answer = 'Gemini ' + tr('did not answered, try to /reset and start again', lang)
+                                return
+                            my_gemini.update_mem(query, answer, chat_id_full)
 
                             if not my_db.get_user_property(chat_id_full, 'voice_only_mode'):
                                 answer_ = utils.bot_markdown_to_html(answer)
@@ -5225,6 +5536,9 @@ def do_task(message, custom_prompt: str = ''):
                             if not my_db.get_user_property(chat_id_full, 'temperature'):
                                 my_db.set_user_property(chat_id_full, 'temperature', GEMIMI_TEMP_DEFAULT)
 
+                            # в режиме только голоса ответ показывать по мере генерации незачем
+                            stream = None if my_db.get_user_property(chat_id_full, 'voice_only_mode') else StreamMessage(message)
+
                             style_ = my_db.get_user_property(chat_id_full, 'role') or hidden_text_for_llama370
                             if style_:
                                 answer = my_groq.chat(f'({style_}) {message.text}',
@@ -5232,6 +5546,7 @@ def do_task(message, custom_prompt: str = ''):
                                                       my_db.get_user_property(chat_id_full, 'temperature'),
                                                       model = 'llama-3.1-70b-versatile',
                                                     #   model = 'llama3-70b-8192',
+                                                      stream_callback = stream,
                                                       )
                             else:
                                 answer = my_groq.chat(message.text,
@@ -5239,8 +5554,11 @@ def do_task(message, custom_prompt: str = ''):
                                                       my_db.get_user_property(chat_id_full, 'temperature'),
                                                       model = 'llama-3.1-70b-versatile',
                                                     #   model = 'llama3-70b-8192',
+                                                      stream_callback = stream,
                                                       )
                             if fuzz.ratio(answer, tr("images was generated successfully", lang)) > 80:
+                                if stream:
+                                    stream.cancel()
                                 my_groq.undo(chat_id_full)
                                 message.text = f'/image {message.text}'
                                 image_gen(message)
@@ -5259,6 +5577,8 @@ def do_task(message, custom_prompt: str = ''):
                                 answer = answer_
 
                             my_log.log_echo(message, f'[groq-llama370] {answer}')
+                            if stream and stream.finish(answer, get_keyboard('groq_groq-llama370_chat', message)):
+                                return
                             try:
                                 bot_reply(message, answer, parse_mode='HTML', disable_web_page_preview = True,
                                                         reply_markup=get_keyboard('groq_groq-llama370_chat', message), not_log=True, allow_voice = True)
@@ -5282,8 +5602,9 @@ def do_task(message, custom_prompt: str = ''):
 
                     with ShowAction(message, action):
                         try:
+                            stream = None if my_db.get_user_property(chat_id_full, 'voice_only_mode') else StreamMessage(message)
                             style_ = my_db.get_user_property(chat_id_full, 'role') or ''
-                            status, answer = my_openrouter.chat(message.text, chat_id_full, system=style_)
+                            status, answer = my_openrouter.chat(message.text, chat_id_full, system=style_, stream_callback=stream)
                             WHO_ANSWERED[chat_id_full] = 'openrouter ' + my_openrouter.PARAMS[chat_id_full][0]
                             WHO_ANSWERED[chat_id_full] = f'👇{WHO_ANSWERED[chat_id_full]} {utils.seconds_to_str(time.time() - time_to_answer_start)}👇'
 
@@ -5296,6 +5617,8 @@ def do_task(message, custom_prompt: str = ''):
                                 answer = answer_
 
                             my_log.log_echo(message, f'[openrouter {my_openrouter.PARAMS[chat_id_full][0]}] {answer}')
+                            if stream and stream.finish(answer, get_keyboard('openrouter_chat', message)):
+                                return
                             try:
                                 bot_reply(message, answer, parse_mode='HTML', disable_web_page_preview = True,
                                                         reply_markup=get_keyboard('openrouter_chat', message), not_log=True, allow_voice = True)
@@ -5511,7 +5834,7 @@ def do_task(message, custom_prompt: str = ''):
                         return
 
 
-@async_run
+@utils.async_run
 def activity_daemon():
     '''Restarts the bot if it's been inactive for too long, may be telegram collapsed.'''
     return # не работает почему то
@@ -5608,6 +5931,8 @@ def main():
     my_groq.load_users_keys()
     my_trans.load_users_keys()
     my_db.init()
+    tr_warmup()
+    my_transcribe.resume_jobs()
 
     one_time_shot()
 
@@ -5615,6 +5940,8 @@ def main():
 
     log_group_daemon()
 
+    show_action_daemon()
+
     # Remove webhook, it fails sometimes the set if there is a previous webhook
     bot.remove_webhook()
     time.sleep(1)
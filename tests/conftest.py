@@ -0,0 +1,9 @@
+# модули бота лежат в корне репозитория и импортируются по имени (import my_db),
+# тесты запускаются из корня: python -m pytest -q tests
+
+
+import os
+import sys
+
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
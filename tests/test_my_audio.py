@@ -0,0 +1,23 @@
+import pytest
+
+
+pytest.importorskip('my_log')
+import my_audio
+
+
+def test_parse_duration_last_time():
+    # строка статистики пишется несколько раз, нужна последняя
+    log = ('Duration: N/A, start: 0.000000, bitrate: N/A\n'
+           'size=     256kB time=00:00:10.00 bitrate= 209.7kbits/s\r'
+           'size=     512kB time=00:01:02.50 bitrate= 209.7kbits/s\n')
+    assert my_audio.parse_duration(log) == 62.5
+
+
+def test_parse_duration_header():
+    log = '  Duration: 01:02:03.25, start: 0.000000, bitrate: 64 kb/s\n'
+    assert my_audio.parse_duration(log) == 3723.25
+
+
+def test_parse_duration_not_found():
+    assert my_audio.parse_duration('') == 0
+    assert my_audio.parse_duration('pipe:0: Invalid data found when processing input') == 0
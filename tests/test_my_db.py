@@ -0,0 +1,122 @@
+import sqlite3
+import time
+
+import pytest
+
+
+pytest.importorskip('my_log')
+import my_db
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    '''stt_cache и счетчики сообщений во временной базе, без init и его демонов'''
+    db_file = str(tmp_path / 'main.db')
+    con = sqlite3.connect(db_file, check_same_thread=False)
+    cur = con.cursor()
+    cur.execute('PRAGMA journal_mode = WAL')
+    cur.execute('''
+        CREATE TABLE stt_cache (
+            key TEXT PRIMARY KEY,
+            date REAL,
+            lang TEXT,
+            engine TEXT,
+            text TEXT
+        )
+    ''')
+    cur.execute('''
+        CREATE TABLE msg_counter (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT,
+            access_time REAL,
+            model_used TEXT
+        )
+    ''')
+    cur.execute('''
+        CREATE TABLE msg_counter_daily (
+            user_id TEXT,
+            model_used TEXT,
+            day INTEGER,
+            count INTEGER,
+            PRIMARY KEY (user_id, model_used, day)
+        ) WITHOUT ROWID
+    ''')
+    cur.execute('''
+        CREATE TABLE msg_counter_users (
+            user_id TEXT PRIMARY KEY,
+            total INTEGER,
+            last_time REAL
+        ) WITHOUT ROWID
+    ''')
+    con.commit()
+    pool = my_db.ReadPool(db_file)
+    monkeypatch.setattr(my_db, 'CON', con)
+    monkeypatch.setattr(my_db, 'CUR', cur)
+    monkeypatch.setattr(my_db, 'READ_POOL', pool)
+    monkeypatch.setattr(my_db, 'STT_CACHE_STATS', dict.fromkeys(my_db.STT_CACHE_STATS, 0))
+    monkeypatch.setattr(my_db, 'STT_CACHE_CLEAN_EVERY', 1)
+    yield con
+    pool.close()
+    con.close()
+
+
+def test_stt_cache_max_rows(db, monkeypatch):
+    monkeypatch.setattr(my_db, 'STT_CACHE_MAX_ROWS', 3)
+    for i in range(5):
+        my_db.set_stt_cache(f'k{i}', 'ru', 'google', f'text {i}')
+        # у записей должно быть разное время, выкидываются самые старые
+        time.sleep(0.01)
+    db.commit()
+    assert [my_db.get_stt_cache(f'k{i}') for i in range(5)] == ['', '', 'text 2', 'text 3', 'text 4']
+    stats = my_db.get_stt_cache_stats()
+    assert stats['written'] == 5
+    assert stats['evicted'] == 2
+    assert stats['hits'] == 3 and stats['misses'] == 2
+
+
+def test_stt_cache_ttl(db):
+    my_db.CUR.execute('INSERT INTO stt_cache VALUES (?, ?, ?, ?, ?)',
+                      ('old', time.time() - my_db.STT_CACHE_TTL - 10, 'ru', 'google', 'old text'))
+    db.commit()
+    # просроченная запись не отдается даже пока ее не удалили
+    assert my_db.get_stt_cache('old') == ''
+    my_db.set_stt_cache('new', 'ru', 'google', 'new text')
+    db.commit()
+    assert my_db.get_stt_cache('new') == 'new text'
+    assert my_db.CUR.execute('SELECT key FROM stt_cache').fetchall() == [('new',)]
+    assert my_db.get_stt_cache_stats()['evicted'] == 1
+
+
+def rows(table: str) -> list:
+    return my_db.CUR.execute(f'SELECT * FROM {table} ORDER BY 1, 2').fetchall()
+
+
+def test_write_msgs_rollback(db):
+    my_db.CUR.execute('DROP TABLE msg_counter_users')
+    my_db.write_msgs([('u1', time.time(), 'gemini')])
+    # третья вставка упала, первые две откатились
+    assert rows('msg_counter') == []
+    assert rows('msg_counter_daily') == []
+
+
+def test_expire_msgs(db):
+    now = time.time()
+    old = now - (my_db.MSG_KEEP_DAYS + 10) * my_db.DAY_SECONDS
+    my_db.write_msgs([('u1', old, 'gemini'), ('u1', now, 'gemini'), ('u2', old, 'groq')])
+    assert my_db.CUR.execute('SELECT user_id, total FROM msg_counter_users ORDER BY 1').fetchall() == [('u1', 2), ('u2', 1)]
+    my_db.expire_msgs()
+    # у u1 осталось одно свежее сообщение, у u2 ничего
+    assert my_db.CUR.execute('SELECT user_id, total FROM msg_counter_users').fetchall() == [('u1', 1)]
+    assert [row[1:] for row in rows('msg_counter')] == [('u1', now, 'gemini')]
+    assert [row[:2] for row in rows('msg_counter_daily')] == [('u1', 'gemini')]
+
+
+def test_write_msgs_duplicates(db):
+    now = time.time()
+    batch = [('u1', now, 'gemini'), ('u1', now, 'gemini'), ('u1', now + 1, 'gemini')]
+    my_db.write_msgs(batch)
+    # повтор той же пачки ничего не добавляет
+    my_db.write_msgs(batch)
+    assert len(rows('msg_counter')) == 2
+    assert my_db.CUR.execute('SELECT SUM(count) FROM msg_counter_daily').fetchone() == (2,)
+    assert my_db.CUR.execute('SELECT total FROM msg_counter_users').fetchall() == [(2,)]
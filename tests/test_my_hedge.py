@@ -0,0 +1,41 @@
+import time
+
+import pytest
+
+
+pytest.importorskip('my_log')
+import my_hedge
+
+
+def test_first_good_answer():
+    assert my_hedge.hedge(('a', lambda: ''), ('b', lambda: 'b')) == ('b', 'b')
+    assert my_hedge.hedge(('a', lambda: ''), ('b', lambda: None), default='x') == ('', 'x')
+
+
+def test_bad_answer_starts_next_at_once():
+    start = time.time()
+    # a думает долго, b запущен параллельно и ответил плохо, c должен стартовать сразу а не через delay
+    who, answer = my_hedge.hedge(('a', lambda: time.sleep(3) or 'a'),
+                                 ('b', lambda: ''),
+                                 ('c', lambda: 'c'),
+                                 delay=1)
+    assert (who, answer) == ('c', 'c')
+    assert time.time() - start < 1.5
+
+
+def test_is_hedged():
+    seen = {}
+
+    def provider(name, result, sleep=0):
+        def func():
+            seen[name] = my_hedge.is_hedged()
+            time.sleep(sleep)
+            return result
+        return func
+
+    # b запущен пока a еще думает
+    my_hedge.hedge(('a', provider('a', 'a', 0.5)), ('b', provider('b', '')), delay=0.1)
+    assert seen == {'a': False, 'b': True}
+    # d запущен когда c уже ответил плохо и никто не работает
+    my_hedge.hedge(('c', provider('c', '')), ('d', provider('d', 'd')), delay=0.1)
+    assert seen['c'] is False and seen['d'] is False
@@ -0,0 +1,89 @@
+import threading
+import time
+
+import pytest
+
+
+# my_log нужен cfg.py и telebot, без них модули бота не импортируются
+pytest.importorskip('my_log')
+import my_jobs
+
+
+def wait_idle(name: str, timeout: float = 5):
+    job_class = my_jobs.get_class(name)
+    end = time.time() + timeout
+    while time.time() < end:
+        with my_jobs.LOCK:
+            if not job_class.running and not job_class.waiting:
+                return
+        time.sleep(0.01)
+    raise TimeoutError(name)
+
+
+def test_priority_then_least_recently_served(monkeypatch):
+    monkeypatch.setitem(my_jobs.JOB_CLASSES, 'test_fair', 1)
+    busy = threading.Event()
+    order = []
+    my_jobs.submit('test_fair', 'z', busy.wait)
+    for user, priority in (('a', 2), ('a', 2), ('b', 2), ('c', 1)):
+        my_jobs.submit('test_fair', user, order.append, (user,), priority=priority)
+    busy.set()
+    wait_idle('test_fair')
+    # сначала высокий приоритет, потом тот кого обслуживали давнее
+    assert order == ['c', 'a', 'b', 'a']
+
+
+def test_one_job_of_type_per_user(monkeypatch):
+    monkeypatch.setitem(my_jobs.JOB_CLASSES, 'test_user', 3)
+    running = []
+    max_running = []
+    lock = threading.Lock()
+
+    def job():
+        with lock:
+            running.append(1)
+            max_running.append(len(running))
+        time.sleep(0.05)
+        with lock:
+            running.pop()
+
+    futures = [my_jobs.submit('test_user', 'a', job) for _ in range(3)]
+    for f in futures:
+        f.result(5)
+    assert max(max_running) == 1
+
+
+def test_queue_positions_reported(monkeypatch):
+    monkeypatch.setitem(my_jobs.JOB_CLASSES, 'test_notice', 1)
+    busy = threading.Event()
+    positions = []
+    my_jobs.submit('test_notice', 'z', busy.wait)
+    future = my_jobs.submit('test_notice', 'b', lambda: 1, on_wait=positions.append)
+    my_jobs.submit('test_notice', 'a', lambda: 2, priority=my_jobs.PRIORITY_ADMIN)
+    time.sleep(0.1)
+    # сначала первый в очереди, потом админ его подвинул
+    assert positions == [1, 2]
+    busy.set()
+    assert future.result(5) == 1
+    wait_idle('test_notice')
+    time.sleep(0.1)
+    # после админа снова первая (если не успело слиться с запуском), потом запустилась
+    assert positions[2:] in ([1, 0], [0])
+
+
+def test_failed_job_releases_slot(monkeypatch):
+    monkeypatch.setitem(my_jobs.JOB_CLASSES, 'test_error', 1)
+    assert my_jobs.submit('test_error', 'a', lambda: 1 / 0).result(5) is None
+    assert my_jobs.submit('test_error', 'a', lambda: 1).result(5) == 1
+
+
+def test_last_served_pruned(monkeypatch):
+    monkeypatch.setattr(my_jobs, 'LAST_SERVED_MAX', 2)
+    job_class = my_jobs.JobClass('test_prune', 1)
+    now = time.time()
+    job_class.last_served = {'old1': now - 2 * my_jobs.LAST_SERVED_TTL,
+                             'old2': now - 2 * my_jobs.LAST_SERVED_TTL,
+                             'new': now}
+    job_class.last_prune = 0
+    job_class.prune(now)
+    assert list(job_class.last_served) == ['new']
@@ -0,0 +1,21 @@
+import my_keys
+
+
+def test_pick_takes_token():
+    pool = my_keys.KeyPool('test', rpm=1)
+    # у каждого ключа один токен, два вызова подряд получают разные ключи
+    first = pool.pick(['a', 'b'], 1)[0]
+    second = pool.pick(['a', 'b'], 1)[0]
+    assert first != second
+    pool.success(first)
+    assert pool.keys[first]['reserved'] == 0
+    assert pool.keys[first]['tokens'] < 1
+
+
+def test_failure_gives_token_back():
+    pool = my_keys.KeyPool('test', rpm=1)
+    key = pool.pick(['a'], 1)[0]
+    assert pool.keys[key]['tokens'] < 1
+    pool.failure(key, 'connection reset')
+    assert pool.keys[key]['tokens'] == 1
+    assert pool.keys[key]['reserved'] == 0
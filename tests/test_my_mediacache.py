@@ -0,0 +1,60 @@
+import collections
+
+import pytest
+
+
+pytest.importorskip('my_log')
+import my_mediacache
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(my_mediacache, 'CACHE_DIR', str(tmp_path))
+    monkeypatch.setattr(my_mediacache, 'INDEX', collections.OrderedDict())
+    monkeypatch.setattr(my_mediacache, 'LOADED', False)
+    monkeypatch.setattr(my_mediacache, 'TOTAL_SIZE', 0)
+    monkeypatch.setattr(my_mediacache, 'STATS', dict.fromkeys(my_mediacache.STATS, 0))
+    monkeypatch.setattr(my_mediacache, 'MAX_SIZE', 100)
+    return tmp_path
+
+
+def test_lru_eviction(cache):
+    my_mediacache.put('a', b'1' * 40)
+    my_mediacache.put('b', b'2' * 40)
+    # a использован позже b, значит выкинут будет b
+    assert my_mediacache.get('a') == b'1' * 40
+    my_mediacache.put('c', b'3' * 40)
+    assert my_mediacache.get('b') == b''
+    assert my_mediacache.get('a') and my_mediacache.get('c')
+    assert my_mediacache.TOTAL_SIZE == 80
+    assert my_mediacache.STATS['evicted'] == 1
+    assert sorted(x.name for x in cache.iterdir()) == ['a', 'c']
+
+
+def test_too_big_and_replaced(cache):
+    my_mediacache.put('big', b'x' * (my_mediacache.MAX_FILE_SIZE + 1))
+    assert my_mediacache.get('big') == b''
+    my_mediacache.put('a', b'1' * 30)
+    my_mediacache.put('a', b'2' * 10)
+    assert my_mediacache.get('a') == b'2' * 10
+    assert my_mediacache.TOTAL_SIZE == 10
+
+
+def test_index_restored_on_load(cache):
+    (cache / 'old').write_bytes(b'1' * 10)
+    (cache / 'half.123.tmp').write_bytes(b'1' * 10)
+    assert my_mediacache.get('old') == b'1' * 10
+    assert not (cache / 'half.123.tmp').exists()
+    assert my_mediacache.TOTAL_SIZE == 10
+
+
+def test_results_and_file_path_stats(cache):
+    my_mediacache.put_result('f1', 'ocr', 'text', 'eng')
+    assert my_mediacache.get_result('f1', 'ocr', 'eng') == 'text'
+    assert my_mediacache.get_result('f1', 'ocr', 'rus') == ''
+    my_mediacache.put_file_path('f1', 'voice/file_1.oga')
+    assert my_mediacache.get_file_path('f1') == 'voice/file_1.oga'
+    # путь к файлу не результат распознавания и не попадает в статистику
+    assert my_mediacache.STATS['results_hits'] == 1
+    assert my_mediacache.STATS['results_misses'] == 1
+    assert my_mediacache.STATS['hits'] == my_mediacache.STATS['misses'] == 0
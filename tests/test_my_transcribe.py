@@ -0,0 +1,88 @@
+import threading
+import time
+
+import pytest
+
+
+# тяжелые зависимости распознавания и клиенты api
+pytest.importorskip('numpy')
+pytest.importorskip('pydub')
+pytest.importorskip('speech_recognition')
+pytest.importorskip('google.generativeai')
+pytest.importorskip('my_gemini')
+import my_transcribe
+
+
+@pytest.mark.parametrize('duration', [1, 5, 599, 600, 601, 605, 1234, 3 * 3600 + 7])
+def test_make_parts_cover_whole_record(duration):
+    parts = my_transcribe.make_parts(duration)
+    assert parts[0][0] == 0
+    # каждый кусок начинается раньше чем кончился предыдущий и последний доходит до конца
+    for (start, length), (next_start, _) in zip(parts, parts[1:]):
+        assert next_start < start + length
+    start, length = parts[-1]
+    assert start + length >= int(duration)
+
+
+def test_make_parts_sizes():
+    parts = my_transcribe.make_parts(1500, part_size=600, treshold=5)
+    assert parts == [(0, 605), (595, 610), (1195, 305)]
+    assert my_transcribe.make_parts(0) == []
+    assert my_transcribe.make_parts(30) == [(0, 30)]
+
+
+def test_split_on_pauses_cuts_in_pauses(monkeypatch):
+    import numpy
+    rate = my_transcribe.my_audio.PCM_RATE
+    # 150 секунд звука, паузы по секунде на 20-й и 60-й секунде
+    samples = numpy.full(150 * rate, 10000, dtype=numpy.int16)
+    for pause in (20, 60):
+        samples[pause * rate:(pause + 1) * rate] = 0
+    pcm = samples.tobytes()
+
+    def stream_pcm(data, block=1.0):
+        size = int(rate * 2 * block)
+        for i in range(0, len(data), size):
+            yield data[i:i + size]
+
+    monkeypatch.setattr(my_transcribe.my_audio, 'stream_pcm', stream_pcm)
+    parts = [(start, len(chunk) / rate / 2) for start, chunk in my_transcribe.split_on_pauses(pcm, max_size=50)]
+    # режется по середине паузы, а где пауз нет - ровно по max_size
+    assert parts == [(0, 20.5), (20.5, 40), (60.5, 50), (110.5, 39.5)]
+
+
+def test_transcribe_url_waiter_gets_exception(monkeypatch):
+    started = threading.Event()
+    release = threading.Event()
+
+    calls = []
+
+    def transcribe_job(*args):
+        calls.append(args)
+        started.set()
+        release.wait(5)
+        raise RuntimeError('yt-dlp failed')
+
+    monkeypatch.setattr(my_transcribe.my_db, 'get_stt_cache', lambda key: '')
+    monkeypatch.setattr(my_transcribe, 'transcribe_job', transcribe_job)
+    errors = []
+
+    def call():
+        try:
+            my_transcribe.transcribe_url('https://example.com/v', 'ru')
+        except RuntimeError as error:
+            errors.append(str(error))
+
+    first = threading.Thread(target=call)
+    first.start()
+    started.wait(5)
+    # второй присоединяется к уже идущей задаче
+    second = threading.Thread(target=call)
+    second.start()
+    time.sleep(0.2)
+    release.set()
+    first.join(5)
+    second.join(5)
+    assert len(calls) == 1
+    assert errors == ['yt-dlp failed', 'yt-dlp failed']
+    assert not my_transcribe.JOBS
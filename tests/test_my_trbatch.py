@@ -0,0 +1,40 @@
+import pytest
+
+
+pytest.importorskip('langcodes')
+# my_gemini и my_groq тянут клиентов api и cfg.py
+pytest.importorskip('my_gemini')
+pytest.importorskip('my_groq')
+import my_trbatch
+
+
+def test_pack_unpack_roundtrip():
+    texts = ['Hello', '<b>Bot name:</b> /name', 'two\nlines']
+    assert my_trbatch.unpack(my_trbatch.pack(texts), len(texts)) == dict(enumerate(texts))
+
+
+def test_unpack_skips_bad_numbers_duplicates_and_empty():
+    answer = '<t id="0">Hallo</t>\n<t id=1> </t><t id="0">again</t><t id="7">extra</t><t id=2>Drei</t>'
+    assert my_trbatch.unpack(answer, 3) == {0: 'Hallo', 2: 'Drei'}
+    assert my_trbatch.unpack(None, 3) == {}
+
+
+@pytest.mark.parametrize('original, translated, valid', [
+    ('<b>Bot name:</b> /name', '<b>Имя бота:</b> /name', True),
+    ('<b>Bot name:</b> /name', 'Имя бота: /name', False),
+    ('<b>Bot name:</b> /name', '<b>Имя бота:</b> /имя', False),
+    ('Hello', '', False),
+    ('Hi', 'x' * 100, False),
+    ('Use /img or /tts', 'Используйте /tts или /img', True),
+])
+def test_is_valid(original, translated, valid):
+    assert my_trbatch.is_valid(original, translated) is valid
+
+
+def test_make_batches_limits(monkeypatch):
+    monkeypatch.setattr(my_trbatch, 'BATCH_CHARS', 10)
+    monkeypatch.setattr(my_trbatch, 'BATCH_ITEMS', 3)
+    texts = ['aaaa', 'bbbb', 'cccc', 'd', 'e', 'f', 'g', 'x' * 20]
+    batches = my_trbatch.make_batches(texts)
+    assert batches == [['aaaa', 'bbbb'], ['cccc', 'd', 'e'], ['f', 'g'], ['x' * 20]]
+    assert [x for batch in batches for x in batch] == texts
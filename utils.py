@@ -13,7 +13,6 @@ import pytz
 import random
 import re
 import regex
-import requests
 import string
 import subprocess
 import sys
@@ -26,6 +25,7 @@ import prettytable
 import telebot
 from pylatexenc.latex2text import LatexNodes2Text
 
+import my_http
 import my_log
 
 
@@ -414,14 +414,9 @@ def is_image_link(url: str) -> bool:
 
   try:
     # response = requests.get(url, timeout=2, stream=True)
-    content = b''
-    response = requests.get(url, stream=True, timeout=10)
-    # Ограничиваем размер
-    for chunk in response.iter_content(chunk_size=1024):
-        content += chunk
-        if len(content) > 50000:
-            break
-    content_type = response.headers['Content-Type']
+    # тело не нужно, хватает заголовков, закрытие ответа возвращает соединение в пул
+    with my_http.get(url, stream=True, timeout=10) as response:
+        content_type = response.headers['Content-Type']
     return content_type.startswith('image/')
   except:
     return False
@@ -440,14 +435,21 @@ def download_image_as_bytes(url_or_urls):
 
     if isinstance(url_or_urls, str):
         try:
-            response = requests.get(url_or_urls, timeout=30)
+            response = my_http.get(url_or_urls, timeout=30)
         except Exception as error:
             return None
         return response.content
 
     elif isinstance(url_or_urls, list):
+        def download(url):
+            try:
+                response = my_http.get(url, timeout=30)
+            except Exception:
+                return None
+            return response.content if response.status_code == 200 else None
+
         with concurrent.futures.ThreadPoolExecutor() as executor:
-            results = list(executor.map(lambda url: requests.get(url, timeout=30).content if requests.get(url, timeout=30).status_code == 200 else None, url_or_urls))
+            results = list(executor.map(download, url_or_urls))
         return results
 
     else: